@@ -4,7 +4,8 @@ import networkx as nx
 import xml.etree.ElementTree as ET
 import os
 from random_fbt import generate_random_fbt
-from parse_rich_newick2 import parse_rich_newick, modify_BirthDeath_str
+from jvm_admission import run_java_prefix
+from parse_rich_newick2 import parse_rich_newick, modify_BirthDeath_str, read_rich_newick_file
 
 # Define degree conditions
 
@@ -33,6 +34,21 @@ def BirthHybrid(taxonset_count, taxa_per_set, iterations, origin=0.1, birth_rate
 
     Returns an array of networks in Newick format.
     '''
+    popped_path = run_BirthHybrid(taxonset_count, taxa_per_set, iterations, origin=origin, birth_rate=birth_rate, hybrid_rate=hybrid_rate, simtag=simtag, work_path=work_path, beast_prefix=beast_prefix)
+
+    with open(popped_path) as f:
+        output = [line[:-2] for line in f]
+
+    return output
+
+def run_BirthHybrid(taxonset_count, taxa_per_set, iterations, origin=0.1, birth_rate=20, hybrid_rate=10, simtag=0, work_path='', beast_prefix='beast'):
+    '''
+    Runs the BirthHybrid model through Beast2, as described in BirthHybrid.
+
+    BEAST runs under admission control (see jvm_admission.py) when beast_prefix is a java command or BEAST 2's bin/beast script.
+
+    Returns the path of the summarized tree file, which can be streamed with read_rich_newick_file.
+    '''
     if work_path != '' and work_path[-1] != '/':
         work_path += '/'
 
@@ -86,13 +102,11 @@ def BirthHybrid(taxonset_count, taxa_per_set, iterations, origin=0.1, birth_rate
     with open(f'{work_path}bubblepop.xml', 'w') as f:
         f.write(ET.tostring(bubble_pop_root, encoding="unicode"))
 
-    os.system(f'{beast_prefix} {work_path}simulation.xml')
-    os.system(f'{beast_prefix} {work_path}bubblepop.xml')
+    features = {"taxa": taxonset_count * taxa_per_set, "loci": iterations}
+    run_java_prefix("beast", beast_prefix, [f'{work_path}simulation.xml'], features)
+    run_java_prefix("beast", beast_prefix, [f'{work_path}bubblepop.xml'], features)
 
-    with open(f'{work_path}popped{simtag}.trees') as f:
-        output = [line[:-2] for line in f.readlines()]
-
-    return output
+    return f'{work_path}popped{simtag}.trees'
 
 def pretty_xml(element):
     '''
@@ -367,17 +381,16 @@ def generate_admixture_networks(pop_count, admixture_count, time_interval, outgr
     return list([(network, generate_ms_command(network, alleles_per_pop, loci_count, mutation, recombination, locus_length, ms_prefix)) for network in networks_modified])
 
 # def generate_BirthHybrid_networks(n, pop_count, alleles_per_pop, loci_count, mutation, recombination, locus_length, sim_path, bubble_pop_path, netcount=1, simtag='0', beast_dir='', ms_prefix="ms"):
-def generate_BirthHybrid_networks(n, pop_count, alleles_per_pop, loci_count, mutation, recombination, locus_length, origin=0.1, birth_rate=20, hybrid_rate=10, work_path="", simtag=0, beast_prefix="beast", ms_prefix="ms"):
+def generate_BirthHybrid_networks(n, pop_count, alleles_per_pop, loci_count, mutation, recombination, locus_length, origin=0.1, birth_rate=20, hybrid_rate=10, work_path="", simtag=0, beast_prefix="beast", ms_prefix="ms", annotations=None):
     """
     Generates n random admixture networks according to the provided parameters. 
     Returns a list of tuples, where the first element in each tuple is an admixture network, and the second element is a command for ms.
+    annotations is an optional list of BEAST annotation keys (e.g. "height_mean") to keep as node attributes.
     """
     # network_strings = BirthHybrid(pop_count, alleles_per_pop, n, sim_path, bubble_pop_path, netcount=netcount, simtag=simtag, beast_dir=beast_dir)
-    network_strings = BirthHybrid(pop_count, alleles_per_pop, n, origin=origin, birth_rate=birth_rate, hybrid_rate=hybrid_rate, simtag=simtag, work_path=work_path, beast_prefix=beast_prefix)
+    popped_path = run_BirthHybrid(pop_count, alleles_per_pop, n, origin=origin, birth_rate=birth_rate, hybrid_rate=hybrid_rate, simtag=simtag, work_path=work_path, beast_prefix=beast_prefix)
     networks = []
-    for network_str in network_strings:
-        network_str = modify_BirthDeath_str(network_str)
-        network = parse_rich_newick(network_str)
+    for network in read_rich_newick_file(popped_path, annotations=annotations, gamma_as_proportion=True): # Streams the file, reading admixture proportions from the gamma annotations
         if not all(attr["length"] >= 0 for attr in network.edges.values()): # Skip networks that have negative-length branches (very unlikely), should probably be handled more robustly in the future
             continue
         add_BirthDeath_time_tags(network)
@@ -386,7 +399,7 @@ def generate_BirthHybrid_networks(n, pop_count, alleles_per_pop, loci_count, mut
         networks.append((network, cmd))
     return networks
 
-def generate_BirthHybrid_networks_admixture_target(n, admixture_count, pop_count, alleles_per_pop, loci_count, mutation, recombination, locus_length, origin=0.1, birth_rate=20, hybrid_rate=10, work_path="", simtag=0, beast_prefix="beast", ms_prefix="ms"):
+def generate_BirthHybrid_networks_admixture_target(n, admixture_count, pop_count, alleles_per_pop, loci_count, mutation, recombination, locus_length, origin=0.1, birth_rate=20, hybrid_rate=10, work_path="", simtag=0, beast_prefix="beast", ms_prefix="ms", annotations=None):
     """
     Generates n random admixture networks according to the provided parameters. All networks have exactly admixture_count admixture nodes.
     Returns a list of tuples, where the first element in each tuple is an admixture network, and the second element is a command for ms.
@@ -395,7 +408,7 @@ def generate_BirthHybrid_networks_admixture_target(n, admixture_count, pop_count
     """
     networks = []
     while len(networks) < n:
-        new_networks = generate_BirthHybrid_networks(n, pop_count, alleles_per_pop, loci_count, mutation, recombination, locus_length, origin=origin, birth_rate=birth_rate, hybrid_rate=hybrid_rate, work_path=work_path, simtag=simtag, beast_prefix=beast_prefix, ms_prefix=ms_prefix)
+        new_networks = generate_BirthHybrid_networks(n, pop_count, alleles_per_pop, loci_count, mutation, recombination, locus_length, origin=origin, birth_rate=birth_rate, hybrid_rate=hybrid_rate, work_path=work_path, simtag=simtag, beast_prefix=beast_prefix, ms_prefix=ms_prefix, annotations=annotations)
         for network_pair in new_networks:
             network_admixture_count = len([node for node, attrs in network_pair[0].nodes.items() if attrs['type'] == 'admixture']) # Count admixture nodes
             if network_admixture_count == admixture_count:
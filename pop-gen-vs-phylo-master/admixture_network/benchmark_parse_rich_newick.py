@@ -0,0 +1,56 @@
+import sys
+import time
+import networkx as nx
+from parse_rich_newick2 import parse_rich_newick, parse_rich_newick_recursive, modify_BirthDeath_str
+
+def time_parser(parser, strings, repeats):
+    """
+    Returns the best wall time, over a number of repeats, for parsing every string in a list with the given parser.
+    """
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for string in strings:
+            parser(string)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def caterpillar_string(depth):
+    """
+    Returns a Rich Newick string for a caterpillar tree with the given nesting depth, which is the worst case for the recursive parser.
+    """
+    return "(" * depth + "A0:1.0" + "".join(f',A{i + 1}:1.0):1.0' for i in range(depth)) + ";"
+
+def benchmark_file(path, repeats=5):
+    """
+    Compares the two parsers on the networks in a BEAST tree file, checking that their results are identical.
+    """
+    with open(path) as f:
+        strings = [modify_BirthDeath_str(line[:-2]) for line in f if line.strip()] # Same preprocessing as BirthHybrid
+
+    mismatches = sum(not nx.utils.graphs_equal(parse_rich_newick(string), parse_rich_newick_recursive(string)) for string in strings)
+    recursive_time = time_parser(parse_rich_newick_recursive, strings, repeats)
+    iterative_time = time_parser(parse_rich_newick, strings, repeats)
+
+    print(f'{path}: {len(strings)} networks, {sum(len(x) for x in strings)} characters, {mismatches} mismatching results')
+    print(f'    recursive: {recursive_time * 1000:.1f} ms')
+    print(f'    iterative: {iterative_time * 1000:.1f} ms ({recursive_time / iterative_time:.1f}x)')
+
+def benchmark_depth(depths=(10, 100, 500, 900, 5000, 50000), repeats=3):
+    """
+    Compares the two parsers on caterpillar trees of increasing nesting depth.
+    """
+    print("Caterpillar trees:")
+    for depth in depths:
+        string = caterpillar_string(depth)
+        iterative_time = time_parser(parse_rich_newick, [string], repeats)
+        if depth < sys.getrecursionlimit():
+            recursive_time = f'{time_parser(parse_rich_newick_recursive, [string], repeats) * 1000:.1f} ms'
+        else: # The recursive parser would raise a RecursionError (after doing most of its quadratic work)
+            recursive_time = "exceeds recursion limit"
+        print(f'    depth {depth}: recursive {recursive_time}, iterative {iterative_time * 1000:.1f} ms')
+
+if __name__ == "__main__":
+    # Usage: python benchmark_parse_rich_newick.py [tree file]
+    benchmark_file(sys.argv[1] if len(sys.argv) > 1 else "netsim/popped0.trees")
+    benchmark_depth()
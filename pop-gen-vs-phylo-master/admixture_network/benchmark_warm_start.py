@@ -0,0 +1,61 @@
+import os
+import sys
+import time
+from run_PhyloNet import run_PhyloNet_streaming, network_candidates_from_lines
+from run_TreeMix import run_TreeMix
+from write_PhyloNet_input import add_start_network, write_input
+
+def likelihood_trace(file, phylonet_prefix="PhyloNet_3.8.2.jar"):
+    """
+    Runs PhyloNet on an input file and returns a list of (seconds, best likelihood so far) pairs, one for each candidate network it reports.
+    """
+    lines = []
+    trace = []
+    start = time.perf_counter()
+
+    def on_line(line):
+        lines.append(line)
+        if len(lines) > 1 and lines[-2].startswith("Likelihood : Topology : Full network string"):
+            likelihood = network_candidates_from_lines(lines[-2:])[0][0]
+            if likelihood is not None:
+                best = max(likelihood, trace[-1][1]) if len(trace) > 0 else likelihood
+                trace.append((time.perf_counter() - start, best))
+        return False
+
+    run_PhyloNet_streaming(file, on_line, phylonet_prefix=phylonet_prefix)
+    return trace
+
+def time_to_likelihood(trace, target):
+    """
+    Returns the first time at which a likelihood trace reaches the target, or None if it never does.
+    """
+    return next((seconds for seconds, likelihood in trace if likelihood >= target), None)
+
+def benchmark_warm_start(phylonet_input, treemix_input, admixture_count=1, tolerance=1.0, phylonet_prefix="PhyloNet_3.8.2.jar", treemix_prefix="treemix"):
+    """
+    Runs a PhyloNet input from scratch and again starting from the TreeMix network for the same data, and compares how long each run takes to
+    come within tolerance log-likelihood units of the best likelihood that either run found.
+    """
+    stem = os.path.splitext(phylonet_input)[0]
+    start = time.perf_counter()
+    start_network = run_TreeMix(treemix_input, admixture_count, output=f'{stem}.treemix', treemix_prefix=treemix_prefix)
+    treemix_time = time.perf_counter() - start
+    with open(phylonet_input) as f:
+        write_input(add_start_network(f.read(), start_network), f'{stem}.warm.nex')
+
+    cold = likelihood_trace(phylonet_input, phylonet_prefix)
+    warm = likelihood_trace(f'{stem}.warm.nex', phylonet_prefix)
+    if len(cold) == 0 or len(warm) == 0:
+        print("PhyloNet reported no likelihoods")
+        return
+
+    target = max(cold[-1][1], warm[-1][1]) - tolerance
+    cold_time = time_to_likelihood(cold, target)
+    warm_time = time_to_likelihood(warm, target)
+    print(f'{phylonet_input}: target log likelihood {target:.2f}')
+    print(f'    cold start: reached in {f"{cold_time:.1f} s" if cold_time is not None else "never"} (final {cold[-1][1]:.2f}, total {cold[-1][0]:.1f} s)')
+    print(f'    warm start: reached in {f"{warm_time:.1f} s" if warm_time is not None else "never"} + {treemix_time:.1f} s for TreeMix (final {warm[-1][1]:.2f}, total {warm[-1][0]:.1f} s)')
+
+if __name__ == "__main__":
+    # Usage: python benchmark_warm_start.py <PhyloNet input> <TreeMix input> [admixture count] [PhyloNet jar] [TreeMix executable]
+    benchmark_warm_start(sys.argv[1], sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else 1, phylonet_prefix=sys.argv[4] if len(sys.argv) > 4 else "PhyloNet_3.8.2.jar", treemix_prefix=sys.argv[5] if len(sys.argv) > 5 else "treemix")
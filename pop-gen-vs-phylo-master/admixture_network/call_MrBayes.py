@@ -1,5 +1,8 @@
+import io
 import os
 import re
+import subprocess
+from tool_threads import tool_pool
 
 def build_MrBayes_input(nexus, loci, taxon_map, generations=1000000, chains=1):
     """
@@ -51,30 +54,27 @@ def build_MrBayes_input(nexus, loci, taxon_map, generations=1000000, chains=1):
 
     return input_str
 
+# A taxon in a tree string: a name right after an opening parenthesis or a comma
+TAXON_PATTERN = re.compile(r'(?<=[(,])([^(),:;\[\]\s]+)')
+
+# The cumulative posterior probability in a .trprobs tree line, e.g. "tree tree_1 [p = 0.432, P = 0.432] = [&W 0.432] ((1,2),3);"
+CUMULATIVE_PROBABILITY_PATTERN = re.compile(r'\bP\s*=\s*([0-9.]+(?:[Ee][-+]?[0-9]+)?)')
+
 def substitute_individual_names(string, map):
     """
-    Substitutes individual names into a tree string.
+    Substitutes individual names into a tree string, in a single pass over the string. Only names in taxon position (after a parenthesis
+    or comma) are replaced, so branch lengths and internal labels are left alone.
     """
-    for key, value in map.items():
-        # Only replaces numbers that are in between parentheses or commas
-        string = re.sub(f'[(),]{key}[(),]', lambda match: match.group()[0] + value + match.group()[-1], string)
-    return string
+    return TAXON_PATTERN.sub(lambda match: map.get(match.group(1), match.group(1)), string)
 
-def run_MrBayes(file, mrbayes_prefix="mb", max_per_locus=float('inf')):
+def run_MrBayes(file, mrbayes_prefix="mb", max_per_locus=float('inf'), credible_set=None):
     """
     Runs MrBayes on an input file, and returns a string corresponding to the NEXUS file representation of the trees that it produces, as well as a string
-    corresponding to the loci that the different trees represent.
+    corresponding to the loci that the different trees represent. max_per_locus and credible_set limit the trees kept per locus (see write_trprobs_trees).
     """
     # Call MrBayes
     os.system(f'{mrbayes_prefix} {file}')
 
-    tree_lines_string = (
-        '#NEXUS\n'
-        'BEGIN TREES;\n'
-    )
-
-    loci_spec_list = []
-
     # Find parent directory path
     directory = os.path.dirname(file)
 
@@ -82,10 +82,33 @@ def run_MrBayes(file, mrbayes_prefix="mb", max_per_locus=float('inf')):
     treefiles = [filename for filename in os.listdir(directory) if filename.endswith(".trprobs")] # This would have to be altered to not return the final file if the aformentioned bug in MrBayes is ever fixed
     treefiles.sort(key=lambda filename: int("".join(char for char in filename if char.isdigit())))
 
+    return read_trprobs([f'{directory}/{treefile_name}' for treefile_name in treefiles], max_per_locus, credible_set)
+
+def read_trprobs(paths, max_per_locus=float('inf'), credible_set=None):
+    """
+    Reads MrBayes .trprobs files, one per locus and in locus order, into a string corresponding to the NEXUS file representation of their
+    trees and a string corresponding to the loci that the different trees represent (as returned by run_MrBayes). See write_trprobs_trees.
+    """
+    out = io.StringIO()
+    loci_spec_string = write_trprobs_trees(paths, out, max_per_locus, credible_set)
+    return out.getvalue(), loci_spec_string
+
+def write_trprobs_trees(paths, out, max_per_locus=float('inf'), credible_set=None):
+    """
+    Streams the trees of MrBayes .trprobs files, one per locus and in locus order, to the file handle out as a NEXUS TREES block, and returns
+    the string corresponding to the loci that the different trees represent. Each locus keeps at most max_per_locus trees, and, if
+    credible_set is given (e.g. 0.95), only its most probable trees up to and including the one whose cumulative probability reaches it.
+    """
+    out.write(
+        '#NEXUS\n'
+        'BEGIN TREES;\n'
+    )
+
+    loci_spec_list = []
+
     # Iterate through files, reading in trees
     overall_counter = 0 # Counts the number of trees read overall
-    for treefile_name in treefiles:
-        path = f'{directory}/{treefile_name}'
+    for path in paths:
         with open(path, "r") as treefile:
             substitution_map = {}
             locus_counter = 0 # Counts the number of trees read for this locus
@@ -101,16 +124,83 @@ def run_MrBayes(file, mrbayes_prefix="mb", max_per_locus=float('inf')):
                     tree_data = line.split()[-3:]
                     tree_data[2] = substitute_individual_names(tree_data[2], substitution_map)
                     tree_string = " ".join(tree_data)
-                    tree_lines_string += f'Tree gt{overall_counter} = {tree_string}\n'
+                    out.write(f'Tree gt{overall_counter} = {tree_string}\n')
                     overall_counter += 1
                     locus_counter += 1
+                    cumulative = CUMULATIVE_PROBABILITY_PATTERN.search(line)
+                    if credible_set is not None and cumulative is not None and float(cumulative.group(1)) >= credible_set:
+                        break
                 if locus_counter >= max_per_locus:
                     break
             loci_stop = overall_counter - 1
             loci_spec_list.append(f'{{gt{loci_start}-gt{loci_stop}}}')
-    
-    tree_lines_string += 'END;\n'
 
-    loci_spec_string = f'({", ".join(loci_spec_list)})'
+    out.write('END;\n')
+
+    return f'({", ".join(loci_spec_list)})'
 
-    return tree_lines_string, loci_spec_string
\ No newline at end of file
+def split_alignment_nexus(nexus):
+    """
+    Splits the result of build_alignment_nexus into its loci. Returns a list of (locus name, rows) pairs, where rows is a list of
+    (taxon, sequence) pairs.
+    """
+    loci = []
+    for line in nexus.splitlines():
+        if line.startswith("[") and line.endswith("]"):
+            loci.append((line[1:-1].split(", ")[0], []))
+        elif len(loci) > 0 and len(line.split()) == 2:
+            loci[-1][1].append(tuple(line.split()))
+    return loci
+
+def build_MrBayes_locus_input(rows, generations=1000000, chains=1, seed=12345):
+    """
+    Returns a multiline string representing a MrBayes input that infers the gene tree of a single locus (rows as returned by
+    split_alignment_nexus) under a strict clock, so that its trees are rooted like those of the multispecies coalescent run.
+    """
+    input_str = (
+        f'#NEXUS\n'
+        f'Begin data;\n'
+        f'Dimensions ntax={len(rows)} nchar={len(rows[0][1])};\n'
+        f'Format datatype=dna missing=? gap=-;\n'
+        f'Matrix\n'
+    )
+    input_str += "".join(f'{taxon} {sequence}\n' for taxon, sequence in rows)
+    input_str += ";End;\n"
+
+    input_str += (
+        f'Begin mrbayes;\n'
+        f'set autoclose=yes nowarn=yes seed={seed} swapseed={seed};\n'
+        f'lset nst=2 rates=gamma;\n'
+        f'prset brlenspr = clock:uniform;\n'
+        f'mcmc ngen={generations} nchains={chains};\n'
+        f'sumt;\n'
+        f'End;\n'
+    )
+
+    return input_str
+
+def run_MrBayes_per_locus(nexus, directory, mrbayes_prefix="mb", generations=1000000, chains=1, loci_per_job=1, max_per_locus=float('inf'), credible_set=None, seed=12345, max_workers=None):
+    """
+    Alternative to build_MrBayes_input and run_MrBayes: given the result of build_alignment_nexus, infers each locus's gene trees in its own
+    small MrBayes run instead of one partitioned run. Loci are grouped into jobs of loci_per_job, each running in its own directory
+    {directory}/job{j}, and the jobs run concurrently (at most max_workers at a time, by default one per core). Locus i uses the seed seed + i.
+    Returns the same (tree_lines_string, loci_spec_string) pair as run_MrBayes, with the loci in their original order.
+    """
+    loci = split_alignment_nexus(nexus)
+    jobs = [list(range(start, min(start + loci_per_job, len(loci)))) for start in range(0, len(loci), loci_per_job)]
+    command = [os.path.abspath(word) if os.path.isfile(word) else word for word in mrbayes_prefix.split()] # The jobs run in their own directories
+
+    def run(j):
+        job_directory = f'{directory}/job{j}'
+        os.makedirs(job_directory, exist_ok=True)
+        with open(f'{job_directory}/log.txt', "w") as log:
+            for i in jobs[j]:
+                with open(f'{job_directory}/{loci[i][0]}.nex', "w") as f:
+                    f.write(build_MrBayes_locus_input(loci[i][1], generations, chains, seed + i))
+                subprocess.run(command + [f'{loci[i][0]}.nex'], cwd=job_directory, stdout=log, stderr=subprocess.STDOUT)
+        return [f'{job_directory}/{loci[i][0]}.nex.trprobs' for i in jobs[j]]
+
+    with tool_pool(len(jobs), max_workers) as executor:
+        paths = [path for job_paths in executor.map(run, range(len(jobs))) for path in job_paths]
+
+    return read_trprobs(paths, max_per_locus, credible_set)
@@ -1,6 +1,18 @@
 import os
+import signal
+import subprocess
+from contextlib import closing
 import networkx as nx
 from admixture_network import generate_admixture_networks
+from runtime_history import record_runtime, wait_measured
+
+def ms_command_features(cmd):
+    """
+    Returns the sample size, locus count, mutation and recombination rates, locus length, and population count of an ms command (as written
+    by generate_ms_command), as features for the runtime history.
+    """
+    words = cmd.split()
+    return {"samples": int(words[1]), "loci": int(words[2]), "mutation": float(words[4]), "recombination": float(words[6]), "locus_length": int(words[7]), "pop_count": int(words[9])}
 
 def call_ms(cmd, trees=False):
     """
@@ -11,8 +23,11 @@ def call_ms(cmd, trees=False):
     alleles_per_pop = int(cmd.split()[1]) // pop_count
 
     # Run ms (with an additional argument requesting gene trees added if necessary), and store its result (excluding the first two lines)
-    stream = os.popen(cmd + (" -T" if trees else ""))
-    output_lines = list([x.strip() for x in stream.readlines()])[3:]
+    with record_runtime("ms", ms_command_features(cmd)) as measured:
+        process = subprocess.Popen(cmd + (" -T" if trees else ""), shell=True, stdout=subprocess.PIPE, text=True)
+        output_lines = list([x.strip() for x in process.stdout.readlines()])[3:]
+        process.stdout.close()
+        measured["peak_rss_mb"] = wait_measured(process)
 
     # Seperate out gene trees if necessary
     if trees:
@@ -51,6 +66,83 @@ def call_ms(cmd, trees=False):
     else:
         return tuple(output)
 
+def iter_ms(cmd):
+    """
+    Runs ms with a command, and yields its loci one at a time as ms prints them, in the same format as the elements of call_ms's result.
+    Only the locus being read is held in memory, so this suits writers that consume loci in a single pass (see fan_out.py).
+    A locus without segregating sites has an empty haplotype for every sample. The run is recorded in the runtime history if ms finishes.
+    """
+    # Extract relevant parameters from command
+    pop_count = int(cmd.split()[9]) # Includes the outgroup
+    alleles_per_pop = int(cmd.split()[1]) // pop_count
+
+    def make_locus(positions, haplotypes):
+        if len(haplotypes) == 0: # ms prints no haplotypes for a locus with "segsites: 0"
+            haplotypes = [""] * (pop_count * alleles_per_pop)
+        return positions, tuple(tuple(haplotypes[j:j+alleles_per_pop]) for j in range(0, len(haplotypes), alleles_per_pop))
+
+    with record_runtime("ms", ms_command_features(cmd)) as measured, subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, text=True, start_new_session=True) as process:
+        try:
+            positions, haplotypes = None, None
+            for line in process.stdout:
+                line = line.strip()
+                if line == "//": # Start of the next locus
+                    if haplotypes is not None:
+                        yield make_locus(positions, haplotypes)
+                    positions, haplotypes = (), []
+                elif haplotypes is None or line == "" or line.startswith(("[", "(", "segsites")):
+                    continue
+                elif line.startswith("positions:"):
+                    positions = tuple([float(x) for x in line.split()[1:]])
+                else:
+                    haplotypes.append(line)
+            if haplotypes is not None:
+                yield make_locus(positions, haplotypes)
+        finally:
+            # If ms is still running, the consumer stopped early, so stop ms rather than let it simulate loci nobody reads. WNOWAIT leaves an
+            # exited ms unreaped, so that wait_measured can still reap it
+            if os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is None:
+                os.killpg(process.pid, signal.SIGKILL) # ms runs under a shell, so kill its whole process group
+            measured["peak_rss_mb"] = wait_measured(process)
+    return
+
+def truncate_locus(locus, snps):
+    """
+    Keeps the first snps segregating sites of a locus (in the format of call_ms).
+    """
+    return locus[0][:snps], tuple(tuple(haplotype[:snps] for haplotype in population) for population in locus[1])
+
+def iter_ms_target(cmd, target_snps=None, snps_per_locus=None, effective=None):
+    """
+    Streams loci from ms like iter_ms, but stops ms once target_snps segregating sites have been yielded in total (the last locus is cut
+    short so that the total is exact), so the command's locus count is only an upper bound. With snps_per_locus, each locus is also cut to
+    its first snps_per_locus sites. If effective is a dictionary, it is filled with the parameters of the data actually produced: the loci
+    and sites yielded, the simulated sequence length that they cover (a locus cut short covers the stretch up to its first dropped site),
+    and the mutation and recombination rates per base, so that datasets simulated this way can be compared.
+    """
+    features = ms_command_features(cmd)
+    effective = effective if effective is not None else {}
+    effective.update({"loci": 0, "snps": 0, "sequence_length": 0.0, "mutation_per_base": features["mutation"] / features["locus_length"], "recombination_per_base": features["recombination"] / features["locus_length"], "stopped_early": False})
+
+    with closing(iter_ms(cmd)) as loci: # Closing the stream early stops ms
+        for locus in loci:
+            keep = len(locus[0])
+            if snps_per_locus is not None:
+                keep = min(keep, snps_per_locus)
+            if target_snps is not None:
+                keep = min(keep, target_snps - effective["snps"])
+            covered = locus[0][keep] if keep < len(locus[0]) else 1.0
+
+            effective["loci"] += 1
+            effective["snps"] += keep
+            effective["sequence_length"] += covered * features["locus_length"]
+            yield truncate_locus(locus, keep) if keep < len(locus[0]) else locus
+
+            if target_snps is not None and effective["snps"] >= target_snps:
+                effective["stopped_early"] = effective["loci"] < features["loci"]
+                break
+    return
+
 if __name__ == "__main__":
     test_results = generate_admixture_networks(4, 1, 0.02, 0.3, 0.5, 4, 2, 50, 50, 500000, True, 1)
 
@@ -1,31 +1,23 @@
-import re
 import os
 import time
-from write_rich_newick import write_rich_newick
+import tempfile
+from write_rich_newick import write_networks_block
+from tool_cache import cached_run, cache_key
+from runtime_history import record_runtime
+from jvm_admission import run_java_prefix
 
-def strip_edge_data(network_string):
-    """
-    Strips out the edge data from a Rich Newick string, leaving just the network topology remaining.
-    """
-    return re.sub(r':[:.0-9Ee-]+', '', network_string)
-
-# print(strip_edge_data("(1:0.054091306690912076,(((2:0.03644309641657073,(5:0.03079916221791329,(6:0.003999897752669873)I14#H14:0.026799264465243416::0.2555694689261563)I7:0.005643934198657441)I5:0.006323279507830765,(4:0.031166933924481208,3:0.031166933924481208)I11:0.011599441999920287)I4:9.03E-3,I14#H14:0.04778727413298191::0.7444305310738437)I3:0.0023041348052602953)I1;"))
-
-def compare_networks(network1, network2, method="luay", phylonet_prefix="java -jar PhyloNet_3.8.2.jar"):
+def compare_networks(network1, network2, method="luay", phylonet_prefix="java -jar PhyloNet_3.8.2.jar", cache=None):
     """
     Computes the distance between two phylogenetic networks, based on their topologies, using PhyloNet.
+    If cache is a directory, distances between identical topologies are served from the tool cache instead (see tool_cache.py).
+    PhyloNet runs under admission control (see jvm_admission.py).
     """
     # Validate method string
     if method not in ["tree", "tri", "cluster", "luay"]:
         return None
 
-    # Convert NetworkX DiGraphs to Rich Newick strings
-    network1_string = write_rich_newick(network1)
-    network2_string = write_rich_newick(network2)
-
-    # Strip edge data from Rich Newick strings
-    network1_string = strip_edge_data(network1_string)
-    network2_string = strip_edge_data(network2_string)
+    # Convert NetworkX DiGraphs to a NETWORKS block of Rich Newick strings, without edge data (only the topologies are compared)
+    networks_block = write_networks_block([network1, network2], edge_data=False)
 
     # network1_string = "((a,(b,(c)x#1)),((d,x#1),e));"
     # network2_string = "((((a, (c)x#1), d), (b, x)), e);"
@@ -33,27 +25,27 @@ def compare_networks(network1, network2, method="luay", phylonet_prefix="java -j
     # Build PhyloNet input
     input_str = (
         f'#NEXUS\n'
-        f'BEGIN NETWORKS;\n'
-        f'Network net1 = {network1_string}\n'
-        f'Network net2 = {network2_string}\n'
-        f'END;\n'
+        f'{networks_block}'
         f'BEGIN PHYLONET;\n'
         f'Cmpnets net1 net2 -m {method};\n'
         f'END;\n'
     )
 
-    # Write PhyloNet input to file
-    with open("compare.nex", "w") as f:
-        f.write(input_str)
-
-    # Call PhyloNet, and extract the result
-    stream = os.popen(f'{phylonet_prefix} compare.nex')
-    for line in stream:
-        line = line.strip()
-        if line.startswith("The"):
-            result = tuple(float(x) for x in line.split(":")[1].split())
-    
-    # Clean up input file
-    os.remove("compare.nex")
-    
-    return result if len(result) > 1 else result[0]
+    def run():
+        # Write PhyloNet input to a directory of its own (removed afterwards), so that concurrent comparisons never share files
+        with tempfile.TemporaryDirectory() as directory:
+            with open(f'{directory}/compare.nex', "w") as f:
+                f.write(input_str)
+
+            # Call PhyloNet, and extract the result
+            with record_runtime("compare", {"nodes": max(len(network1), len(network2))}):
+                run_java_prefix("compare", phylonet_prefix, [os.path.abspath(f'{directory}/compare.nex')], {"taxa": max(len(network1), len(network2))}, output=os.path.abspath(f'{directory}/compare.out'))
+            with open(f'{directory}/compare.out') as f:
+                for line in f:
+                    line = line.strip()
+                    if line.startswith("The"):
+                        result = tuple(float(x) for x in line.split(":")[1].split())
+
+        return result if len(result) > 1 else result[0]
+
+    return cached_run(cache, "compare", lambda: cache_key("compare", [phylonet_prefix], [method], input_data=[input_str]), run, {})
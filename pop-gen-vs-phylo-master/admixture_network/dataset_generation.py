@@ -0,0 +1,122 @@
+import os
+import json
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, wait, as_completed, FIRST_COMPLETED
+from call_ms import iter_ms_target
+from fan_out import fan_out
+from write_GTmix_input import GTmix_sink
+from write_TreeMix_input import TreeMix_sink
+from write_PhyloNet_input import write_input, bimarker_sink, build_MCMC_BiMarkers_input, build_MLE_BiMarkers_input
+
+# Simulates and writes the inputs of many networks in parallel, logged to {base}/datasets.jsonl so that an interrupted batch can be resumed
+
+INDEX_NAME = "datasets.jsonl"
+
+def index_path(base):
+    """
+    Returns the path of the dataset index that belongs to a data directory.
+    """
+    return f'{base}/{INDEX_NAME}'
+
+def read_index(base):
+    """
+    Reads the dataset index of a data directory, and returns a dictionary from network ids to their latest entries (empty if there is no index).
+    The batch marker (see planned_batch_size) is not a dataset, so it is left out.
+    """
+    index = {}
+    if os.path.exists(index_path(base)):
+        with open(index_path(base)) as f:
+            for line in f:
+                if line.strip() != "":
+                    entry = json.loads(line)
+                    if "id" in entry:
+                        index[entry["id"]] = entry
+    return index
+
+def planned_batch_size(base):
+    """
+    Returns the number of networks in the batch of a data directory, from the marker entry logged once every network of the batch was
+    generated and indexed, or None if there is no marker (no batch, or one whose planning was interrupted).
+    """
+    size = None
+    if os.path.exists(index_path(base)):
+        with open(index_path(base)) as f:
+            for line in f:
+                if line.strip() != "":
+                    entry = json.loads(line)
+                    if entry.get("batch") == "planned":
+                        size = entry["networks"]
+    return size
+
+def flagged_datasets(base):
+    """
+    Returns the set of network ids whose latest index entry was flagged by the f-statistics check (see f_statistics.py).
+    """
+    return {i for i, entry in read_index(base).items() if entry.get("f_statistics", {}).get("flagged", False)}
+
+def log_index(base, entry):
+    """
+    Appends an entry to the dataset index of a data directory.
+    """
+    with open(index_path(base), "a") as f:
+        f.write(json.dumps(entry, sort_keys=True) + "\n")
+    return
+
+def ms_seeds(seed, i):
+    """
+    Returns the three ms seeds for network i of a batch, derived from the batch's seed so that every dataset gets its own random stream.
+    ms keeps its state in unsigned shorts, so the seeds are between 1 and 65535.
+    """
+    return [int(x) % 65535 + 1 for x in np.random.SeedSequence([seed, i]).generate_state(3)]
+
+def seeded_command(cmd, seeds):
+    """
+    Adds a -seeds flag to an ms command.
+    """
+    return f'{cmd.rstrip()} -seeds {" ".join(str(x) for x in seeds)}'
+
+def write_dataset(base, i, cmd, max_reticulation, MCMC_threads=None, MLE_threads=None, target_snps=None, snps_per_locus=None):
+    """
+    Simulates the data of network i with its ms command and writes its GTmix, TreeMix, and PhyloNet inputs, in one pass over ms's output.
+    With target_snps or snps_per_locus, ms is stopped once the data has that many segregating sites (see iter_ms_target).
+    Runs in a worker process, and returns i and the effective parameters of the data.
+    """
+    effective = {}
+    results = fan_out(iter_ms_target(cmd, target_snps, snps_per_locus, effective), {
+        "gtmix": GTmix_sink(f'{base}/input/gtmix/{i}/'),
+        "treemix": TreeMix_sink(f'{base}/input/treemix/{i}.gz'),
+        "bimarkers": bimarker_sink(),
+    })
+
+    bimarker_nexus, bimarker_taxa, bimarker_taxon_map = results["bimarkers"]
+    write_input(build_MCMC_BiMarkers_input(bimarker_nexus, bimarker_taxa, bimarker_taxon_map, max_reticulation=max_reticulation, threads=MCMC_threads), f'{base}/input/phylonet_mcmc_bimarkers/{i}.nex')
+    write_input(build_MLE_BiMarkers_input(bimarker_nexus, bimarker_taxon_map, max_reticulation=max_reticulation, threads=MLE_threads), f'{base}/input/phylonet_mle_bimarkers/{i}.nex')
+    return i, effective
+
+def generate_datasets(base, max_reticulation, MCMC_threads=None, MLE_threads=None, max_workers=None, max_in_flight=None, target_snps=None, snps_per_locus=None):
+    """
+    Writes the datasets of every network in the index of a data directory that is not yet complete, using a pool of max_workers processes
+    (by default one per core) with at most max_in_flight datasets (by default twice max_workers) submitted at once.
+    Each finished dataset is logged as complete along with its effective parameters, and the ids written are returned in the order they finished.
+    """
+    pending = [entry for _, entry in sorted(read_index(base).items()) if entry["status"] != "complete"]
+    max_workers = max_workers if max_workers is not None else os.cpu_count()
+    max_in_flight = max_in_flight if max_in_flight is not None else 2 * max_workers
+
+    finished = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = {}
+        for entry in pending:
+            if len(in_flight) >= max_in_flight: # Wait for a dataset to finish before submitting another
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i, effective = future.result()
+                    finished.append(i)
+                    log_index(base, dict(in_flight.pop(future), status="complete", effective=effective))
+            future = executor.submit(write_dataset, base, entry["id"], entry["cmd"], max_reticulation, MCMC_threads, MLE_threads, target_snps, snps_per_locus)
+            in_flight[future] = entry
+        for future in as_completed(in_flight):
+            i, effective = future.result()
+            finished.append(i)
+            log_index(base, dict(in_flight[future], status="complete", effective=effective))
+    return finished
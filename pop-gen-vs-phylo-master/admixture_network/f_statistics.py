@@ -0,0 +1,254 @@
+import sys
+import gzip
+import itertools
+import numpy as np
+import networkx as nx
+from site_patterns import compress_data, pattern_allele_counts
+from network_archive import archive_path, open_archive, read_networks
+from dataset_generation import read_index, log_index
+
+# f2, f3, f4 and D for every population pair, triple, and quadruple, with block jackknife standard errors, and the signs a network predicts
+# for them (used to flag data that conflicts with its true network)
+
+Z_THRESHOLD = 3.0
+ZERO_TOLERANCE = 1e-6 # Predictions below this share of a table's largest prediction count as zero
+
+def pattern_weights(inverse, blocks, pattern_count):
+    """
+    Returns the blocks x patterns matrix of site counts, given the pattern and the block of every site. Blocks without sites are left out.
+    """
+    _, block_index = np.unique(blocks, return_inverse=True)
+    weights = np.zeros((block_index.max() + 1 if len(block_index) > 0 else 0, pattern_count))
+    np.add.at(weights, (block_index.reshape(-1), inverse), 1)
+    return weights
+
+def statistic_indices(pop_count):
+    """
+    Returns the population indices of every f2 (A, B), f3 (C; A, B), and f4/D (A, B; C, D) statistic. f4 has the three pairings of each
+    quadruple.
+    """
+    pairs = list(itertools.combinations(range(pop_count), 2))
+    triples = [(c, a, b) for c in range(pop_count) for a, b in pairs if c not in (a, b)]
+    quadruples = [pairing for w, x, y, z in itertools.combinations(range(pop_count), 4) for pairing in [(w, x, y, z), (w, y, x, z), (w, z, x, y)]]
+    return {"f2": np.array(pairs, dtype=int).reshape(-1, 2), "f3": np.array(triples, dtype=int).reshape(-1, 3), "f4": np.array(quadruples, dtype=int).reshape(-1, 4), "D": np.array(quadruples, dtype=int).reshape(-1, 4)}
+
+def block_jackknife(numerators, denominators):
+    """
+    Estimates ratios of sums (sum of numerators / sum of denominators, given as blocks x statistics matrices of block sums), with delete-one
+    block jackknife standard errors. Returns the estimates and standard errors.
+    """
+    block_count = numerators.shape[0]
+    total_numerators, total_denominators = numerators.sum(axis=0), denominators.sum(axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        estimates = total_numerators / total_denominators
+        leave_one_out = (total_numerators - numerators) / (total_denominators - denominators)
+    if block_count < 2:
+        return estimates, np.full_like(estimates, np.nan)
+    se = np.sqrt((block_count - 1) / block_count * ((leave_one_out - leave_one_out.mean(axis=0)) ** 2).sum(axis=0))
+    return estimates, se
+
+def f_statistics(counts, sizes, weights):
+    """
+    Computes every f2, f3, f4, and D statistic from a patterns x populations matrix of derived allele counts, the sample size of each
+    population, and a blocks x patterns matrix of site counts (see pattern_weights). Returns a dictionary from statistic names to tables:
+    dictionaries with the population indices ("pops"), estimates, standard errors, and Z scores of every statistic of that kind.
+    """
+    p = counts / np.asarray(sizes, dtype=float)
+    h = p * (1 - p) / (np.asarray(sizes, dtype=float) - 1) # Unbiased estimate of each frequency's sampling variance
+    indices = statistic_indices(counts.shape[1])
+    sites = weights.sum(axis=1)[:, np.newaxis]
+
+    a, b = indices["f2"].T
+    c3, a3, b3 = indices["f3"].T
+    w, x, y, z = indices["f4"].T
+    numerators = {
+        "f2": (p[:, a] - p[:, b]) ** 2 - h[:, a] - h[:, b],
+        "f3": (p[:, c3] - p[:, a3]) * (p[:, c3] - p[:, b3]) - h[:, c3],
+        "f4": (p[:, w] - p[:, x]) * (p[:, y] - p[:, z]),
+    }
+    numerators["D"] = numerators["f4"]
+    D_denominators = (p[:, w] + p[:, x] - 2 * p[:, w] * p[:, x]) * (p[:, y] + p[:, z] - 2 * p[:, y] * p[:, z])
+
+    tables = {}
+    for name, numerator in numerators.items():
+        block_numerators = weights @ numerator
+        block_denominators = weights @ D_denominators if name == "D" else np.broadcast_to(sites, block_numerators.shape)
+        estimates, se = block_jackknife(block_numerators, block_denominators)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            tables[name] = {"pops": indices[name], "estimate": estimates, "se": se, "z": estimates / se}
+    return tables
+
+def data_f_statistics(data, loci_per_block=1):
+    """
+    Computes the f-statistics of a dataset in the format of call_ms, with blocks of loci_per_block consecutive loci.
+    """
+    compressed = compress_data(data)
+    weights = pattern_weights(compressed["inverse"], compressed["loci"] // loci_per_block, len(compressed["patterns"]))
+    return f_statistics(pattern_allele_counts(compressed), compressed["pop_sizes"], weights)
+
+def read_TreeMix_counts(path):
+    """
+    Reads a TreeMix input file into a sites x populations matrix of derived ("first") allele counts and the sample size of each population.
+    """
+    with gzip.open(path, "rt") as f:
+        f.readline() # Population names
+        rows = [[[int(x) for x in pair.split(",")] for pair in line.split()] for line in f if line.strip() != ""]
+    rows = np.array(rows, dtype=int).reshape(len(rows), -1, 2)
+    return rows[:, :, 0], rows[0].sum(axis=1) if len(rows) > 0 else np.zeros(0, dtype=int)
+
+def TreeMix_f_statistics(path, block_size=500):
+    """
+    Computes the f-statistics of a TreeMix input file, with blocks of block_size consecutive SNPs (as in TreeMix's -k).
+    """
+    counts, sizes = read_TreeMix_counts(path)
+    patterns, inverse = np.unique(counts, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    return f_statistics(patterns, sizes, pattern_weights(inverse, np.arange(len(inverse)) // block_size, len(patterns)))
+
+def drift_coefficients(network, pop_count, major_only=False):
+    """
+    Returns the lengths of a network's edges and the edges x populations matrix of the probabilities that each population's lineage passes
+    through each edge, or None if some population has no leaf. Populations are matched to leaves by their "population" attribute, so
+    population i (counting from 0, in the order of the data) is the leaf labeled i + 1. An admixture node's mix_parent edge is taken with
+    its proportion (or 0.5 if the network has none), and with major_only, only the more likely parent edge is kept (the network's major tree).
+    """
+    edges = list(network.edges)
+    edge_index = {edge: i for i, edge in enumerate(edges)}
+    lengths = np.ones(len(edges))
+    for i, (u, v) in enumerate(edges):
+        if network.nodes[u].get("time") is not None and network.nodes[v].get("time") is not None:
+            lengths[i] = abs(network.nodes[u]["time"] - network.nodes[v]["time"])
+        elif network.edges[u, v].get("length") is not None:
+            lengths[i] = network.edges[u, v]["length"]
+
+    def parent_weight(u, v):
+        parents = list(network.predecessors(v))
+        if len(parents) < 2:
+            return 1.0
+        proportion = network.nodes[v].get("proportion")
+        proportion = 0.5 if proportion is None else proportion
+        weight = proportion if network.nodes[v].get("mix_parent", parents[0]) == u else 1 - proportion
+        if major_only:
+            return 1.0 if weight > 0.5 or (weight == 0.5 and u == parents[0]) else 0.0
+        return weight
+
+    leaves = {}
+    for node in network.nodes:
+        if network.out_degree(node) == 0:
+            try:
+                leaves[int(str(network.nodes[node].get("population")))] = node
+            except ValueError:
+                continue
+    if any(pop + 1 not in leaves for pop in range(pop_count)):
+        return None
+
+    order = list(reversed(list(nx.topological_sort(network)))) # Children before parents
+    coefficients = np.zeros((len(edges), pop_count))
+    for pop in range(pop_count):
+        probability = {leaves[pop + 1]: 1.0}
+        for v in order:
+            if probability.get(v, 0) == 0:
+                continue
+            for u in network.predecessors(v):
+                share = probability[v] * parent_weight(u, v)
+                coefficients[edge_index[u, v], pop] = share
+                probability[u] = probability.get(u, 0) + share
+    return lengths, coefficients
+
+def network_f_statistics(network, pop_count, major_only=False):
+    """
+    Returns a network's predicted f2, f3, and f4 statistics, as a dictionary from statistic names to arrays in the order of statistic_indices
+    (D is predicted through f4, whose sign it shares). Returns None if the network does not have every population.
+    """
+    drift = drift_coefficients(network, pop_count, major_only)
+    if drift is None:
+        return None
+    lengths, c = drift
+    indices = statistic_indices(pop_count)
+    a, b = indices["f2"].T
+    c3, a3, b3 = indices["f3"].T
+    w, x, y, z = indices["f4"].T
+    return {
+        "f2": lengths @ ((c[:, a] - c[:, b]) ** 2),
+        "f3": lengths @ ((c[:, c3] - c[:, a3]) * (c[:, c3] - c[:, b3])),
+        "f4": lengths @ ((c[:, w] - c[:, x]) * (c[:, y] - c[:, z])),
+    }
+
+def prediction_signs(predicted):
+    """
+    Returns the signs of predictions, with predictions below ZERO_TOLERANCE of the largest one counted as zero.
+    """
+    scale = np.abs(predicted).max() if len(predicted) > 0 else 0
+    return np.where(np.abs(predicted) <= ZERO_TOLERANCE * scale, 0, np.sign(predicted))
+
+def check_network(tables, network, z_threshold=Z_THRESHOLD):
+    """
+    Checks a network against the f3 and f4 statistics of its data. Returns the number of statistics that are significant in the data, the
+    number of those that the network contradicts (predicting zero or the opposite sign), and the contradicted statistics' populations.
+    Returns None if the network does not have every population.
+    """
+    predicted = network_f_statistics(network, tables["f2"]["pops"].max() + 1 if len(tables["f2"]["pops"]) > 0 else 0)
+    if predicted is None:
+        return None
+    report = {"significant": 0, "conflicts": 0, "conflicting": []}
+    for name in ["f3", "f4"]:
+        significant = np.abs(np.nan_to_num(tables[name]["z"])) > z_threshold
+        conflicts = significant & (prediction_signs(predicted[name]) != np.sign(tables[name]["estimate"]))
+        report["significant"] += int(significant.sum())
+        report["conflicts"] += int(conflicts.sum())
+        report["conflicting"] += [f'{name}({",".join(str(pop + 1) for pop in pops)})' for pops in tables[name]["pops"][conflicts]]
+    return report
+
+def admixture_signal(tables, network, z_threshold=Z_THRESHOLD):
+    """
+    Returns the number of f4 statistics that a network's admixture makes nonzero (zero in its major tree, nonzero in the network), and how
+    many of those are significant in the data. Returns None if the network does not have every population.
+    """
+    pop_count = tables["f2"]["pops"].max() + 1 if len(tables["f2"]["pops"]) > 0 else 0
+    predicted, major = network_f_statistics(network, pop_count), network_f_statistics(network, pop_count, major_only=True)
+    if predicted is None:
+        return None
+    informative = (prediction_signs(major["f4"]) == 0) & (prediction_signs(predicted["f4"]) != 0)
+    return int(informative.sum()), int((informative & (np.abs(np.nan_to_num(tables["f4"]["z"])) > z_threshold)).sum())
+
+def check_dataset(tables, true_network, inferred_networks=None, max_conflict_fraction=0.05, z_threshold=Z_THRESHOLD):
+    """
+    Checks a dataset's f-statistics against its true network (and, optionally, a dictionary from methods to inferred networks), and returns
+    a summary. The dataset is flagged if the true network contradicts more than max_conflict_fraction of the significant statistics, or
+    if the true network's admixture changes some f4 statistics but none of them is significant (so no method could be expected to find it).
+    """
+    true_report = check_network(tables, true_network, z_threshold)
+    signal = admixture_signal(tables, true_network, z_threshold)
+    summary = {"true": true_report, "admixture_signal": signal, "inferred": {}}
+    if inferred_networks is not None:
+        summary["inferred"] = {method: check_network(tables, network, z_threshold) for method, network in inferred_networks.items()}
+
+    reasons = []
+    if true_report is not None and true_report["conflicts"] > max_conflict_fraction * max(true_report["significant"], 1):
+        reasons.append("true network conflicts with the data")
+    if signal is not None and signal[0] > 0 and signal[1] == 0:
+        reasons.append("admixture leaves no significant f4 signal")
+    summary["flagged"] = len(reasons) > 0
+    summary["reasons"] = reasons
+    return summary
+
+if __name__ == "__main__":
+    # Usage: python f_statistics.py <base> [block size]
+    # Checks every dataset of a data directory (from its TreeMix input) against its true network and any networks already inferred for it,
+    # and records the summary, including whether the dataset is flagged, in the dataset index.
+    base = sys.argv[1]
+    block_size = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    archive = open_archive(archive_path(base))
+    true_networks = {run_id: network for run_id, _, network in read_networks(archive, "true")}
+    inferred = {}
+    for method in ["gtmix", "treemix", "phylonet_mcmc_bimarkers", "phylonet_mle_bimarkers"]:
+        for run_id, _, network in read_networks(archive, method):
+            inferred.setdefault(run_id, {}).setdefault(method, network)
+    archive.close()
+
+    for i, entry in sorted(read_index(base).items()):
+        if entry["status"] != "complete" or i not in true_networks:
+            continue
+        summary = check_dataset(TreeMix_f_statistics(f'{base}/input/treemix/{i}.gz', block_size), true_networks[i], inferred.get(i))
+        log_index(base, dict(entry, f_statistics=summary))
+        print(f'{i}: {"flagged (" + "; ".join(summary["reasons"]) + ")" if summary["flagged"] else "ok"}', " ".join(f'{method} {report["conflicts"]}/{report["significant"]} conflicts' for method, report in summary["inferred"].items() if report is not None))
@@ -0,0 +1,10 @@
+# Writes the inputs of several methods from one pass over the loci. A sink is a dictionary of an "add(locus_id, locus)" and a "close()" function
+
+def fan_out(loci, sinks):
+    """
+    Feeds every locus of an iterable to every sink in a dictionary of sinks, and returns a dictionary from the same names to the sinks' results.
+    """
+    for locus_id, locus in enumerate(loci):
+        for sink in sinks.values():
+            sink["add"](locus_id, locus)
+    return {name: sink["close"]() for name, sink in sinks.items()}
@@ -0,0 +1,196 @@
+import re
+import sys
+import numpy as np
+from parse_rich_newick2 import parse_rich_newick
+from call_MrBayes import substitute_individual_names
+
+# Keeps each locus's distinct rooted gene tree topologies once, with counts and weights. A topology is a parent array over a fixed taxon order,
+# with internal nodes numbered canonically in post-order, so equal topologies have equal arrays
+
+WEIGHT_PATTERN = re.compile(r'\[&W\s+([0-9.]+(?:[Ee][-+]?[0-9]+)?)\]')
+
+def new_store(taxa):
+    """
+    Returns an empty gene tree store over the given taxa (leaf names, as strings).
+    """
+    return {"taxa": list(taxa), "index": {taxon: i for i, taxon in enumerate(taxa)}, "loci": []}
+
+def canonical_parents(children, root, index):
+    """
+    Returns the canonical parent array of a tree, given its children lists (a dictionary from nodes to lists of children), its root, and a
+    dictionary from its leaves to their taxon indices. Internal nodes with a single child are suppressed.
+    """
+    n = len(index)
+    internal_children = [] # Children labels of each internal node, in numbering order
+    min_leaf = {}
+    labels = {}
+
+    # First pass: the smallest leaf below every node, iteratively in post-order
+    order = []
+    stack = [root]
+    while len(stack) > 0:
+        node = stack.pop()
+        order.append(node)
+        stack.extend(children.get(node, []))
+    for node in reversed(order):
+        min_leaf[node] = index[node] if node in index else min(min_leaf[child] for child in children[node])
+
+    # Second pass: number internal nodes in post-order with sorted children, collapsing unary nodes into their child
+    def resolve(node):
+        while node not in index and len(children[node]) == 1:
+            node = children[node][0]
+        return node
+
+    stack = [(resolve(root), False)]
+    while len(stack) > 0:
+        node, expanded = stack.pop()
+        if node in index:
+            labels[node] = index[node]
+        elif not expanded:
+            stack.append((node, True))
+            stack.extend((child, False) for child in sorted((resolve(child) for child in children[node]), key=lambda child: -min_leaf[child]))
+        else:
+            labels[node] = n + len(internal_children)
+            internal_children.append([labels[resolve(child)] for child in children[node]])
+
+    parents = np.full(n + len(internal_children), -1, dtype=np.int32)
+    for internal, node_children in enumerate(internal_children):
+        parents[node_children] = n + internal
+    return parents
+
+def tree_parents(store, tree_string):
+    """
+    Parses a Newick tree string into its canonical parent array over the store's taxa.
+    """
+    tree = parse_rich_newick(tree_string)
+    root = next(node for node in tree.nodes if tree.in_degree(node) == 0)
+    index = {node: store["index"][str(tree.nodes[node]["population"])] for node in tree.nodes if tree.out_degree(node) == 0}
+    return canonical_parents({node: list(tree.successors(node)) for node in tree.nodes}, root, index)
+
+def add_tree(store, locus, tree_string, weight=1.0):
+    """
+    Adds a tree to a locus of a store (extending the store to that locus if necessary), merging it with an equal topology already there.
+    """
+    while len(store["loci"]) <= locus:
+        store["loci"].append({})
+    parents = tree_parents(store, tree_string)
+    entry = store["loci"][locus].setdefault(parents.tobytes(), {"parents": parents, "count": 0, "weight": 0.0})
+    entry["count"] += 1
+    entry["weight"] += weight
+    return
+
+def add_ms_trees(store, tree_lines, locus_length):
+    """
+    Adds the gene trees printed by ms -T (tree_lines as returned by call_ms, with "[length]" prefixes under recombination) to a store, one
+    locus per locus_length sites (ms numbers its taxa 1 .. n, so the store's taxa should be "1" .. "n"). Each tree is weighted by the number
+    of sites it covers.
+    """
+    locus = len(store["loci"])
+    covered = 0
+    for line in tree_lines:
+        match = re.match(r'\[(\d+)\](.*)', line)
+        length, tree_string = (int(match.group(1)), match.group(2)) if match is not None else (locus_length, line)
+        add_tree(store, locus, tree_string, length)
+        covered += length
+        if covered >= locus_length:
+            locus += 1
+            covered = 0
+    return
+
+def add_RentPlus_trees(store, path, locus):
+    """
+    Adds the trees of a RentPlus .trees file (one tree per site, after its position) to a locus of a store, one count per site.
+    """
+    with open(path) as f:
+        for line in f:
+            tree_string = next((word for word in line.split() if word.startswith("(")), None)
+            if tree_string is not None:
+                add_tree(store, locus, tree_string)
+    return
+
+def add_trprobs(store, paths):
+    """
+    Adds the trees of MrBayes .trprobs files (one per locus, in locus order) to a store, weighted by their posterior probabilities.
+    """
+    for path in paths:
+        locus = len(store["loci"])
+        translation = {}
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if len(line) > 0 and line[0].isdigit():
+                    key, value = line.strip(",;").split()
+                    translation[key] = value
+                elif line.startswith("tree"):
+                    weight = WEIGHT_PATTERN.search(line)
+                    add_tree(store, locus, substitute_individual_names(line.split()[-1], translation), float(weight.group(1)) if weight is not None else 1.0)
+    return
+
+def parents_to_newick(parents, taxa):
+    """
+    Writes a parent array as a Newick topology string, with children in canonical order.
+    """
+    n = len(taxa)
+    children = [[] for _ in range(len(parents))]
+    for node, parent in enumerate(parents):
+        if parent >= 0:
+            children[parent].append(node)
+    root = int(np.flatnonzero(parents < 0)[0])
+
+    # Internal nodes are numbered in post-order, so every node's children come before it
+    strings = list(taxa) + [None] * (len(parents) - n)
+    for node in range(n, len(parents)):
+        strings[node] = f'({",".join(strings[child] for child in children[node])})'
+    return strings[root] + ";"
+
+def write_weighted_trees_block(store, out):
+    """
+    Writes the distinct trees of a store to the file handle out as a PhyloNet TREES block, each tree once with a "[&W w]" weight equal to its
+    share of its locus's total weight, and returns the string corresponding to the loci that the trees represent (like run_MrBayes).
+    """
+    out.write(
+        '#NEXUS\n'
+        'BEGIN TREES;\n'
+    )
+    loci_spec_list = []
+    counter = 0
+    for locus in store["loci"]:
+        if len(locus) == 0:
+            continue
+        total = sum(entry["weight"] for entry in locus.values())
+        start = counter
+        for entry in sorted(locus.values(), key=lambda entry: -entry["weight"]):
+            out.write(f'Tree gt{counter} = [&W {entry["weight"] / total:.6g}] {parents_to_newick(entry["parents"], store["taxa"])}\n')
+            counter += 1
+        loci_spec_list.append(f'{{gt{start}-gt{counter - 1}}}')
+    out.write('END;\n')
+    return f'({", ".join(loci_spec_list)})'
+
+def write_expanded_trees(store, out, loci=None):
+    """
+    Writes the trees of a store (or of the given loci) to the file handle out one per line, each distinct tree repeated as many times as it
+    was added, for tools like GTmix that take unweighted tree lists.
+    """
+    for locus in (store["loci"] if loci is None else [store["loci"][i] for i in loci]):
+        for entry in sorted(locus.values(), key=lambda entry: -entry["count"]):
+            out.write(f'{parents_to_newick(entry["parents"], store["taxa"])}\n' * entry["count"])
+    return
+
+def store_summary(store):
+    """
+    Returns the numbers of trees and of distinct trees in a store.
+    """
+    return sum(entry["count"] for locus in store["loci"] for entry in locus.values()), sum(len(locus) for locus in store["loci"])
+
+if __name__ == "__main__":
+    # Usage: python gene_tree_store.py <trprobs file>... > trees.nex
+    # Writes the deduplicated, weighted TREES block of MrBayes output, and reports the loci spec string and the compression on stderr.
+    taxa = set()
+    for path in sys.argv[1:]:
+        with open(path) as f:
+            taxa.update(line.strip().strip(",;").split()[1] for line in f if len(line.strip()) > 0 and line.strip()[0].isdigit())
+    store = new_store(sorted(taxa))
+    add_trprobs(store, sys.argv[1:])
+    loci_spec_string = write_weighted_trees_block(store, sys.stdout)
+    trees, distinct = store_summary(store)
+    print(f'{loci_spec_string}\n{trees} trees, {distinct} distinct', file=sys.stderr)
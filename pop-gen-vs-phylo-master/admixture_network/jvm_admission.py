@@ -0,0 +1,252 @@
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import getpass
+import sqlite3
+import tempfile
+import subprocess
+
+# Admission control for Java tools sharing a node: a job starts once its estimated heap fits in available memory next to the heaps reserved
+# in a node-local SQLite ledger. Jobs that run out of heap are retried with twice the heap
+
+LEDGER_PATH = f'/tmp/jvm_admission_{getpass.getuser()}.sqlite'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS reservations (
+    id INTEGER PRIMARY KEY,
+    pid INTEGER NOT NULL,
+    tool TEXT NOT NULL,
+    heap_mb INTEGER NOT NULL,
+    started REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS observations (
+    tool TEXT NOT NULL,
+    size REAL NOT NULL,
+    heap_mb INTEGER NOT NULL,
+    peak_rss_mb REAL NOT NULL,
+    out_of_memory INTEGER NOT NULL,
+    features TEXT NOT NULL,
+    recorded REAL NOT NULL
+);
+"""
+
+# Starting points for the heap model of each tool: heap_mb = base_mb + mb_per_unit * size (see input_size). Observations replace the slope.
+DEFAULT_MODELS = {
+    "phylonet": {"base_mb": 512, "mb_per_unit": 0.002},
+    "rentplus": {"base_mb": 256, "mb_per_unit": 0.001},
+    "beast": {"base_mb": 512, "mb_per_unit": 0.001},
+    "compare": {"base_mb": 256, "mb_per_unit": 0.01},
+}
+
+SAFETY_FACTOR = 1.25 # Headroom over the largest observed RSS per unit of input
+OUT_OF_MEMORY_CODES = [-9, 137] # SIGKILL from the kernel's OOM killer (137 when the JVM runs under a shell)
+OUT_OF_MEMORY_PATTERN = re.compile(r'java\.lang\.OutOfMemoryError') # Also in the message of -XX:+ExitOnOutOfMemoryError
+
+def open_ledger(path=LEDGER_PATH, timeout=600):
+    """
+    Opens the node's admission ledger, creating it if necessary, and returns the SQLite connection to it.
+    """
+    connection = sqlite3.connect(path, timeout=timeout)
+    connection.executescript(SCHEMA)
+    return connection
+
+def meminfo_mb(field):
+    """
+    Returns a field of /proc/meminfo (e.g. "MemAvailable" or "MemTotal") in megabytes.
+    """
+    with open("/proc/meminfo") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) / 1024
+    return None
+
+def phylonet_input_features(file):
+    """
+    Reads the size of a PhyloNet input: the number of taxa and sites in its data block, the number of loci (or gene trees), and the maximum
+    number of reticulations, along with its command and (where given) chain length, number of runs, and threads.
+    """
+    with open(file) as f:
+        input_str = f.read()
+    taxa = re.search(r'ntax\s*=\s*(\d+)', input_str, re.IGNORECASE)
+    sites = re.search(r'nchar\s*=\s*(\d+)', input_str, re.IGNORECASE)
+    reticulations = re.search(r'-mr (\d+)', input_str) or re.search(r'^InferNetwork_\w+ \([^)]*\) (\d+)', input_str, re.MULTILINE)
+    loci = len(re.findall(r'^\s*\[L\d+', input_str, re.MULTILINE)) + len(re.findall(r'^\s*Tree ', input_str, re.MULTILINE | re.IGNORECASE))
+    command = re.search(r'^(MCMC_\w+|MLE_\w+|InferNetwork_\w+)', input_str, re.MULTILINE)
+    options = {name: re.search(rf'(?:{flag}) (\d+)', input_str) for name, flag in [("chain_length", "-cl"), ("runs", "-mnr|-x"), ("threads", "-pl")]}
+    return {
+        "command": command.group(1) if command is not None else "unknown",
+        "taxa": int(taxa.group(1)) if taxa is not None else 0,
+        "sites": int(sites.group(1)) if sites is not None else 0,
+        "loci": loci,
+        "reticulations": int(reticulations.group(1)) if reticulations is not None else 0,
+        **{name: int(match.group(1)) for name, match in options.items() if match is not None},
+    }
+
+def input_size(features):
+    """
+    Collapses input features into the single size that heap needs are modeled against.
+    """
+    return features.get("taxa", 0) * (features.get("sites", 0) + features.get("loci", 0)) * (1 + features.get("reticulations", 0))
+
+def estimate_heap_mb(connection, tool, features):
+    """
+    Estimates the heap a job needs. Once a tool has observations, the largest observed peak RSS per unit of input size (times SAFETY_FACTOR)
+    replaces the default slope, and the estimate never falls below the largest RSS seen for an input of at most the same size, nor below
+    twice the largest heap that ran out of memory on an input of at least the same size.
+    """
+    model = DEFAULT_MODELS.get(tool, {"base_mb": 512, "mb_per_unit": 0.001})
+    size = input_size(features)
+    estimate = model["base_mb"] + model["mb_per_unit"] * size
+
+    rows = connection.execute("SELECT size, peak_rss_mb FROM observations WHERE tool = ? AND out_of_memory = 0", (tool,)).fetchall()
+    failed = connection.execute("SELECT MAX(heap_mb) FROM observations WHERE tool = ? AND out_of_memory = 1 AND size >= ?", (tool, size)).fetchone()[0]
+    slopes = [max(peak_rss_mb - model["base_mb"], 0) / row_size for row_size, peak_rss_mb in rows if row_size > 0]
+    if len(slopes) > 0:
+        estimate = model["base_mb"] + SAFETY_FACTOR * max(slopes) * size
+    smaller = [peak_rss_mb for row_size, peak_rss_mb in rows if row_size <= size]
+    if len(smaller) > 0:
+        estimate = max(estimate, SAFETY_FACTOR * max(smaller))
+    if failed is not None:
+        estimate = max(estimate, 2 * failed)
+    return int(estimate)
+
+def process_alive(pid):
+    """
+    Returns True if a process with the given id is running.
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def admit(connection, tool, heap_mb, poll_interval=10, reserve_fraction=0.9):
+    """
+    Waits until a job with the given heap can start, then reserves the heap in the ledger and returns the reservation id.
+    A job is admitted when its heap fits in MemAvailable and the reserved heaps (including it) fit in reserve_fraction of MemTotal.
+    A job that could never fit (larger than that share of MemTotal) is admitted once nothing else is reserved, rather than waiting forever.
+    """
+    while True:
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            for reservation_id, pid in connection.execute("SELECT id, pid FROM reservations").fetchall(): # Drop reservations of jobs that died
+                if not process_alive(pid):
+                    connection.execute("DELETE FROM reservations WHERE id = ?", (reservation_id,))
+            reserved = connection.execute("SELECT COALESCE(SUM(heap_mb), 0) FROM reservations").fetchone()[0]
+            limit = reserve_fraction * meminfo_mb("MemTotal")
+            fits = heap_mb <= meminfo_mb("MemAvailable") and reserved + heap_mb <= limit
+            if fits or (reserved == 0 and heap_mb > limit):
+                cursor = connection.execute("INSERT INTO reservations (pid, tool, heap_mb, started) VALUES (?, ?, ?, ?)", (os.getpid(), tool, heap_mb, time.time()))
+                return cursor.lastrowid
+        time.sleep(poll_interval)
+
+def release(connection, reservation_id):
+    """
+    Releases a heap reservation.
+    """
+    with connection:
+        connection.execute("DELETE FROM reservations WHERE id = ?", (reservation_id,))
+    return
+
+def record_observation(connection, tool, features, heap_mb, peak_rss_mb, out_of_memory):
+    """
+    Records the peak RSS of a finished run, for estimate_heap_mb.
+    """
+    with connection:
+        connection.execute("INSERT INTO observations VALUES (?, ?, ?, ?, ?, ?, ?)", (tool, input_size(features), heap_mb, peak_rss_mb, int(out_of_memory), json.dumps(features, sort_keys=True), time.time()))
+    return
+
+def run_measured(cmd, stdout=None):
+    """
+    Runs a command and returns its exit code, peak RSS in megabytes (from os.wait4, so it covers just this process), and standard error,
+    which is also passed on to this process's standard error.
+    """
+    with tempfile.TemporaryFile("w+") as stderr:
+        process = subprocess.Popen(cmd, stdout=stdout, stderr=stderr)
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status) # Tell Popen the process has already been reaped
+        stderr.seek(0)
+        errors = stderr.read()
+    sys.stderr.write(errors)
+    return process.returncode, usage.ru_maxrss / 1024, errors # ru_maxrss is in kilobytes on Linux
+
+def out_of_memory(returncode, errors):
+    """
+    Returns whether a JVM run failed for lack of memory: it was killed (by the kernel's OOM killer), or it reported an OutOfMemoryError.
+    Other failures are not retried, since a larger heap would not help them.
+    """
+    return returncode in OUT_OF_MEMORY_CODES or (returncode != 0 and OUT_OF_MEMORY_PATTERN.search(errors) is not None)
+
+def run_java(tool, java_args, features, output=None, java="java", heap_mb=None, max_attempts=3, ledger=LEDGER_PATH):
+    """
+    Runs a Java tool (java_args are the arguments after the JVM options, e.g. ["-jar", "PhyloNet_3.8.2.jar", "input.nex"]) under admission
+    control, writing its standard output to output if given. The heap is estimated from features unless heap_mb is given, and runs that run out
+    of memory are retried with twice the heap, up to max_attempts times. Returns the exit code of the last attempt.
+    """
+    connection = open_ledger(ledger)
+    heap_mb = estimate_heap_mb(connection, tool, features) if heap_mb is None else heap_mb
+
+    for attempt in range(max_attempts):
+        reservation_id = admit(connection, tool, heap_mb)
+        try:
+            cmd = [java, f'-Xmx{heap_mb}m', "-XX:+ExitOnOutOfMemoryError", "-XX:+DisplayVMOutputToStderr"] + java_args # The JVM's exit message goes to stderr
+            if output is not None:
+                with open(output, "w") as f:
+                    returncode, peak_rss_mb, errors = run_measured(cmd, f)
+            else:
+                returncode, peak_rss_mb, errors = run_measured(cmd)
+        finally:
+            release(connection, reservation_id)
+
+        ran_out = out_of_memory(returncode, errors)
+        record_observation(connection, tool, features, heap_mb, peak_rss_mb, ran_out)
+        if not ran_out:
+            break
+        print(f'{tool} ran out of memory with a {heap_mb} MB heap (attempt {attempt + 1} of {max_attempts})')
+        heap_mb *= 2
+
+    connection.close()
+    return returncode
+
+def java_command(prefix):
+    """
+    Splits the command prefix of a Java tool into the java executable and the arguments that follow the JVM options, e.g.
+    "java -jar RentPlus.jar" into ("java", ["-jar", "RentPlus.jar"]). BEAST 2's bin/beast launcher script sets its own heap, so it is
+    replaced by the launcher class in the installation's lib/launcher.jar. Returns None if the prefix does not start a JVM this way.
+    """
+    words = prefix.split()
+    if os.path.basename(words[0]) == "java":
+        return words[0], words[1:]
+    script = os.path.realpath(shutil.which(words[0]) or words[0]) # e.g. "beast" on the PATH, possibly a symlink into the installation
+    launcher = os.path.join(os.path.dirname(os.path.dirname(script)), "lib", "launcher.jar")
+    if os.path.basename(words[0]) == "beast" and os.path.exists(launcher):
+        return "java", ["-cp", launcher, "beast.app.beastapp.BeastLauncher"] + words[1:]
+    return None
+
+def run_java_prefix(tool, prefix, args, features, output=None, heap_mb=None):
+    """
+    Runs a Java tool given by its command prefix (see java_command) with the given arguments under admission control (see run_java).
+    A prefix that does not start a JVM is run as is, without admission control, after a warning. Returns the exit code.
+    """
+    command = java_command(prefix)
+    if command is None:
+        print(f'Cannot set the heap of "{prefix}", so {tool} runs without admission control')
+        if output is not None:
+            with open(output, "w") as f:
+                return subprocess.run(prefix.split() + args, stdout=f).returncode
+        return subprocess.run(prefix.split() + args).returncode
+    java, java_args = command
+    return run_java(tool, java_args + args, features, output, java=java, heap_mb=heap_mb)
+
+if __name__ == "__main__":
+    # Usage: python jvm_admission.py [ledger path]
+    connection = open_ledger(sys.argv[1] if len(sys.argv) > 1 else LEDGER_PATH)
+    for tool, pid, heap_mb, started in connection.execute("SELECT tool, pid, heap_mb, started FROM reservations"):
+        print(f'reserved: {tool} (pid {pid}) {heap_mb} MB for {time.time() - started:.0f} s')
+    for tool, runs, out_of_memory, peak in connection.execute("SELECT tool, COUNT(*), SUM(out_of_memory), MAX(peak_rss_mb) FROM observations GROUP BY tool"):
+        print(f'observed: {tool} {runs} runs, {out_of_memory} out of memory, peak RSS {peak:.0f} MB')
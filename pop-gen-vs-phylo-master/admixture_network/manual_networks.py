@@ -1,9 +1,9 @@
 import os
-import pickle
 import networkx as nx
 from parse_rich_newick2 import parse_rich_newick
 from admixture_network import generate_ms_command, add_BirthDeath_time_tags, strip_extra_root
 from call_ms import call_ms
+from network_archive import archive_path, write_network
 from write_GTmix_input import write_GTmix_input
 from write_TreeMix_input import write_TreeMix_input
 from write_PhyloNet_input import write_input, build_bimarker_nexus, build_MCMC_BiMarkers_input, build_MLE_BiMarkers_input
@@ -102,7 +102,7 @@ base = "/home/ehs3/pop-gen-vs-phylo/manual_data"
 
 create_dir(base)
 
-top_level = ["input", "networks", "output"]
+top_level = ["input"]
 methods = ["gtmix", "treemix", "phylonet_mcmc_bimarkers", "phylonet_mle_bimarkers"]
 
 for d, network_set in enumerate(manual_networks):
@@ -114,11 +114,10 @@ for d, network_set in enumerate(manual_networks):
         create_dir(difficulty_base + "/" + name)
     for name in methods:
         create_dir(difficulty_base + "/input/" + name)
-        create_dir(difficulty_base + "/output/" + name)
     
     for i, network_data in enumerate(network_set):
-        # Save network using pickle
-        pickle.dump(network_data[0], open(f'{difficulty_base}/networks/{i}.p', 'wb'))
+        # Save network to the archive
+        write_network(archive_path(difficulty_base), network_data[0], i, "true")
 
         # Write GTmix input
         write_GTmix_input(network_data[2], f'{difficulty_base}/input/gtmix/{i}/')
@@ -4,6 +4,7 @@ import pickle
 import networkx as nx
 from parse_rich_newick2 import parse_rich_newick
 from run_PhyloNet import extract_network_string
+from network_archive import ARCHIVE_NAME, run_id_from_filename, write_network
 
 in_path = os.path.expanduser(sys.argv[1])
 out_path = os.path.expanduser(sys.argv[2])
@@ -11,9 +12,14 @@ out_path = os.path.expanduser(sys.argv[2])
 network_string = extract_network_string(in_path)
 network = parse_rich_newick(network_string)
 
-print(f'Dumping network {network_string} to output path {out_path}...')
-
-pickle.dump(network, open(out_path, 'wb'))
+if out_path.endswith(ARCHIVE_NAME): # Usage with an archive: python mcmc_pickle_save.py <PhyloNet output> <archive path> <run id> <method>
+    run_id = run_id_from_filename(sys.argv[3])
+    method = sys.argv[4]
+    print(f'Writing network {network_string} to archive {out_path} as run {run_id} of method {method}...')
+    write_network(out_path, network, run_id, method)
+else:
+    print(f'Dumping network {network_string} to output path {out_path}...')
+    pickle.dump(network, open(out_path, 'wb'))
 
 viz = nx.nx_pydot.to_pydot(network)
 print(viz)
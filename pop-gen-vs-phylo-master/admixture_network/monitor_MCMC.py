@@ -0,0 +1,145 @@
+import os
+import re
+import numpy as np
+from parse_rich_newick2 import parse_rich_newick
+from run_PhyloNet import run_PhyloNet_streaming, extract_network_string
+from write_rich_newick import write_rich_newick
+
+# Collects the samples of PhyloNet's MCMC output as it streams in, so that convergence can be checked while the chain runs
+
+SAMPLE_PATTERN = re.compile(r'^\s*(\d+)\s*;\s*(-?[0-9.]+(?:[Ee][-+]?[0-9]+)?)\s*;')
+
+def new_trace(burn_in=0):
+    """
+    Returns an empty trace. Samples from iterations before burn_in are read but not used for convergence checks.
+    """
+    return {"burn_in": burn_in, "iterations": [], "posteriors": [], "networks": [], "topologies": []}
+
+def topology_key(network_string):
+    """
+    Returns a string that identifies the topology of a sampled network, independent of branch lengths, child order, and internal node names.
+    """
+    network = parse_rich_newick(network_string)
+    string = write_rich_newick(network, canonical=True, edge_data=False)
+    names = {}
+    return re.sub(r'I\d+', lambda match: names.setdefault(match.group(0), f'I{len(names)}'), string)
+
+def add_line(trace, line):
+    """
+    Adds a line of PhyloNet output to a trace, and returns True if it was a sample or a sampled network.
+    """
+    line = line.strip()
+    match = SAMPLE_PATTERN.match(line)
+    if match is not None:
+        trace["iterations"].append(int(match.group(1)))
+        trace["posteriors"].append(float(match.group(2)))
+        trace["networks"].append(None)
+        trace["topologies"].append(None)
+        return True
+    if line.startswith("(") and line.endswith(";") and len(trace["networks"]) > 0 and trace["networks"][-1] is None: # The network of the last sample
+        trace["networks"][-1] = line
+        trace["topologies"][-1] = topology_key(line)
+        return True
+    return False
+
+def effective_sample_size(values):
+    """
+    Returns the effective sample size n / tau of a series, where the autocorrelation time tau = -1 + 2 * (sum of Geyer's initial positive
+    sequence), i.e. of the pairs rho_0 + rho_1, rho_2 + rho_3, ... up to the first pair that is not positive.
+    """
+    x = np.asarray(values, dtype=float)
+    n = len(x)
+    if n < 4 or np.var(x) == 0:
+        return float(n)
+
+    # Autocorrelation through the FFT (padded to avoid wrap-around)
+    x = x - x.mean()
+    spectrum = np.fft.rfft(x, 2 * n)
+    autocorrelation = np.fft.irfft(spectrum * np.conj(spectrum))[:n]
+    autocorrelation /= autocorrelation[0]
+
+    # Sum consecutive pairs of autocorrelations, starting at lag 0, while they stay positive
+    total = 0.0
+    for k in range(0, n - 1, 2):
+        pair = autocorrelation[k] + autocorrelation[k + 1]
+        if pair <= 0:
+            break
+        total += pair
+    tau = 2 * total - 1
+    return float(n / tau) if tau > 0 else float(n) # tau is only 0 for a series that strictly alternates
+
+def topology_difference(topologies):
+    """
+    Splits a series of sampled topologies in half and returns the largest difference in any topology's frequency between the two halves.
+    """
+    half = len(topologies) // 2
+    if half == 0:
+        return 1.0
+    first, second = topologies[:half], topologies[half:]
+    return max(abs(first.count(topology) / len(first) - second.count(topology) / len(second)) for topology in set(topologies))
+
+def burn_in_start(trace):
+    """
+    Returns the index of the first sample in a trace that comes after the burn-in.
+    """
+    return next((i for i, iteration in enumerate(trace["iterations"]) if iteration >= trace["burn_in"]), len(trace["iterations"]))
+
+def check_convergence(trace, min_ess=200, max_topology_difference=0.05, min_samples=100):
+    """
+    Returns True once the post-burn-in part of a trace has at least min_samples samples, an effective sample size of the log posterior of
+    at least min_ess, and (if networks were sampled) topology frequencies that differ by at most max_topology_difference between its halves.
+    """
+    start = burn_in_start(trace)
+    posteriors = trace["posteriors"][start:]
+    if len(posteriors) < min_samples or effective_sample_size(posteriors) < min_ess:
+        return False
+    topologies = [topology for topology in trace["topologies"][start:] if topology is not None]
+    return len(topologies) == 0 or topology_difference(topologies) <= max_topology_difference
+
+def MAP_network_string(trace):
+    """
+    Returns the sampled network with the highest posterior in a trace, or None if no networks were sampled.
+    """
+    sampled = [(posterior, network) for posterior, network in zip(trace["posteriors"], trace["networks"]) if network is not None]
+    return max(sampled, key=lambda sample: sample[0])[1] if len(sampled) > 0 else None
+
+def run_PhyloNet_MCMC_monitored(file, output=None, phylonet_prefix="PhyloNet_3.8.2.jar", max_heap=None, min_ess=200, max_topology_difference=0.05, min_samples=100, check_interval=20):
+    """
+    Runs a PhyloNet MCMC input (MCMC_BiMarkers, MCMC_SEQ, or MCMC_GT) while checking convergence every check_interval samples (see
+    check_convergence), and stops PhyloNet as soon as the chain has converged. Burn-in is read from the input's -bl flag.
+    Returns the MAP network: PhyloNet's own summary if the chain ran to the end, or else the best sampled network so far. The graph attributes
+    "converged", "samples", and "ess" record how the run ended.
+    """
+    if output is None:
+        output = os.path.splitext(file)[0] + ".out"
+    with open(file, "r") as f:
+        burn_in = re.search(r'-bl (\d+)', f.read())
+    trace = new_trace(int(burn_in.group(1)) if burn_in is not None else 0)
+    due = False # Whether the last sample is one to check convergence at, once its network (if any) has been recorded
+
+    def on_line(line):
+        nonlocal due
+        if not add_line(trace, line):
+            return False
+        if trace["networks"][-1] is None: # A new sample, so the previous one is complete
+            check = due # The previous sample was due but had no network line
+            due = len(trace["posteriors"]) % check_interval == 0
+            if not check:
+                return False
+        elif due: # The network of the sample that is due
+            due = False
+        else:
+            return False
+        return check_convergence(trace, min_ess, max_topology_difference, min_samples)
+
+    stopped = run_PhyloNet_streaming(file, on_line, output, phylonet_prefix, max_heap)
+
+    network_string = MAP_network_string(trace) if stopped else extract_network_string(output)
+    if network_string is None or network_string == "":
+        network_string = MAP_network_string(trace)
+    if network_string is None:
+        return None
+    network = parse_rich_newick(network_string)
+    converged = stopped or check_convergence(trace, min_ess, max_topology_difference, min_samples)
+    network.graph.update({"converged": converged, "samples": len(trace["posteriors"]), "ess": effective_sample_size(trace["posteriors"][burn_in_start(trace):])})
+    return network
@@ -0,0 +1,141 @@
+import re
+import sys
+import subprocess
+import numpy as np
+from call_ms import ms_command_features
+from tool_cache import cached_run, cache_key
+from runtime_history import record_runtime, wait_measured
+
+# Sweeps theta without re-running the coalescent: ms -T gene trees are kept as branch arrays, and mutations are dropped onto them as in ms
+
+TREE_TOKEN = re.compile(r'\(|\)([^(),;]*)|([^(),;]+)|[,;]')
+
+def genealogy_command(cmd, seeds=None):
+    """
+    Turns an ms command (as written by generate_ms_command) into the command that only simulates its gene trees: the -t flag is removed,
+    -T is added, and so is -seeds, if given. Returns the new command and the removed theta.
+    """
+    words = cmd.split()
+    t = words.index("-t")
+    theta = float(words[t + 1])
+    words = words[:t] + words[t + 2:] + ["-T"]
+    if seeds is not None:
+        words += ["-seeds"] + [str(x) for x in seeds]
+    return " ".join(words), theta
+
+def tree_arrays(tree_string, sample_count):
+    """
+    Parses an ms gene tree (with samples labeled 1 .. sample_count) into an array of branch lengths and a boolean matrix with a row per branch
+    that marks the samples below it. The root, which has no branch above it, is left out.
+    """
+    lengths = []
+    masks = []
+    stack = [np.zeros(sample_count, dtype=bool)]
+    for match in TREE_TOKEN.finditer(tree_string):
+        token = match.group(0)
+        if token == "(":
+            stack.append(np.zeros(sample_count, dtype=bool))
+        elif token.startswith(")"):
+            mask = stack.pop()
+            stack[-1] |= mask
+            if ":" in match.group(1):
+                lengths.append(float(match.group(1).split(":")[1]))
+                masks.append(mask)
+        elif match.group(2) is not None:
+            label, length = match.group(2).split(":")
+            mask = np.zeros(sample_count, dtype=bool)
+            mask[int(label) - 1] = True
+            stack[-1] |= mask
+            lengths.append(float(length))
+            masks.append(mask)
+    return np.array(lengths), np.array(masks)
+
+def locus_arrays(tree_lines, sample_count, locus_length):
+    """
+    Stacks the branches of a locus's trees (lines of ms -T output, with "[length]" prefixes under recombination) into the arrays used by
+    overlay_mutations: branch weights, sample masks, the tree each branch belongs to, and the start and share of the locus of each tree.
+    """
+    weights, masks, trees, starts, fractions = [], [], [], [], []
+    start = 0.0
+    for tree_index, line in enumerate(tree_lines):
+        match = re.match(r'\[(\d+)\](.*)', line)
+        fraction, tree_string = (int(match.group(1)) / locus_length, match.group(2)) if match is not None else (1.0, line)
+        lengths, tree_masks = tree_arrays(tree_string, sample_count)
+        weights.append(lengths * fraction)
+        masks.append(tree_masks)
+        trees.append(np.full(len(lengths), tree_index))
+        starts.append(start)
+        fractions.append(fraction)
+        start += fraction
+    return {"weights": np.concatenate(weights), "masks": np.concatenate(masks), "trees": np.concatenate(trees), "starts": np.array(starts), "fractions": np.array(fractions)}
+
+def simulate_genealogies(cmd, seeds=None, cache=None):
+    """
+    Runs the coalescent part of an ms command once and returns its genealogies: a dictionary with the sample count, the population count,
+    and the arrays of each locus (see locus_arrays). With seeds (three ms seeds) and a cache directory, the genealogies are cached under
+    the command without its theta, so that every theta of a sweep (and every later sweep of the same network) shares them.
+    """
+    tree_cmd, _ = genealogy_command(cmd, seeds)
+    words = cmd.split()
+    sample_count = int(words[1])
+    pop_count = int(words[words.index("-I") + 1])
+    locus_length = int(words[words.index("-r") + 2]) if "-r" in words else 1
+
+    def run():
+        with record_runtime("ms_genealogies", ms_command_features(cmd)) as measured:
+            process = subprocess.Popen(tree_cmd, shell=True, stdout=subprocess.PIPE, text=True)
+            output = process.stdout.read()
+            process.stdout.close()
+            measured["peak_rss_mb"] = wait_measured(process)
+            if process.returncode != 0:
+                raise subprocess.CalledProcessError(process.returncode, tree_cmd)
+        loci = []
+        for block in output.split("//")[1:]:
+            tree_lines = [line.strip() for line in block.splitlines() if line.strip().startswith(("[", "("))]
+            loci.append(locus_arrays(tree_lines, sample_count, locus_length))
+        return {"sample_count": sample_count, "pop_count": pop_count, "loci": loci}
+
+    key_function = lambda: cache_key("ms_genealogies", [words[0]], [tree_cmd])
+    return cached_run(cache if seeds is not None else None, "ms_genealogies", key_function, run, {})
+
+def overlay_mutations(genealogies, theta, seed=None, precision=4):
+    """
+    Drops mutations at rate theta (per locus, as in ms's -t) onto simulated genealogies, and returns the haplotypes in the same format as
+    call_ms. Positions are rounded to precision decimals, as ms prints them. seed may be anything np.random.default_rng accepts.
+    """
+    rng = np.random.default_rng(seed)
+    alleles_per_pop = genealogies["sample_count"] // genealogies["pop_count"]
+    output = []
+    for locus in genealogies["loci"]:
+        total = locus["weights"].sum()
+        if total == 0:
+            # No branch length to mutate on, so no segregating sites
+            output.append(((), tuple(tuple([""] * alleles_per_pop) for _ in range(genealogies["pop_count"]))))
+            continue
+        mutation_count = rng.poisson(theta * total)
+        branches = rng.choice(len(locus["weights"]), size=mutation_count, p=locus["weights"] / total)
+        trees = locus["trees"][branches]
+        positions = locus["starts"][trees] + locus["fractions"][trees] * rng.random(mutation_count)
+        order = np.argsort(positions)
+
+        # Samples by sites, as the characters "0" and "1"
+        matrix = (locus["masks"][branches[order]].T.astype(np.uint8) + ord("0"))
+        haplotypes = [row.tobytes().decode() for row in matrix]
+        output.append((tuple(np.round(positions[order], precision).tolist()), tuple(tuple(haplotypes[j:j+alleles_per_pop]) for j in range(0, len(haplotypes), alleles_per_pop))))
+    return tuple(output)
+
+def theta_sweep(cmd, thetas, seeds=None, seed=None, cache=None):
+    """
+    Simulates the genealogies of an ms command once, and returns a dictionary from each theta to the data (in the format of call_ms) obtained
+    by overlaying mutations at that rate. Each theta draws from its own random stream, spawned from seed.
+    """
+    genealogies = simulate_genealogies(cmd, seeds, cache)
+    streams = np.random.SeedSequence(seed).spawn(len(thetas))
+    return {theta: overlay_mutations(genealogies, theta, stream) for theta, stream in zip(thetas, streams)}
+
+if __name__ == "__main__":
+    # Usage: python mutation_overlay.py "<ms command>" <theta>...
+    # Prints the number of segregating sites per locus for each theta.
+    sweep = theta_sweep(sys.argv[1], [float(x) for x in sys.argv[2:]])
+    for theta, data in sweep.items():
+        print(f'theta {theta}: {[len(positions) for positions, _ in data]} segregating sites')
@@ -0,0 +1,261 @@
+import os
+import sys
+import json
+import pickle
+import sqlite3
+import networkx as nx
+from write_rich_newick import write_networks_block
+
+# Networks stored in SQLite as rows of typed node/edge attribute columns, indexed by (run_id, method, params)
+
+ARCHIVE_NAME = "networks.sqlite"
+
+# Typed columns for the attributes the generators set, with their SQLite types. A value goes into its column only if it has the column's type;
+# anything else (other attributes, or e.g. an integer time) goes into the JSON extra column, so that every attribute reads back as written.
+NODE_COLUMNS = {"type": "TEXT", "population": "INTEGER", "time": "REAL", "proportion": "REAL", "mix_parent": "INTEGER"}
+EDGE_COLUMNS = {"length": "REAL", "support": "REAL"}
+
+COLUMN_TYPES = {"TEXT": (str,), "INTEGER": (int,), "REAL": (float,)}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS networks (
+    id INTEGER PRIMARY KEY,
+    run_id,
+    method TEXT NOT NULL,
+    params TEXT NOT NULL,
+    graph TEXT NOT NULL,
+    UNIQUE (run_id, method, params)
+);
+CREATE TABLE IF NOT EXISTS nodes (
+    network_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    node,
+    type TEXT,
+    population INTEGER,
+    time REAL,
+    proportion REAL,
+    mix_parent INTEGER,
+    extra TEXT
+);
+CREATE TABLE IF NOT EXISTS edges (
+    network_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    u,
+    v,
+    length REAL,
+    support REAL,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS nodes_by_network ON nodes (network_id);
+CREATE INDEX IF NOT EXISTS edges_by_network ON edges (network_id);
+"""
+
+def archive_path(base):
+    """
+    Returns the path of the network archive that belongs to a data directory.
+    """
+    return f'{base}/{ARCHIVE_NAME}'
+
+def open_archive(path, timeout=600):
+    """
+    Opens a network archive, creating it if necessary, and returns the SQLite connection to it.
+    timeout is the number of seconds to wait for other workers to release the database lock.
+    """
+    connection = sqlite3.connect(path, timeout=timeout)
+    connection.executescript(SCHEMA)
+    return connection
+
+def params_key(params):
+    """
+    Returns the canonical string form of a parameter dictionary, which is used to index the archive.
+    """
+    return json.dumps(params if params is not None else {}, sort_keys=True)
+
+def fits_column(value, column_type):
+    """
+    Returns whether a value can be stored in a column of the given SQLite type and read back unchanged (booleans are not integers here).
+    """
+    return isinstance(value, COLUMN_TYPES[column_type]) and not isinstance(value, bool)
+
+def encode_json(value):
+    """
+    Returns the JSON string of an attribute value. Tuples (which JSON would turn into lists) are tagged, so that decode_json restores them.
+    """
+    def tag(x):
+        if isinstance(x, tuple):
+            return {"__tuple__": [tag(y) for y in x]}
+        if isinstance(x, list):
+            return [tag(y) for y in x]
+        if isinstance(x, dict):
+            return {key: tag(y) for key, y in x.items()}
+        return x
+    return json.dumps(tag(value))
+
+def decode_json(string):
+    """
+    Inverse of encode_json.
+    """
+    return json.loads(string, object_hook=lambda x: tuple(x["__tuple__"]) if x.keys() == {"__tuple__"} else x)
+
+def split_attributes(attributes, columns):
+    """
+    Splits an attribute dictionary into a list of values for the given columns (NULL where the attribute is unset or does not fit the
+    column's type), plus a JSON string holding any remaining attributes.
+    """
+    values = [attributes[column] if fits_column(attributes.get(column), column_type) else None for column, column_type in columns.items()]
+    extra = {key: value for key, value in attributes.items() if key not in columns or not fits_column(value, columns[key])}
+    return values, encode_json(extra) if len(extra) > 0 else None
+
+def join_attributes(values, extra, columns):
+    """
+    Inverse of split_attributes. Columns that are NULL are left out, so that attributes that were never set stay unset.
+    """
+    attributes = {column: value for column, value in zip(columns, values) if value is not None}
+    if extra is not None:
+        attributes.update(decode_json(extra))
+    return attributes
+
+def write_network(archive, network, run_id, method, params=None):
+    """
+    Writes a network into an archive (either a path or an open connection) under the key (run_id, method, params).
+    Any network already stored under the same key is replaced.
+    """
+    connection = open_archive(archive) if isinstance(archive, str) else archive
+
+    # Flatten nodes and edges into rows before taking the lock, so that the write transaction stays short
+    node_rows = []
+    for position, (node, attributes) in enumerate(network.nodes.items()):
+        values, extra = split_attributes(attributes, NODE_COLUMNS)
+        node_rows.append([position, node] + values + [extra])
+    edge_rows = []
+    for position, ((u, v), attributes) in enumerate(network.edges.items()):
+        values, extra = split_attributes(attributes, EDGE_COLUMNS)
+        edge_rows.append([position, u, v] + values + [extra])
+
+    with connection: # Commits on success, rolls back on error
+        connection.execute("BEGIN IMMEDIATE") # Take the write lock up front so that concurrent workers queue instead of deadlocking
+        delete_network(connection, run_id, method, params)
+        cursor = connection.execute("INSERT INTO networks (run_id, method, params, graph) VALUES (?, ?, ?, ?)", (run_id, method, params_key(params), encode_json(network.graph)))
+        network_id = cursor.lastrowid
+        connection.executemany(f'INSERT INTO nodes VALUES ({", ".join("?" * (len(NODE_COLUMNS) + 4))})', ([network_id] + row for row in node_rows))
+        connection.executemany(f'INSERT INTO edges VALUES ({", ".join("?" * (len(EDGE_COLUMNS) + 5))})', ([network_id] + row for row in edge_rows))
+
+    if isinstance(archive, str):
+        connection.close()
+    return
+
+def delete_network(connection, run_id, method, params=None):
+    """
+    Deletes the network stored under the key (run_id, method, params), if there is one.
+    """
+    for (network_id,) in connection.execute("SELECT id FROM networks WHERE run_id = ? AND method = ? AND params = ?", (run_id, method, params_key(params))).fetchall():
+        connection.execute("DELETE FROM nodes WHERE network_id = ?", (network_id,))
+        connection.execute("DELETE FROM edges WHERE network_id = ?", (network_id,))
+        connection.execute("DELETE FROM networks WHERE id = ?", (network_id,))
+    return
+
+def load_network(connection, network_id, graph):
+    """
+    Rebuilds the NetworkX DiGraph with the given archive id.
+    """
+    network = nx.DiGraph()
+    network.graph.update(decode_json(graph))
+    for row in connection.execute(f'SELECT node, {", ".join(NODE_COLUMNS)}, extra FROM nodes WHERE network_id = ? ORDER BY position', (network_id,)):
+        network.add_node(row[0], **join_attributes(row[1:-1], row[-1], NODE_COLUMNS))
+    for row in connection.execute(f'SELECT u, v, {", ".join(EDGE_COLUMNS)}, extra FROM edges WHERE network_id = ? ORDER BY position', (network_id,)):
+        network.add_edge(row[0], row[1], **join_attributes(row[2:-1], row[-1], EDGE_COLUMNS))
+    return network
+
+def read_network(archive, run_id, method, params=None):
+    """
+    Reads the network stored under the key (run_id, method, params) from an archive, or returns None if there is no such network.
+    """
+    connection = open_archive(archive) if isinstance(archive, str) else archive
+    row = connection.execute("SELECT id, graph FROM networks WHERE run_id = ? AND method = ? AND params = ?", (run_id, method, params_key(params))).fetchone()
+    network = load_network(connection, *row) if row is not None else None
+    if isinstance(archive, str):
+        connection.close()
+    return network
+
+def list_networks(archive, method=None):
+    """
+    Returns a list of (run_id, method, params) keys for the networks in an archive, optionally restricted to a single method.
+    """
+    connection = open_archive(archive) if isinstance(archive, str) else archive
+    if method is None:
+        rows = connection.execute("SELECT run_id, method, params FROM networks ORDER BY method, run_id").fetchall()
+    else:
+        rows = connection.execute("SELECT run_id, method, params FROM networks WHERE method = ? ORDER BY run_id", (method,)).fetchall()
+    if isinstance(archive, str):
+        connection.close()
+    return [(run_id, method, json.loads(params)) for run_id, method, params in rows]
+
+def read_networks(archive, method, params=None):
+    """
+    Reads every network stored for a method (and, if given, a parameter dictionary), and returns a list of (run_id, params, network) tuples.
+    """
+    connection = open_archive(archive) if isinstance(archive, str) else archive
+    if params is None:
+        rows = connection.execute("SELECT id, graph, run_id, params FROM networks WHERE method = ? ORDER BY run_id", (method,)).fetchall()
+    else:
+        rows = connection.execute("SELECT id, graph, run_id, params FROM networks WHERE method = ? AND params = ? ORDER BY run_id", (method, params_key(params))).fetchall()
+    networks = [(run_id, json.loads(params), load_network(connection, network_id, graph)) for network_id, graph, run_id, params in rows]
+    if isinstance(archive, str):
+        connection.close()
+    return networks
+
+def export_networks(archive, method, path, params=None, canonical=False):
+    """
+    Exports every network stored for a method (and, if given, a parameter dictionary) as a NEXUS file with a single NETWORKS block.
+    Networks are named "run{run_id}". Returns the number of networks exported.
+    """
+    networks = read_networks(archive, method, params)
+    with open(path, "w") as f:
+        f.write('#NEXUS\n')
+        write_networks_block((network for _, _, network in networks), f, [f'run{run_id}' for run_id, _, _ in networks], canonical)
+    return len(networks)
+
+def run_id_from_filename(filename):
+    """
+    Converts a pickle file name like "12.p" into the run id 12 (non-numeric names are kept as strings).
+    """
+    stem = os.path.splitext(filename)[0]
+    return int(stem) if stem.isnumeric() else stem
+
+def migrate_pickle_dir(base, archive=None, true_method="true"):
+    """
+    Copies the pickled networks in a data directory (networks/{i}.p and output/{method}/{i}.p) into a network archive.
+    The pickle files are left in place. Returns the number of networks migrated.
+    """
+    if archive is None:
+        archive = archive_path(base)
+    connection = open_archive(archive)
+
+    # Pair every pickle directory with the method name it is archived under
+    pickle_dirs = []
+    if os.path.isdir(f'{base}/networks'):
+        pickle_dirs.append((f'{base}/networks', true_method))
+    if os.path.isdir(f'{base}/output'):
+        for method in sorted(os.listdir(f'{base}/output')):
+            if os.path.isdir(f'{base}/output/{method}'):
+                pickle_dirs.append((f'{base}/output/{method}', method))
+
+    count = 0
+    for directory, method in pickle_dirs:
+        for filename in sorted(os.listdir(directory)):
+            if not filename.endswith(".p"):
+                continue
+            with open(f'{directory}/{filename}', "rb") as f:
+                network = pickle.load(f)
+            write_network(connection, network, run_id_from_filename(filename), method)
+            count += 1
+
+    connection.close()
+    return count
+
+if __name__ == "__main__":
+    # Usage: python network_archive.py <data directory> [archive path]
+    base = os.path.expanduser(sys.argv[1])
+    archive = os.path.expanduser(sys.argv[2]) if len(sys.argv) > 2 else archive_path(base)
+    count = migrate_pickle_dir(base, archive)
+    print(f'Migrated {count} networks from {base} to {archive}')
@@ -4,6 +4,18 @@ import networkx as nx
 # TODO
 # Quoted strings "" for node names (not super important for now)
 
+# Bracket comments, structural characters, and runs of node text (label, length, support, and probability), in that order
+TOKEN_PATTERN = re.compile(r'\[[^\]]*\]?|[(),;]|[^()\[\],;]+')
+
+# key=value pairs in BEAST annotation comments, where values can be {}-enclosed lists
+ANNOTATION_PATTERN = re.compile(r'([^=,{}]+)=(\{[^}]*\}|[^,]*)')
+
+# Separators between networks in tree files (semicolons only count outside of comments)
+STATEMENT_PATTERN = re.compile(r'[\[\];]')
+
+# Prefix of NEXUS "tree"/"Network" statements, e.g. "tree SIM_1 =" or "Network net1 ="
+NAMED_STATEMENT_PATTERN = re.compile(r'\s*(tree|network)\s+[^=(]*=', re.IGNORECASE)
+
 def unpack_node_data(node_string):
     """
     Unpacks the data associated with a node string, and returns it as a list.
@@ -61,7 +73,7 @@ def merge_admixture_using_tag(node, mix_tag, network):
 
 def parse_rich_newick_helper(string, parent, network):
     """
-    Recursive helper function for parse_rich_newick.
+    Recursive helper function for parse_rich_newick_recursive.
     """
     # Create node and connect it to parent
     node = network.graph["counter"]
@@ -140,22 +152,164 @@ def strip_bracket_comments(string):
     """
     Strips comments, enclosed in square brackets, from string.
     """
-    new_string = ""
-    comment = False
-    for i, char in enumerate(string):
-        if char == "[":
-            comment = True
-        elif char == "]":
-            comment = False
-        elif comment:
-            continue
+    return re.sub(r'\[[^\]]*\]?|\]', '', string) # Stray closing brackets are dropped as well
+
+def tokenize_rich_newick(string):
+    """
+    Splits a Rich Newick string into bracket comments, structural characters, and node text, in a single pass.
+    """
+    return (match.group() for match in TOKEN_PATTERN.finditer(string))
+
+def parse_annotation_value(value):
+    """
+    Converts the value of an annotation into a float, a tuple (for {}-enclosed lists), or failing that, a string.
+    """
+    if value.startswith("{"):
+        return tuple(parse_annotation_value(x.strip()) for x in value[1:-1].split(","))
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+def parse_annotation_comment(comment):
+    """
+    Parses a BEAST-style annotation comment, like "[&gamma=0.3,height_95%HPD={0.0,0.1}]", into a dictionary of typed values.
+    Comments that are not annotations (they do not start with "&") give an empty dictionary.
+    """
+    comment = comment.strip("[]")
+    if not comment.startswith("&"):
+        return {}
+    return {key.strip(): parse_annotation_value(value.strip()) for key, value in ANNOTATION_PATTERN.findall(comment[1:])}
+
+def finish_node(node, parent, text, internal, nodes, edges, mix_tags, aliases, extra_attributes=None, default_proportion=None):
+    """
+    Records the data in a node's text once all of its children have been read. Mirrors the per-node logic of parse_rich_newick_helper, except that
+    a repeated hybrid tag is resolved by recording an alias instead of merging nodes in a graph.
+    extra_attributes (e.g. annotations read from comments) are added to the node, and default_proportion is used for hybrid nodes without a probability.
+    """
+    attributes = nodes[node]
+    if extra_attributes is not None:
+        attributes.update(extra_attributes)
+
+    if internal:
+        # Record node types and fill placeholder length and support values
+        if parent is None:
+            attributes["type"] = "root"
         else:
-            new_string += char
-    return new_string
+            attributes["type"] = "internal"
+            edges[parent, node]["length"] = None
+            edges[parent, node]["support"] = None
+        if len(text) == 0 or parent is None: # No internal node data to record
+            return
+
+    data = unpack_node_data(text)
+    if parent is not None:
+        edges[parent, node]["length"] = data[1]
+        edges[parent, node]["support"] = data[2]
+
+    if isinstance(data[0], str) and "#" in data[0]: # Admixture node
+        attributes["type"] = "admixture"
+        attributes["mix_parent"] = parent
+        attributes["proportion"] = data[3] if data[3] is not None else default_proportion
+        mix_tag = data[0].split("#")[1]
+        if mix_tag in mix_tags: # Other node exists: keep whichever node merge_admixture_using_tag would have kept
+            other_node = mix_tags[mix_tag]
+            if attributes["proportion"] is not None:
+                kept, dropped = other_node, node
+            else:
+                kept, dropped = node, other_node
+            nodes[kept].update(nodes.pop(dropped))
+            aliases[dropped] = kept
+        else: # Other node does not exist
+            mix_tags[mix_tag] = node
+    elif not internal: # Leaf node
+        attributes["type"] = "leaf"
+        attributes["population"] = data[0]
+    return
 
-def parse_rich_newick(string, strip_comments=True):
+def parse_rich_newick(string, strip_comments=True, annotations=None, gamma_as_proportion=False):
     """
     Parses a network in the Rich Newick format into a NetworkX DiGraph.
+    Works in a single pass over the tokens of the string with an explicit stack, so there is no limit on nesting depth. The result is identical to
+    that of parse_rich_newick_recursive (nodes are numbered in preorder, and hybrid nodes are merged the same way).
+
+    annotations is an optional list of keys to read out of BEAST-style comments (e.g. "height_mean") and store as typed node attributes.
+    If gamma_as_proportion is set, the "gamma" annotation of a hybrid node is used as its proportion, which replaces modify_BirthDeath_str.
+    """
+    read_comments = strip_comments and (annotations is not None or gamma_as_proportion)
+    nodes = {} # Node attributes, in preorder
+    edges = {} # Edge attributes, keyed by (parent, child), before hybrid aliases are resolved
+    mix_tags = {} # Maps hybrid tags to the first node that carried them
+    aliases = {} # Maps hybrid nodes that were merged away to the node that replaced them
+
+    stack = [] # (node, parent) pairs for the internal nodes whose child lists are still open
+    current = None # (node, parent, internal) for the node whose text is being read
+    text = []
+    comment_data = {} # Annotations read from the comments in the current node's text
+
+    def new_node(parent):
+        node = len(nodes) + len(aliases) # Merged nodes still used up an id, just as in the recursive parser
+        nodes[node] = {}
+        if parent is not None:
+            edges[parent, node] = {}
+        return node
+
+    def new_leaf():
+        parent = stack[-1][0] if len(stack) > 0 else None
+        return (new_node(parent), parent, False)
+
+    def finish_current():
+        if read_comments:
+            extra_attributes = {key: comment_data[key] for key in annotations if key in comment_data} if annotations is not None else None
+            default_proportion = comment_data.get("gamma") if gamma_as_proportion else None
+            finish_node(*current[:2], "".join(text), current[2], nodes, edges, mix_tags, aliases, extra_attributes, default_proportion)
+        else:
+            finish_node(*current[:2], "".join(text), current[2], nodes, edges, mix_tags, aliases)
+
+    for token in tokenize_rich_newick(string):
+        char = token[0]
+        if char == "(":
+            parent = stack[-1][0] if len(stack) > 0 else None
+            stack.append((new_node(parent), parent))
+        elif char in ",);":
+            if current is None and (char != ";" or len(nodes) == 0): # Empty leaf, as in "(A,,B)"
+                current = new_leaf()
+            if current is not None:
+                finish_current()
+            current = None
+            text = []
+            comment_data = {}
+            if char == ")":
+                current = stack.pop() + (True,) # Any text that follows belongs to the node that was just closed
+            elif char == ";":
+                break
+        elif char == "[":
+            if not strip_comments:
+                text.append(token)
+            elif read_comments and current is not None:
+                comment_data.update(parse_annotation_comment(token))
+        elif not token.isspace():
+            if current is None:
+                current = new_leaf()
+            text.append("".join(token.split())) # Skip space characters
+    else: # No terminating semicolon
+        if current is None and len(nodes) == 0:
+            current = new_leaf()
+        if current is not None:
+            finish_current()
+
+    # Build the DiGraph, redirecting edges of merged hybrid nodes to the nodes that replaced them
+    network = nx.DiGraph()
+    network.add_nodes_from(nodes.items())
+    for (u, v), attributes in edges.items():
+        network.add_edge(aliases.get(u, u), aliases.get(v, v), **attributes)
+
+    return network
+
+def parse_rich_newick_recursive(string, strip_comments=True):
+    """
+    Parses a network in the Rich Newick format into a NetworkX DiGraph, using the original recursive parser.
+    Kept as a reference for parse_rich_newick (see benchmark_parse_rich_newick.py); it is quadratic in the nesting depth and limited by Python's recursion limit.
     """
     # Strip comments from string, if requested
     if strip_comments:
@@ -179,6 +333,53 @@ def parse_rich_newick(string, strip_comments=True):
 
     return network
 
+def read_rich_newick_file(path, strip_comments=True, annotations=None, gamma_as_proportion=False, chunk_size=65536):
+    """
+    Reads the networks in a tree file (one Rich Newick string per statement, as in BEAST's summarized output, or NEXUS "tree"/"Network" statements)
+    incrementally, and yields them one at a time as parsed NetworkX DiGraphs, so that only one network is held in memory at once.
+    Statements without a network (e.g. "#NEXUS", "Begin trees;", "End;") are skipped. The remaining arguments are passed on to parse_rich_newick.
+    """
+    with open(path, "r") as f:
+        statement = [] # Pieces of the statement that is currently being read
+        in_comment = False
+        while True:
+            chunk = f.read(chunk_size)
+            if len(chunk) == 0:
+                break
+            start = 0
+            for match in STATEMENT_PATTERN.finditer(chunk):
+                char = match.group()
+                if char == "[":
+                    in_comment = True
+                elif char == "]":
+                    in_comment = False
+                elif not in_comment: # Semicolon that ends a statement
+                    statement.append(chunk[start:match.end()])
+                    start = match.end()
+                    network = parse_tree_statement("".join(statement), strip_comments, annotations, gamma_as_proportion)
+                    statement = []
+                    if network is not None:
+                        yield network
+            statement.append(chunk[start:])
+
+        # Parse a final statement that is missing its semicolon
+        network = parse_tree_statement("".join(statement), strip_comments, annotations, gamma_as_proportion)
+        if network is not None:
+            yield network
+
+def parse_tree_statement(statement, strip_comments=True, annotations=None, gamma_as_proportion=False):
+    """
+    Parses a single statement from a tree file, returning None if it does not contain a network.
+    """
+    match = NAMED_STATEMENT_PATTERN.match(statement)
+    if match is not None: # NEXUS statement: only the part after the equals sign is the network
+        statement = statement[match.end():]
+    elif "(" not in strip_bracket_comments(statement): # Not a network
+        return None
+    if len(statement.strip()) == 0:
+        return None
+    return parse_rich_newick(statement, strip_comments, annotations, gamma_as_proportion)
+
 def modify_BirthDeath_str(string):
     """
     Modifies a network string generated by BEAST so that it can be read in as a Rich Newick format network by properly encoding admixture proportions.
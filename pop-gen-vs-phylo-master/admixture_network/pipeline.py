@@ -0,0 +1,220 @@
+import os
+import sys
+import json
+import time
+import pickle
+import hashlib
+from admixture_network import generate_admixture_networks, generate_BirthHybrid_networks_admixture_target
+from call_ms import call_ms
+from compare_PhyloNet import compare_networks
+from run_GTmix import run_GTmix
+from run_PhyloNet import run_PhyloNet, run_PhyloNet_sharded
+from run_TreeMix import run_TreeMix
+from runtime_history import record_run
+from write_GTmix_input import write_GTmix_input
+from write_TreeMix_input import write_TreeMix_input
+from write_PhyloNet_input import write_input, build_bimarker_nexus, build_MCMC_BiMarkers_input, build_MLE_BiMarkers_input
+
+# The experiment as a graph of stages: generate -> network -> ms -> input_{method} -> infer_{method} -> distance. Artifacts are stored as
+# {store}/{stage}/{key}.p, keyed by the stage's parameters and inputs, so only stages downstream of a changed parameter rerun.
+
+MANIFEST_NAME = "manifest.jsonl"
+
+DEFAULT_CONFIG = {
+    "generator": "birth_hybrid",
+    "generate": {"n": 10, "admixture_count": 1, "alleles_per_pop": 1, "loci_count": 50, "mutation": 50, "recombination": 50, "locus_length": 500000, "hybrid_rate": 3},
+    "pop_counts": [4, 6, 8, 10],
+    "methods": {
+        "gtmix": {"input": {}, "infer": {"trees_per_locus": 10, "admixture_count": 1}},
+        "treemix": {"input": {}, "infer": {"admixture_count": 1}},
+        "phylonet_mcmc_bimarkers": {"input": {"max_reticulation": 1}, "infer": {}},
+        "phylonet_mle_bimarkers": {"input": {"max_reticulation": 1}, "infer": {}},
+    },
+    "compare_method": "luay",
+}
+
+# Paths of external programs (and the tool cache): these do not change results, so they are not part of any key
+DEFAULT_TOOLS = {
+    "beast_prefix": "beast",
+    "ms_prefix": "ms",
+    "phylonet_prefix": "PhyloNet_3.8.2.jar",
+    "compare_prefix": "java -jar PhyloNet_3.8.2.jar",
+    "treemix_prefix": "treemix",
+    "rent_prefix": "java -jar RentPlus.jar",
+    "treepicker_prefix": "./treepicker-linux64",
+    "gtmix_prefix": "./gtmix-linux64",
+    "cache": None, # Optional tool cache directory (see tool_cache.py), shared between stores
+}
+
+def stage_key(stage, params, upstream):
+    """
+    Returns the key of a stage's artifact: a hash of the stage name, its parameters, and the keys of its upstream artifacts.
+    """
+    description = json.dumps({"stage": stage, "params": params, "upstream": upstream}, sort_keys=True, default=str)
+    return hashlib.sha256(description.encode()).hexdigest()[:20]
+
+def artifact_path(store, stage, key):
+    """
+    Returns the path of the pickle file that holds an artifact.
+    """
+    return f'{store}/{stage}/{key}.p'
+
+def load_artifact(store, stage, key):
+    """
+    Loads a stored artifact.
+    """
+    with open(artifact_path(store, stage, key), "rb") as f:
+        return pickle.load(f)
+
+def save_artifact(store, stage, key, value):
+    """
+    Stores an artifact. The pickle is written to a temporary file and renamed, so a crash never leaves a partial artifact behind.
+    """
+    path = artifact_path(store, stage, key)
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, "wb") as f:
+        pickle.dump(value, f)
+    os.replace(temp_path, path)
+    return
+
+def log_manifest(store, entry):
+    """
+    Appends a record of a finished stage to the store's manifest.
+    """
+    with open(f'{store}/{MANIFEST_NAME}', "a") as f:
+        f.write(json.dumps(entry, sort_keys=True, default=str) + "\n")
+    return
+
+def run_stage(store, stage, function, params, upstream=None, tools=None):
+    """
+    Runs a stage unless its artifact is already stored, and returns the artifact's key.
+    upstream maps argument names to (stage, key) pairs of earlier artifacts, which are only loaded if the stage actually has to run.
+    function is called as function(params, inputs, work_dir, tools), where inputs maps the same names to the loaded artifacts.
+    """
+    upstream = upstream if upstream is not None else {}
+    key = stage_key(stage, params, {name: upstream_key for name, (_, upstream_key) in upstream.items()})
+    if os.path.exists(artifact_path(store, stage, key)):
+        return key
+
+    work_dir = f'{store}/{stage}/{key}'
+    os.makedirs(work_dir, exist_ok=True)
+    inputs = {name: load_artifact(store, upstream_stage, upstream_key) for name, (upstream_stage, upstream_key) in upstream.items()}
+
+    start = time.time()
+    value = function(params, inputs, work_dir, tools if tools is not None else DEFAULT_TOOLS)
+    save_artifact(store, stage, key, value)
+    log_manifest(store, {"stage": stage, "key": key, "params": params, "upstream": upstream, "seconds": time.time() - start, "finished": time.time()})
+    record_run(f'stage_{stage}', params, time.time() - start)
+
+    return key
+
+def generate_stage(params, inputs, work_dir, tools):
+    """
+    Generates a batch of networks, each paired with its ms command.
+    """
+    params = dict(params)
+    generator = params.pop("generator")
+    if generator == "birth_hybrid":
+        return generate_BirthHybrid_networks_admixture_target(**params, work_path=f'{work_dir}/', beast_prefix=tools["beast_prefix"], ms_prefix=tools["ms_prefix"])
+    return generate_admixture_networks(**params, ms_prefix=tools["ms_prefix"])
+
+def network_stage(params, inputs, work_dir, tools):
+    """
+    Picks a single (network, ms command) pair out of a generated batch.
+    """
+    return inputs["networks"][params["index"]]
+
+def ms_stage(params, inputs, work_dir, tools):
+    """
+    Simulates data for a network with ms.
+    """
+    return call_ms(inputs["network"][1])
+
+def input_stage(params, inputs, work_dir, tools):
+    """
+    Writes the input for one inference method, and returns its path.
+    """
+    method = params["method"]
+    options = params["options"]
+    if method == "gtmix":
+        write_GTmix_input(inputs["data"], f'{work_dir}/')
+        return f'{work_dir}/'
+    if method == "treemix":
+        write_TreeMix_input(inputs["data"], f'{work_dir}/input.gz')
+        return f'{work_dir}/input.gz'
+
+    nexus, taxa, taxon_map = build_bimarker_nexus(inputs["data"])
+    if method == "phylonet_mcmc_bimarkers":
+        input_str = build_MCMC_BiMarkers_input(nexus, taxa, taxon_map, **options, start_network=inputs.get("start"))
+    elif method == "phylonet_mle_bimarkers":
+        input_str = build_MLE_BiMarkers_input(nexus, taxon_map, **options, start_network=inputs.get("start"))
+    write_input(input_str, f'{work_dir}/input.nex')
+    return f'{work_dir}/input.nex'
+
+def infer_stage(params, inputs, work_dir, tools):
+    """
+    Runs one inference method on its input, and returns the inferred network.
+    """
+    method = params["method"]
+    options = params["options"]
+    if method == "gtmix":
+        return run_GTmix(inputs["input"], options["trees_per_locus"], options["admixture_count"], rent_prefix=tools["rent_prefix"], treepicker_prefix=tools["treepicker_prefix"], gtmix_prefix=tools["gtmix_prefix"], output=f'{work_dir}/optimal-network.gml', cache=tools.get("cache"))
+    if method == "treemix":
+        return run_TreeMix(inputs["input"], options["admixture_count"], options.get("outgroup"), options.get("snp_group_size"), output=f'{work_dir}/out_stem', treemix_prefix=tools["treemix_prefix"], cache=tools.get("cache"))
+    if options.get("shards", 1) > 1: # Split the restarts of MLE_BiMarkers across parallel PhyloNet jobs
+        return run_PhyloNet_sharded(inputs["input"], options["shards"], output=f'{work_dir}/output.txt', phylonet_prefix=tools["phylonet_prefix"], max_heap=options.get("max_heap"), cache=tools.get("cache"))
+    return run_PhyloNet(inputs["input"], output=f'{work_dir}/output.txt', phylonet_prefix=tools["phylonet_prefix"], max_heap=options.get("max_heap"), cache=tools.get("cache"))
+
+def distance_stage(params, inputs, work_dir, tools):
+    """
+    Computes the distance between an inferred network and the true network.
+    """
+    return compare_networks(inputs["inferred"], inputs["network"][0], method=params["compare_method"], phylonet_prefix=tools["compare_prefix"], cache=tools.get("cache"))
+
+def run_pipeline(store, config=None, tools=None):
+    """
+    Runs (or resumes) the whole experiment described by config in the artifact store directory store.
+    Returns a dictionary mapping each population count to a dictionary from methods to lists of distances, like summarize_results.
+    """
+    config = config if config is not None else DEFAULT_CONFIG
+    for stage in ["generate", "network", "ms", "distance"] + [f'{prefix}_{method}' for method in config["methods"] for prefix in ["input", "infer"]]:
+        os.makedirs(f'{store}/{stage}', exist_ok=True)
+
+    results = {}
+    for pop_count in config["pop_counts"]:
+        results[pop_count] = {method: [] for method in config["methods"]}
+
+        generate_params = dict(config["generate"], pop_count=pop_count, generator=config["generator"])
+        generate_key = run_stage(store, "generate", generate_stage, generate_params, tools=tools)
+
+        for i in range(config["generate"]["n"]):
+            network_key = run_stage(store, "network", network_stage, {"index": i}, {"networks": ("generate", generate_key)}, tools)
+            ms_key = run_stage(store, "ms", ms_stage, {}, {"network": ("network", network_key)}, tools)
+
+            infer_keys = {}
+            for method, options in sorted(config["methods"].items(), key=lambda item: "start_from" in item[1]): # Warm-started methods go last
+                input_upstream = {"data": ("ms", ms_key)}
+                if "start_from" in options:
+                    input_upstream["start"] = (f'infer_{options["start_from"]}', infer_keys[options["start_from"]])
+                tool = options.get("tool", method)
+                input_key = run_stage(store, f'input_{method}', input_stage, {"method": tool, "options": options["input"]}, input_upstream, tools)
+                infer_key = run_stage(store, f'infer_{method}', infer_stage, {"method": tool, "options": options["infer"]}, {"input": (f'input_{method}', input_key)}, tools)
+                infer_keys[method] = infer_key
+                distance_key = run_stage(store, "distance", distance_stage, {"compare_method": config["compare_method"]}, {"inferred": (f'infer_{method}', infer_key), "network": ("network", network_key)}, tools)
+                results[pop_count][method].append(load_artifact(store, "distance", distance_key))
+
+    return results
+
+if __name__ == "__main__":
+    # Usage: python pipeline.py <store directory> [config JSON file] [tools JSON file]
+    store = os.path.expanduser(sys.argv[1])
+    config = DEFAULT_CONFIG
+    if len(sys.argv) > 2:
+        with open(sys.argv[2]) as f:
+            config = json.load(f)
+    tools = DEFAULT_TOOLS
+    if len(sys.argv) > 3:
+        with open(sys.argv[3]) as f:
+            tools = dict(DEFAULT_TOOLS, **json.load(f))
+
+    print(run_pipeline(store, config, tools))
@@ -1,35 +1,68 @@
 import os
 import networkx as nx
+from tool_cache import cached_run, cache_key
+from runtime_history import record_runtime
+from jvm_admission import run_java_prefix
 
-def run_GTmix(directory, trees_per_locus, admixture_count, outgroup=None, max_trees=500, rent_prefix="java -jar RentPlus.jar", treepicker_prefix="./treepicker-linux64", gtmix_prefix="./gtmix-linux64", output="optimal-network.gml"):
+def GTmix_input_features(directory, trees_per_locus, admixture_count, max_trees=500):
+    """
+    Returns the numbers of loci and populations in a GTmix input directory, along with the run parameters, as features for the runtime history.
+    """
+    with open(f'{directory}/listPopInfo-all.txt') as f:
+        pop_count = sum(1 for line in f if line.strip() != "")
+    return {"loci": len(next(os.walk(directory))[1]), "pop_count": pop_count, "trees_per_locus": trees_per_locus, "admixture_count": admixture_count, "max_trees": max_trees}
+
+def haplotype_features(path):
+    """
+    Returns the numbers of haplotypes (taxa) and sites in a GTmix .hap file, for sizing RentPlus's heap.
+    """
+    with open(path) as f:
+        lines = [line for line in f if line.strip() != ""]
+    return {"taxa": len(lines) - 1, "sites": len(lines[0].split()) if len(lines) > 0 else 0}
+
+def run_GTmix(directory, trees_per_locus, admixture_count, outgroup=None, max_trees=500, rent_prefix="java -jar RentPlus.jar", treepicker_prefix="./treepicker-linux64", gtmix_prefix="./gtmix-linux64", output="optimal-network.gml", cache=None):
     """
     Runs GTmix on an input directory, and returns the network that it produces.
     Note that some of the command prefixes may have to be altered depending on your OS.
+    RentPlus runs under admission control (see jvm_admission.py), so that runs sharing a node never over-commit its memory.
+    If cache is a directory, identical runs (same executables, arguments, and haplotype files) are served from the tool cache instead (see tool_cache.py).
     """
-    # Initalize variables
-    subdir_count = len(next(os.walk(directory))[1])
-    all_chosen_trees = ""
+    def run():
+        with record_runtime("gtmix", GTmix_input_features(directory, trees_per_locus, admixture_count, max_trees)):
+            # Initalize variables
+            subdir_count = len(next(os.walk(directory))[1])
+            all_chosen_trees = ""
+
+            # Loop through locus directories, computing and selecting gene trees for each one
+            for i in range(subdir_count):
+                print(i)
+                run_java_prefix("rentplus", rent_prefix, [f'{directory}/{i}/locus-{i}.hap'], haplotype_features(f'{directory}/{i}/locus-{i}.hap'))
+                os.system(f'{treepicker_prefix} "{directory}/{i}/locus-{i}.hap.trees" "{directory}/{i}/locus-{i}.hap" {trees_per_locus} > "{directory}/{i}/locus-{i}.hap.trees.chosen"')
+                with open(f'{directory}/{i}/locus-{i}.hap.trees.chosen', 'r') as f:
+                    data = f.read()
+                    if not data.startswith("Can not open gene tree"):
+                        all_chosen_trees += data
+
+            # Write out all of the chosen trees to an input file
+            with open(f'{directory}/locus-all.trees.chosen', 'w') as f:
+                f.write(all_chosen_trees)
 
-    # Loop through locus directories, computing and selecting gene trees for each one
-    for i in range(subdir_count):
-        print(i)
-        os.system(f'{rent_prefix} "{directory}/{i}/locus-{i}.hap"')
-        os.system(f'{treepicker_prefix} "{directory}/{i}/locus-{i}.hap.trees" "{directory}/{i}/locus-{i}.hap" {trees_per_locus} > "{directory}/{i}/locus-{i}.hap.trees.chosen"')
-        with open(f'{directory}/{i}/locus-{i}.hap.trees.chosen', 'r') as f:
-            data = f.read()
-            if not data.startswith("Can not open gene tree"):
-                all_chosen_trees += data
+            # Call GTmix appropriately
+            if outgroup is None:
+                os.system(f'{gtmix_prefix} -n {admixture_count} -T {max_trees} -P {directory}/listPopInfo-all.txt -o {output} {directory}/locus-all.trees.chosen')
+            else:
+                os.system(f'{gtmix_prefix} -n {admixture_count} -T {max_trees} -P {directory}/listPopInfo-all.txt -o {output} -r {outgroup} {directory}/locus-all.trees.chosen')
 
-    # Write out all of the chosen trees to an input file
-    with open(f'{directory}/locus-all.trees.chosen', 'w') as f:
-        f.write(all_chosen_trees)
+        return parse_GTmix_output(output)
 
-    # Call GTmix appropriately
-    if outgroup is None:
-        os.system(f'{gtmix_prefix} -n {admixture_count} -T {max_trees} -P {directory}/listPopInfo-all.txt -o {output} {directory}/locus-all.trees.chosen')
-    else:
-        os.system(f'{gtmix_prefix} -n {admixture_count} -T {max_trees} -P {directory}/listPopInfo-all.txt -o {output} -r {outgroup} {directory}/locus-all.trees.chosen')
+    is_input = lambda path: path.endswith(".hap") or path == "listPopInfo-all.txt" # The other files in the directory are written by the run itself
+    key_function = lambda: cache_key("gtmix", [rent_prefix, treepicker_prefix, gtmix_prefix], [trees_per_locus, admixture_count, outgroup, max_trees], [directory], include=is_input)
+    return cached_run(cache, "gtmix", key_function, run, {"output": output})
 
+def parse_GTmix_output(output):
+    """
+    Reads the network that GTmix wrote to output, and converts it to the format used by the rest of the pipeline.
+    """
     # Read in output network
     inferred_network = nx.read_gml(output, label="id")
 
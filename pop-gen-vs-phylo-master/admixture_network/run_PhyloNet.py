@@ -1,5 +1,16 @@
 import os
+import re
+import subprocess
+import threading
+import time
+import collections
 from parse_rich_newick2 import parse_rich_newick
+from tool_cache import cached_run, cache_key
+from jvm_admission import run_java, phylonet_input_features
+from runtime_history import record_run, record_runtime, wait_measured
+from tool_threads import tool_pool
+
+SCORE_PATTERN = re.compile(r'(log probability|likelihood|extra lineages)\s*[:=]\s*(-?[0-9.]+(?:[Ee][-+]?[0-9]+)?)', re.IGNORECASE)
 
 def extract_network_string(file):
     """
@@ -24,16 +35,221 @@ def extract_network_string(file):
         return best_network # Ends up being the final best network, which is what we want
     return None
 
-def run_PhyloNet(file, output=None, phylonet_prefix="PhyloNet_3.8.2.jar", max_heap=None):
+def parse_float(string):
+    """
+    Returns a string's value as a float, or None if it is not a number.
+    """
+    try:
+        return float(string)
+    except ValueError:
+        return None
+
+def extract_network_candidates(file):
+    """
+    Given a PhyloNet output file, extracts every candidate network it reports, as a list of (score, Rich Newick string) pairs.
+    Candidates are read from "Likelihood : Topology : Full network string" blocks (the likelihood leads the line) and from
+    "Inferred Network #k:" entries (the score is taken from the log probability, likelihood, or extra lineage count reported after them).
+    The score is None when it cannot be found.
+    """
+    with open(file, "r") as f:
+        return network_candidates_from_lines(f)
+
+def network_candidates_from_lines(lines):
+    """
+    Same as extract_network_candidates, but for PhyloNet output that is already in memory as a list of lines.
+    """
+    candidates = []
+    lines = [line.strip() for line in lines]
+    for i, line in enumerate(lines[:-1]):
+        if line.startswith("Likelihood : Topology : Full network string"):
+            candidates.append((parse_float(lines[i + 1].split(":")[0].strip()), lines[i + 1].split("]")[-1]))
+        elif line.startswith("Inferred Network #"):
+            match = next((SCORE_PATTERN.search(x) for x in lines[i + 2:i + 4] if SCORE_PATTERN.search(x) is not None), None)
+            candidates.append((float(match.group(2)) if match is not None else None, lines[i + 1]))
+    return candidates
+
+def run_PhyloNet(file, output=None, phylonet_prefix="PhyloNet_3.8.2.jar", max_heap=None, cache=None):
     """
     Runs PhyloNet on an input file, and returns the network that it produces.
     Note that some of the command prefixes may have to be altered depending on your OS.
+    max_heap is a JVM heap size like "4g", or "auto" to size the heap from the input and wait for memory on the node (see jvm_admission.py).
+    If cache is a directory, identical runs (same jar and input file) are served from the tool cache instead (see tool_cache.py).
+    """
+    if output is None:
+        output = os.path.splitext(file)[0] + ".out"
+
+    def run():
+        features = phylonet_input_features(file)
+        with record_runtime(f'phylonet_{features["command"]}', features) as measured:
+            if max_heap == "auto": # The peak RSS goes to the admission ledger instead
+                run_java("phylonet", ["-jar", phylonet_prefix, file], features, output)
+            else:
+                measured["peak_rss_mb"] = wait_measured(subprocess.Popen(f'java{" -Xmx" + max_heap + " " if max_heap is not None else ""} -jar {phylonet_prefix} {file} > {output}', shell=True))
+        network_string = extract_network_string(output)
+        return parse_rich_newick(network_string)
+
+    return cached_run(cache, "phylonet", lambda: cache_key("phylonet", [f'java -jar {phylonet_prefix}'], [], [file]), run, {"output": output})
+
+def stop_process(process, grace=30):
+    """
+    Asks a process to exit (SIGTERM, which lets the JVM shut down cleanly), and kills it if it is still running after grace seconds.
+    """
+    process.terminate()
+    try:
+        process.wait(timeout=grace)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+    return
+
+def run_PhyloNet_streaming(file, on_line, output=None, phylonet_prefix="PhyloNet_3.8.2.jar", max_heap=None, timeout=None, grace=30):
+    """
+    Runs PhyloNet on an input file while watching its output: every line is written to output (as in run_PhyloNet) and passed to on_line
+    as soon as PhyloNet prints it. PhyloNet is stopped if on_line returns True, or once it has run for timeout seconds (if given).
+    Returns True if PhyloNet was stopped, and False if it finished. Only runs that finish are recorded in the runtime history.
+    """
+    if output is None:
+        output = os.path.splitext(file)[0] + ".out"
+
+    cmd = ["java"] + (["-Xmx" + max_heap] if max_heap is not None else []) + ["-jar", phylonet_prefix, file]
+    stopped = threading.Event()
+    start = time.perf_counter()
+    with open(output, "w") as f, subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True, bufsize=1) as process:
+        def stop():
+            stopped.set()
+            stop_process(process, grace)
+
+        timer = threading.Timer(timeout, stop) if timeout is not None else None
+        if timer is not None:
+            timer.daemon = True
+            timer.start()
+
+        for line in process.stdout: # Ends when PhyloNet exits or is stopped by the timer
+            f.write(line)
+            if on_line(line):
+                stop()
+                break
+
+        if timer is not None:
+            timer.cancel()
+        process.wait()
+    if not stopped.is_set():
+        features = phylonet_input_features(file)
+        record_run(f'phylonet_{features["command"]}', features, time.perf_counter() - start)
+    return stopped.is_set()
+
+def derive_seed(seed, shard):
+    """
+    Returns the seed for one shard of a run, derived from the run's seed so that sharded runs stay reproducible.
+    """
+    return (seed * 1000003 + shard) % 2 ** 31
+
+def shard_PhyloNet_input(input_str, shards, seed=None):
+    """
+    Splits the restarts (-mnr) of an MLE_BiMarkers input into up to shards inputs with the same total number of restarts, each with its own
+    seed (-sd) derived from seed, or from the input's own seed if seed is None.
+    InferNetwork_* inputs are not split: their commands take no seed, so every shard would repeat the same restarts. They, and inputs for
+    other commands, are returned unchanged, as a single shard.
+    """
+    command = re.search(r'^\s*(MLE_BiMarkers|InferNetwork_\w+)\b', input_str, re.MULTILINE)
+    if command is None:
+        return [input_str]
+    if command.group(1) != "MLE_BiMarkers":
+        if shards > 1:
+            print(f'{command.group(1)} takes no seed, so its restarts run as a single shard')
+        return [input_str]
+
+    runs_match = re.search(r'-mnr (\d+)', input_str)
+    runs = int(runs_match.group(1)) if runs_match is not None else 1
+    if seed is None:
+        seed_match = re.search(r'-sd (\d+)', input_str)
+        seed = int(seed_match.group(1)) if seed_match is not None else 12345678
+    counts = [runs // shards + (1 if k < runs % shards else 0) for k in range(min(shards, runs))]
+
+    shard_inputs = []
+    for k, count in enumerate(counts):
+        shard_str = input_str[:runs_match.start()] + f'-mnr {count}' + input_str[runs_match.end():] if runs_match is not None else input_str.replace("MLE_BiMarkers", f'MLE_BiMarkers -mnr {count}', 1)
+        if re.search(r'-sd \d+', shard_str) is not None:
+            shard_str = re.sub(r'-sd \d+', f'-sd {derive_seed(seed, k)}', shard_str, count=1)
+        else:
+            shard_str = shard_str.replace("MLE_BiMarkers", f'MLE_BiMarkers -sd {derive_seed(seed, k)}', 1)
+        shard_inputs.append(shard_str)
+    return shard_inputs
+
+def run_PhyloNet_sharded(file, shards, output=None, phylonet_prefix="PhyloNet_3.8.2.jar", max_heap=None, seed=None, max_workers=None, cache=None):
+    """
+    Runs the restarts of an MLE_BiMarkers input as up to shards independent PhyloNet jobs at once (see shard_PhyloNet_input),
+    then merges every candidate network the jobs report and returns the global best one, with its score in the graph attribute "likelihood".
+    Scores are maximized, except for InferNetwork_MP, which reports a number of extra lineages to be minimized.
+    Shard k reads {stem}.shard{k}.nex and writes {stem}.shard{k}.out, where stem is output without its extension.
+    """
+    if output is None:
+        output = os.path.splitext(file)[0] + ".out"
+    stem = os.path.splitext(output)[0]
+
+    with open(file, "r") as f:
+        input_str = f.read()
+    shard_inputs = shard_PhyloNet_input(input_str, shards, seed)
+    for k, shard_str in enumerate(shard_inputs):
+        with open(f'{stem}.shard{k}.nex', "w") as f:
+            f.write(shard_str)
+
+    def run(k):
+        run_PhyloNet(f'{stem}.shard{k}.nex', f'{stem}.shard{k}.out', phylonet_prefix, max_heap, cache)
+        return extract_network_candidates(f'{stem}.shard{k}.out')
+
+    with tool_pool(len(shard_inputs), max_workers if max_workers is not None else len(shard_inputs)) as executor:
+        candidates = [candidate for shard_candidates in executor.map(run, range(len(shard_inputs))) for candidate in shard_candidates]
+
+    best = best_candidate(candidates, input_str)
+    if best is None:
+        return None
+    network = parse_rich_newick(best[1])
+    network.graph["likelihood"] = best[0]
+    return network
+
+def best_candidate(candidates, input_str):
+    """
+    Returns the best (score, Rich Newick string) pair among the candidates of a PhyloNet input, or None if no candidate has a score.
+    Scores are maximized, except for InferNetwork_MP, which reports a number of extra lineages to be minimized.
+    """
+    sign = -1 if re.search(r'^\s*InferNetwork_MP\b', input_str, re.MULTILINE) is not None else 1
+    scored = [candidate for candidate in candidates if candidate[0] is not None]
+    return max(scored, key=lambda candidate: sign * candidate[0]) if len(scored) > 0 else None
+
+def run_PhyloNet_budgeted(file, budget, output=None, phylonet_prefix="PhyloNet_3.8.2.jar", max_heap=None, grace=30):
+    """
+    Runs PhyloNet on an input file for at most budget seconds, keeping the best candidate network it has reported so far (see
+    extract_network_candidates). Returns a (network, likelihood, truncated) tuple, where the network is the best scored candidate (including
+    the "Inferred Network" entries printed at the end of a finished run) and the likelihood is that network's score. A finished run without
+    scored candidates falls back to the network that run_PhyloNet would return, with a likelihood of None. network is None if there was no
+    candidate yet. Only MLE and InferNetwork_* runs report candidates as they go, so budgeted MCMC runs return None when they are stopped.
     """
     if output is None:
         output = os.path.splitext(file)[0] + ".out"
-    os.system(f'java{" -Xmx" + max_heap + " " if max_heap is not None else ""} -jar {phylonet_prefix} {file} > {output}')
-    network_string = extract_network_string(output)
-    return parse_rich_newick(network_string)
+    with open(file, "r") as f:
+        input_str = f.read()
+
+    recent = collections.deque(maxlen=4) # Enough output to hold a candidate and its score, so the whole output is never kept in memory
+    best = None
+
+    def on_line(line):
+        nonlocal best
+        recent.append(line)
+        best = best_candidate(([best] if best is not None else []) + network_candidates_from_lines(list(recent)), input_str)
+        return False
+
+    truncated = run_PhyloNet_streaming(file, on_line, output, phylonet_prefix, max_heap, timeout=budget, grace=grace)
+
+    if best is not None:
+        likelihood, network_string = best
+    elif not truncated:
+        likelihood, network_string = None, extract_network_string(output)
+    else:
+        return None, None, truncated
+    if network_string is None or network_string == "":
+        return None, None, truncated
+    return parse_rich_newick(network_string), likelihood, truncated
 
 if __name__ == "__main__":
     # test = run_PhyloNet("test.nex")
@@ -1,28 +1,161 @@
 import os
+import re
+import subprocess
+import numpy as np
 from skbio import DistanceMatrix
 from skbio.tree import nj
 from write_Structure import write_Structure
+from tool_threads import tool_pool
 import dendropy
 
+NUMBER = r'-?[0-9.]+(?:[Ee][-+]?[0-9]+)?'
+
 
 def run_Structure(params, dir=''):
+    """
+    Runs Structure on the input in {dir}Structure_input/ (with the command line parameters returned by write_Structure), and returns the
+    neighbor-joining tree of its net nucleotide distances between clusters as a Newick string.
+    """
     os.system(f'structure {params} -m {dir}Structure_input/mainparams -e {dir}Structure_input/extraparams -i {dir}Structure_input/structure_input.txt '
               f'-o {dir}Structure_input/structure_output')
 
-    pop_count = int(params.split()[3])
-    dists = []
-    ids = []
-
-    with open('Structure_input/structure_output_f') as outfile:
-        output = outfile.readlines()[37 + pop_count: 37 + 2 * pop_count]
-        for x in output:
-            csv = x.replace('-', '0').split()
-            ids.append(csv.pop(0))
-            dists.append([float(y) for y in csv])
+    result = parse_Structure_output(f'{dir}Structure_input/structure_output_f')
+    ids = [str(k) for k in range(1, len(result["net_distances"]) + 1)]
 
-    dm = DistanceMatrix(dists, ids)
+    dm = DistanceMatrix(result["net_distances"], ids)
     newick = nj(dm, result_constructor=str)
     print(nj(dm).ascii_art())
+    return newick
+
+def section_lines(lines, header):
+    """
+    Returns the lines that follow the first line containing header.
+    """
+    start = next((i for i, line in enumerate(lines) if header in line), None)
+    return lines[start + 1:] if start is not None else []
+
+def parse_Structure_output(path):
+    """
+    Parses a Structure output file (the one ending in _f) by its section headers rather than by line numbers. Returns a dictionary with
+    "ln_prob" (the estimated Ln Prob of Data), "mean_ln_likelihood", "variance_ln_likelihood", "K", "membership" (a populations x clusters
+    array of the proportion of each given population in each cluster), "net_distances" (the K x K array of net nucleotide distances between
+    clusters), "labels" (individual labels), and "ancestry" (the individuals x K Q-matrix; individuals whose ancestry Structure reports
+    relative to their given population, under USEPOPINFO, get a row of NaN).
+    """
+    with open(path) as f:
+        lines = [line.rstrip("\n") for line in f]
+    text = "\n".join(lines)
+
+    def statistic(name):
+        match = re.search(rf'{name}\s*=\s*({NUMBER})', text)
+        return float(match.group(1)) if match is not None else None
+
+    K = int(re.search(r'(\d+) populations assumed', text).group(1))
+
+    # Rows like "  0:     0.380  0.202  0.237  0.009  0.173        4"
+    membership = []
+    for line in section_lines(lines, "Proportion of membership"):
+        match = re.match(rf'\s*\S+:\s+((?:{NUMBER}\s+){{{K}}})\d+\s*$', line)
+        if match is not None:
+            membership.append([float(x) for x in match.group(1).split()])
+        elif line.startswith("-----") and len(membership) > 0:
+            break
+
+    # Rows like " 2   0.0435     -    0.0359 ...", where "-" is the diagonal
+    net_distances = []
+    for line in section_lines(lines, "Net nucleotide distance"):
+        words = line.split()
+        if len(words) == K + 1 and words[0] == str(len(net_distances) + 1):
+            net_distances.append([0.0 if x == "-" else float(x) for x in words[1:]])
+            if len(net_distances) == K:
+                break
+
+    # Rows like "  1      0.0    (0)    0 :  0.212 0.075 0.488 0.010 0.215     (0.032,0.384) ...", with or without the population column
+    labels = []
+    ancestry = []
+    for line in section_lines(lines, "Inferred ancestry of individuals"):
+        match = re.match(r'\s*\d+\s+(\S+)\s+\(\d+\)\s+(?:\S+\s+)?:\s+(.*)$', line)
+        if match is None:
+            if len(ancestry) > 0:
+                break
+            continue
+        q = re.split(r'[(|]', match.group(2))[0].split()
+        labels.append(match.group(1))
+        ancestry.append([float(x) for x in q] if len(q) == K else [np.nan] * K)
+
+    return {
+        "ln_prob": statistic("Estimated Ln Prob of Data"),
+        "mean_ln_likelihood": statistic("Mean value of ln likelihood"),
+        "variance_ln_likelihood": statistic("Variance of ln likelihood"),
+        "K": K,
+        "membership": np.array(membership),
+        "net_distances": np.array(net_distances),
+        "labels": labels,
+        "ancestry": np.array(ancestry).reshape(-1, K),
+    }
+
+def write_params(template, path, overrides):
+    """
+    Copies a Structure parameter file (mainparams or extraparams), replacing the values of the #define lines named in overrides.
+    """
+    with open(template) as f:
+        params = f.read()
+    for name, value in overrides.items():
+        params = re.sub(rf'^(#define\s+{name}\s+)\S+', rf'\g<1>{value}', params, flags=re.MULTILINE)
+    with open(path, "w") as f:
+        f.write(params)
+    return
+
+def run_Structure_sweep(params, K_values, replicates=1, dir='', output="structure_sweep", seed=12345, use_pop_info=False, max_workers=None, structure_prefix="structure"):
+    """
+    Runs Structure on the input in {dir}Structure_input/ (with the -L and -N of the command line parameters returned by write_Structure) for
+    every K in K_values, replicates times each. Replicate r uses the seed seed + r. The runs are independent, so they are executed
+    concurrently (at most max_workers at a time, by default one per available core), each in its own directory {output}/K{K}_r{r} with its own
+    copies of the parameter files, with prior population information only if use_pop_info (which needs K to be at least the number of populations).
+    Returns a list with one dictionary per run, holding its "K", "replicate", and "seed", and the parsed output (see parse_Structure_output).
+    A run that fails does not stop the others: it is reported, and its dictionary has "ln_prob" None and an "error" instead of the output.
+    """
+    loci = re.search(r'-L (\d+)', params).group(1)
+    individuals = re.search(r'-N (\d+)', params).group(1)
+    runs = [(K, r) for K in K_values for r in range(replicates)]
+
+    def run(K, replicate):
+        work_dir = f'{output}/K{K}_r{replicate}'
+        os.makedirs(work_dir, exist_ok=True)
+        write_params(f'{dir}Structure_input/mainparams', f'{work_dir}/mainparams', {})
+        write_params(f'{dir}Structure_input/extraparams', f'{work_dir}/extraparams', {"RANDOMIZE": 0, "SEED": seed + replicate, "USEPOPINFO": int(use_pop_info)}) # -D only takes effect without RANDOMIZE
+        with open(f'{work_dir}/log.txt', "w") as log:
+            returncode = subprocess.run(structure_prefix.split() + ["-K", str(K), "-L", loci, "-N", individuals, "-m", f'{work_dir}/mainparams', "-e", f'{work_dir}/extraparams',
+                            "-i", f'{dir}Structure_input/structure_input.txt', "-o", f'{work_dir}/structure_output', "-D", str(seed + replicate)], stdout=log, stderr=subprocess.STDOUT).returncode
+        if returncode != 0 or not os.path.exists(f'{work_dir}/structure_output_f'):
+            error = f'Structure exited with code {returncode} for K = {K}, replicate {replicate} (see {work_dir}/log.txt)'
+            print(error)
+            return {"K": K, "replicate": replicate, "seed": seed + replicate, "ln_prob": None, "error": error}
+        return dict(parse_Structure_output(f'{work_dir}/structure_output_f'), K=K, replicate=replicate, seed=seed + replicate)
+
+    with tool_pool(len(runs), max_workers) as executor:
+        return list(executor.map(lambda key: run(*key), runs))
+
+def summarize_Structure_sweep(runs):
+    """
+    Aggregates the likelihoods of a sweep for choosing K. Returns a dictionary mapping each K to the mean and standard deviation of
+    Ln Prob of Data over its replicates and Evanno's delta K (the mean over replicates of |L(K+1) - 2 L(K) + L(K-1)|, divided by sd L(K);
+    defined for interior K whose replicates vary), along with "best_K": the K with the largest delta K, or with the largest mean Ln Prob if
+    no delta K is defined.
+    """
+    K_values = sorted(set(run["K"] for run in runs))
+    ln_probs = {K: np.array([run["ln_prob"] for run in sorted(runs, key=lambda run: run["replicate"]) if run["K"] == K and run["ln_prob"] is not None]) for K in K_values}
+    summary = {K: {"mean_ln_prob": float(ln_probs[K].mean()), "sd_ln_prob": float(ln_probs[K].std(ddof=1)) if len(ln_probs[K]) > 1 else 0.0, "delta_K": None} for K in K_values if len(ln_probs[K]) > 0}
+
+    for previous, K, next_K in zip(K_values, K_values[1:], K_values[2:]):
+        lengths = set(len(ln_probs[k]) for k in (previous, K, next_K))
+        if next_K - K == K - previous == 1 and len(lengths) == 1 and lengths != {0} and summary[K]["sd_ln_prob"] > 0: # Replicates are paired by index
+            second_differences = np.abs(ln_probs[next_K] - 2 * ln_probs[K] + ln_probs[previous])
+            summary[K]["delta_K"] = float(second_differences.mean() / summary[K]["sd_ln_prob"])
+
+    with_delta = [K for K in summary if summary[K]["delta_K"] is not None]
+    best_K = max(with_delta, key=lambda K: summary[K]["delta_K"]) if len(with_delta) > 0 else max(summary, key=lambda K: summary[K]["mean_ln_prob"], default=None)
+    return {"K": summary, "best_K": best_K}
 
 def newick_to_nx(newick):
     '''
@@ -1,20 +1,72 @@
 import os
 import gzip
+import subprocess
 import networkx as nx
+from tool_cache import cached_run, cache_key
+from runtime_history import record_runtime, wait_measured
+from tool_threads import tool_pool
 
-def run_TreeMix(file, admixture_count, outgroup=None, snp_group_size=None, output="out_stem", treemix_prefix="treemix"):
+OUTPUT_SUFFIXES = ["vertices.gz", "edges.gz", "llik", "cov.gz", "covse.gz", "modelcov.gz", "treeout.gz"]
+
+def build_TreeMix_command(file, admixture_count, outgroup=None, snp_group_size=None, output="out_stem", treemix_prefix="treemix", bootstrap=False, seed=None):
     """
-    Runs TreeMix on an input file, and returns the network that it produces.
-    Note that some of the command prefixes may have to be altered depending on your OS.
+    Returns the command line for a single TreeMix run.
     """
-    # Run TreeMix with given parameters
     cmd = f'{treemix_prefix} -i {file} -o {output} -m {admixture_count} '
     if outgroup is not None:
         cmd += f'-root {outgroup} '
     if snp_group_size is not None:
         cmd += f'-k {snp_group_size} '
-    os.system(cmd)
-    
+    if bootstrap:
+        cmd += '-bootstrap '
+    if seed is not None:
+        cmd += f'-seed {seed} '
+    return cmd
+
+def TreeMix_input_features(file, admixture_count, snp_group_size=None, bootstrap=False):
+    """
+    Returns the numbers of populations and sites in a TreeMix input, along with the run parameters, as features for the runtime history.
+    """
+    with gzip.open(file, "rt") as f:
+        pop_count = len(f.readline().split())
+        sites = sum(1 for _ in f)
+    return {"pop_count": pop_count, "sites": sites, "admixture_count": admixture_count, "snp_group_size": snp_group_size if snp_group_size is not None else 1, "bootstrap": int(bootstrap)}
+
+def run_TreeMix_command(file, admixture_count, outgroup=None, snp_group_size=None, output="out_stem", treemix_prefix="treemix", bootstrap=False, seed=None, cache=None):
+    """
+    Runs TreeMix, leaving its output files at the stem output, and returns the network that it produces. If cache is a directory,
+    identical runs (same executable, arguments, and input file) restore the output files from the tool cache instead (see tool_cache.py).
+    """
+    def run():
+        with record_runtime("treemix", TreeMix_input_features(file, admixture_count, snp_group_size, bootstrap)) as measured:
+            measured["peak_rss_mb"] = wait_measured(subprocess.Popen(build_TreeMix_command(file, admixture_count, outgroup, snp_group_size, output, treemix_prefix, bootstrap, seed), shell=True))
+        return parse_TreeMix_output(output)
+
+    key_function = lambda: cache_key("treemix", [treemix_prefix], [admixture_count, outgroup, snp_group_size, bootstrap, seed], [file])
+    return cached_run(cache, "treemix", key_function, run, {suffix: f'{output}.{suffix}' for suffix in OUTPUT_SUFFIXES})
+
+def run_TreeMix(file, admixture_count, outgroup=None, snp_group_size=None, output="out_stem", treemix_prefix="treemix", cache=None):
+    """
+    Runs TreeMix on an input file, and returns the network that it produces.
+    Note that some of the command prefixes may have to be altered depending on your OS.
+    """
+    # Run TreeMix with given parameters
+    return run_TreeMix_command(file, admixture_count, outgroup, snp_group_size, output, treemix_prefix, cache=cache)
+
+def parse_TreeMix_likelihood(output):
+    """
+    Returns the final log likelihood that TreeMix reports in {output}.llik, or None if the file is missing.
+    """
+    if not os.path.exists(f'{output}.llik'):
+        return None
+    with open(f'{output}.llik') as f:
+        lines = [line for line in f if ":" in line]
+    return float(lines[-1].split(":")[-1]) if len(lines) > 0 else None # The last line is the likelihood after all migration events were added
+
+def parse_TreeMix_output(output):
+    """
+    Parses the graph that TreeMix wrote to {output}.vertices.gz and {output}.edges.gz into a network.
+    """
     # Parse output graph
     with gzip.open(f'{output}.vertices.gz', 'rt') as vertices_file, gzip.open(f'{output}.edges.gz', 'rt') as edges_file:
         # Initalize network
@@ -60,6 +112,28 @@ def run_TreeMix(file, admixture_count, outgroup=None, snp_group_size=None, outpu
 
     return network
 
+def run_TreeMix_sweep(file, max_admixture_count, replicates=0, outgroup=None, snp_group_size=None, output="sweep", treemix_prefix="treemix", seed=12345, max_workers=None, cache=None):
+    """
+    Runs TreeMix for every admixture count from 0 to max_admixture_count, once on the full data and once for each of a number of bootstrap replicates
+    (which resample blocks of snp_group_size SNPs, so snp_group_size should be given when replicates > 0). The runs are independent, so they are
+    executed concurrently (at most max_workers at a time, by default one per available core), each with its own output stem {output}_m{m}_r{r}.
+    Replicate r uses the seed seed + r. Returns a list with one dictionary per run, holding its "mix_count", "replicate" (0 for the full data),
+    "likelihood", and "network". A run that fails does not stop the others: its "network" and "likelihood" are None, and "error" says why.
+    """
+    runs = [(m, r) for m in range(max_admixture_count + 1) for r in range(replicates + 1)]
+
+    def run(mix_count, replicate):
+        stem = f'{output}_m{mix_count}_r{replicate}'
+        try:
+            network = run_TreeMix_command(file, mix_count, outgroup, snp_group_size, stem, treemix_prefix, bootstrap=replicate > 0, seed=seed + replicate, cache=cache)
+        except (OSError, EOFError, ValueError, IndexError) as e: # TreeMix failed, so its output is missing or incomplete
+            print(f'TreeMix failed for admixture count {mix_count}, replicate {replicate}: {e}')
+            return {"mix_count": mix_count, "replicate": replicate, "likelihood": None, "network": None, "error": str(e)}
+        return {"mix_count": mix_count, "replicate": replicate, "likelihood": parse_TreeMix_likelihood(stem), "network": network}
+
+    with tool_pool(len(runs), max_workers) as executor:
+        return list(executor.map(lambda key: run(*key), runs))
+
 if __name__ == "__main__":
     inferred_network = run_TreeMix("TreeMix_input.gz", 1, 5)
 
@@ -1,34 +1,204 @@
 import os
 import sys
-import pickle
-from run_GTmix import run_GTmix
-from run_PhyloNet import run_PhyloNet
-from run_TreeMix import run_TreeMix
+import json
+import traceback
+from multiprocessing import Process
+from run_GTmix import run_GTmix, GTmix_input_features
+from run_PhyloNet import run_PhyloNet, run_PhyloNet_budgeted
+from run_TreeMix import run_TreeMix, run_TreeMix_sweep, TreeMix_input_features
+from jvm_admission import phylonet_input_features
+from runtime_history import fit_cost_model, predict_seconds, balance_batches
+from network_archive import archive_path, write_network, read_network
+from write_PhyloNet_input import add_start_network, write_input
+from task_queue import queue_path, enqueue, run_worker, worker_name, queue_status
+from dataset_generation import read_index, flagged_datasets
 
-# $env:SLURM_PROCID = '0'
-rank = int(os.environ.get("SLURM_PROCID"))
+TASKS = ["gtmix", "treemix", "treemix_sweep", "phylonet_mcmc_bimarkers", "phylonet_mle_bimarkers", "phylonet_mle_bimarkers_warm"]
 
-task = sys.argv[1]
+PHYLONET_TASKS = ["phylonet_mcmc_bimarkers", "phylonet_mle_bimarkers", "phylonet_mle_bimarkers_warm"] # Skipped on datasets flagged by f_statistics.py
 
-base = sys.argv[2] if len(sys.argv) > 2 else "/home/ehs3/pop-gen-vs-phylo/data"
+PHYLONET_PREFIX = "/home/ehs3/pop-gen-vs-phylo/bin/phylonet/PhyloNet_3.8.2.jar"
 
-mix_count = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+BATCHES_NAME = "batches.json"
 
-n = int(sys.argv[4]) if len(sys.argv) > 4 else 1
-
-for i in range(rank * n, (rank + 1) * n):
-
-    print(f'Running with rank {rank} and task {task} on input {i} if input exists...')
+def run_PhyloNet_task(file, cache=None, budget=None):
+    """
+    Runs PhyloNet for a task. With a time budget in seconds (for jobs that could outlast their allocation), PhyloNet is stopped when the
+    budget runs out and the best network so far is kept, with graph attributes "likelihood" and "truncated". Raises an error if no network
+    was found, so that the task fails (and can be retried) instead of being recorded as done.
+    """
+    if budget is None:
+        network = run_PhyloNet(file, phylonet_prefix=PHYLONET_PREFIX, cache=cache)
+    else:
+        network, likelihood, truncated = run_PhyloNet_budgeted(file, float(budget), phylonet_prefix=PHYLONET_PREFIX)
+        if network is not None:
+            network.graph.update({"likelihood": likelihood, "truncated": truncated})
+    if network is None:
+        raise RuntimeError(f'PhyloNet found no network for {file}')
+    return network
 
+def run_task(task, base, i, mix_count=1, replicates=0, tag=0, cache=None, budget=None):
+    """
+    Runs a single inference task on input i of a data directory, and writes the inferred network(s) to the archive.
+    Raises FileNotFoundError if the input (or, for warm starts, the archived TreeMix network) does not exist, so that queued tasks fail
+    rather than being recorded as done.
+    tag distinguishes the scratch files of concurrent workers. cache is an optional tool cache directory, taken from $TOOL_CACHE by default,
+    and budget is an optional time limit in seconds for PhyloNet tasks, taken from $PHYLONET_BUDGET by default.
+    PhyloNet tasks are skipped on datasets that the f-statistics check flagged (see f_statistics.py), since they are not worth the CPU time.
+    """
+    cache = cache if cache is not None else os.environ.get("TOOL_CACHE") # Read at call time, so that changes after import take effect
+    budget = budget if budget is not None else os.environ.get("PHYLONET_BUDGET")
+    if task in PHYLONET_TASKS and i in flagged_datasets(base):
+        print(f'Skipping {task} on input {i} of {base}, which the f-statistics check flagged')
+        return
     if task == "gtmix" and os.path.exists(f'{base}/input/gtmix/{i}/'):
-        inferred_network = run_GTmix(f'{base}/input/gtmix/{i}/', 10, mix_count, treepicker_prefix="/home/ehs3/pop-gen-vs-phylo/bin/gtmix/treepicker", gtmix_prefix="/home/ehs3/pop-gen-vs-phylo/bin/gtmix/gtmix", rent_prefix="java -jar /home/ehs3/pop-gen-vs-phylo/bin/gtmix/RentPlus.jar", output=f'{base}/input/gtmix/{rank}/optimal-network.gml') # Be careful with the GTmix output file location
-        pickle.dump(inferred_network, open(f'{base}/output/gtmix/{i}.p', 'wb'))
+        inferred_network = run_GTmix(f'{base}/input/gtmix/{i}/', 10, mix_count, treepicker_prefix="/home/ehs3/pop-gen-vs-phylo/bin/gtmix/treepicker", gtmix_prefix="/home/ehs3/pop-gen-vs-phylo/bin/gtmix/gtmix", rent_prefix="java -jar /home/ehs3/pop-gen-vs-phylo/bin/gtmix/RentPlus.jar", output=f'{base}/input/gtmix/{i}/optimal-network.gml', cache=cache) # Written next to the input, so that concurrent workers never share it
+        write_network(archive_path(base), inferred_network, i, task, {"mix_count": mix_count})
     elif task == "treemix" and os.path.exists(f'{base}/input/treemix/{i}.gz'):
-        inferred_network = run_TreeMix(f'{base}/input/treemix/{i}.gz', mix_count, treemix_prefix="/home/ehs3/pop-gen-vs-phylo/bin/treemix/treemix", output=f'{base}/input/treemix/out_stem{rank}')
-        pickle.dump(inferred_network, open(f'{base}/output/treemix/{i}.p', 'wb'))
+        inferred_network = run_TreeMix(f'{base}/input/treemix/{i}.gz', mix_count, treemix_prefix="/home/ehs3/pop-gen-vs-phylo/bin/treemix/treemix", output=f'{base}/input/treemix/out_stem{tag}', cache=cache)
+        write_network(archive_path(base), inferred_network, i, task, {"mix_count": mix_count})
+    elif task == "treemix_sweep" and os.path.exists(f'{base}/input/treemix/{i}.gz'): # Runs every admixture count up to mix_count
+        sweep = run_TreeMix_sweep(f'{base}/input/treemix/{i}.gz', mix_count, replicates, snp_group_size=500 if replicates > 0 else None, treemix_prefix="/home/ehs3/pop-gen-vs-phylo/bin/treemix/treemix", output=f'{base}/input/treemix/sweep{tag}', cache=cache)
+        for run in sweep:
+            if run["network"] is None: # Failed, and reported by run_TreeMix_sweep; the other runs are still archived
+                continue
+            run["network"].graph["likelihood"] = run["likelihood"]
+            write_network(archive_path(base), run["network"], i, task, {"mix_count": run["mix_count"], "replicate": run["replicate"]})
     elif task == "phylonet_mcmc_bimarkers" and os.path.exists(f'{base}/input/phylonet_mcmc_bimarkers/{i}.nex'):
-        inferred_network = run_PhyloNet(f'{base}/input/phylonet_mcmc_bimarkers/{i}.nex', phylonet_prefix="/home/ehs3/pop-gen-vs-phylo/bin/phylonet/PhyloNet_3.8.2.jar")
-        pickle.dump(inferred_network, open(f'{base}/output/phylonet_mcmc_bimarkers/{i}.p', 'wb'))
+        inferred_network = run_PhyloNet_task(f'{base}/input/phylonet_mcmc_bimarkers/{i}.nex', cache) # MCMC reports no candidates as it goes, so a budget would only lose the run
+        write_network(archive_path(base), inferred_network, i, task)
     elif task == "phylonet_mle_bimarkers" and os.path.exists(f'{base}/input/phylonet_mle_bimarkers/{i}.nex'):
-        inferred_network = run_PhyloNet(f'{base}/input/phylonet_mle_bimarkers/{i}.nex', phylonet_prefix="/home/ehs3/pop-gen-vs-phylo/bin/phylonet/PhyloNet_3.8.2.jar")
-        pickle.dump(inferred_network, open(f'{base}/output/phylonet_mle_bimarkers/{i}.p', 'wb'))
\ No newline at end of file
+        inferred_network = run_PhyloNet_task(f'{base}/input/phylonet_mle_bimarkers/{i}.nex', cache, budget)
+        write_network(archive_path(base), inferred_network, i, task)
+    elif task == "phylonet_mle_bimarkers_warm" and os.path.exists(f'{base}/input/phylonet_mle_bimarkers/{i}.nex'): # Starts from the archived TreeMix network, so run treemix first
+        start_network = read_network(archive_path(base), i, "treemix", {"mix_count": mix_count})
+        if start_network is None:
+            raise FileNotFoundError(f'No archived treemix network with mix_count {mix_count} for input {i} of {base}')
+        with open(f'{base}/input/phylonet_mle_bimarkers/{i}.nex') as f:
+            write_input(add_start_network(f.read(), start_network), f'{base}/input/phylonet_mle_bimarkers/{i}.warm.nex')
+        inferred_network = run_PhyloNet_task(f'{base}/input/phylonet_mle_bimarkers/{i}.warm.nex', cache, budget)
+        write_network(archive_path(base), inferred_network, i, task, {"mix_count": mix_count})
+    elif task in TASKS:
+        raise FileNotFoundError(f'No {task} input {i} in {base}')
+    else:
+        raise ValueError(f'Unknown task {task}, expected one of {TASKS}')
+    return
+
+def task_cost_features(task, base, i, mix_count=1):
+    """
+    Returns the runtime history tool and features of a task on input i of a data directory, or None if the input does not exist.
+    """
+    if task == "gtmix" and os.path.exists(f'{base}/input/gtmix/{i}/'):
+        return "gtmix", GTmix_input_features(f'{base}/input/gtmix/{i}/', 10, mix_count)
+    if task == "treemix" and os.path.exists(f'{base}/input/treemix/{i}.gz'):
+        return "treemix", TreeMix_input_features(f'{base}/input/treemix/{i}.gz', mix_count)
+    if task in ["phylonet_mcmc_bimarkers", "phylonet_mle_bimarkers"] and os.path.exists(f'{base}/input/{task}/{i}.nex'):
+        features = phylonet_input_features(f'{base}/input/{task}/{i}.nex')
+        return f'phylonet_{features["command"]}', features
+    return None
+
+def project_task_costs(base, count, ranks, mix_count=1, tasks=("gtmix", "treemix", "phylonet_mcmc_bimarkers", "phylonet_mle_bimarkers")):
+    """
+    Predicts the runtime of each task on inputs 0 .. count - 1 from the runtime history (see runtime_history.py), prints each task's projected
+    CPU hours and the contiguous batches that give every rank the same expected wall time, and saves the batches in {base}/batches.json,
+    where the static split reads them when n is "auto". Tasks without any recorded runs are skipped.
+    """
+    batches = {}
+    for task in tasks:
+        inputs = [task_cost_features(task, base, i, mix_count) for i in range(count)]
+        models = {tool: fit_cost_model(tool) for tool in set(tool for tool, _ in filter(None, inputs))}
+        if len(models) == 0 or None in models.values():
+            print(f'{task}: no inputs or no runtime history yet')
+            continue
+        costs = [predict_seconds(models[input_features[0]], input_features[1]) if input_features is not None else 0 for input_features in inputs]
+        batches[task] = balance_batches(costs, ranks)
+        rank_hours = [sum(costs[start:end]) / 3600 for start, end in batches[task]]
+        print(f'{task}: {sum(costs) / 3600:.1f} CPU hours projected, {max(rank_hours):.1f} hours of wall time on {ranks} ranks')
+        print(f'    batches: {", ".join(f"{end - start}" for start, end in batches[task])}')
+    with open(f'{base}/{BATCHES_NAME}', "w") as f:
+        json.dump(batches, f)
+    return batches
+
+def run_queued_task(task, i, params, worker):
+    """
+    Adapter between run_worker and run_task.
+    """
+    run_task(task, params["base"], i, params.get("mix_count", 1), params.get("replicates", 0), worker.replace(":", "_"))
+
+def run_local_workers(base, processes):
+    """
+    Stands in for SLURM on a single machine: runs a number of queue workers as separate processes and waits for the queue to drain.
+    """
+    workers = [Process(target=run_worker, args=(queue_path(base), run_queued_task)) for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return
+
+if __name__ == "__main__":
+    # Usage:
+    #   python run_cluster_task.py <task> [base] [mix_count] [n] [replicates]           Static split: rank r runs inputs r*n .. (r+1)*n - 1
+    #                                                                                    (n = auto: the batches saved by project_task_costs,
+    #                                                                                    or an even split for tasks without batches)
+    #   python run_cluster_task.py enqueue <base> <task> <count> [mix_count] [replicates]  Queue a task for inputs 0 .. count - 1
+    #                                                                                    (PhyloNet tasks leave out datasets flagged by f_statistics.py)
+    #   python run_cluster_task.py worker <base> [processes]                              Pull tasks from the queue until it drains
+    # Queue workers can be started with srun (one per rank) or, on a single machine, as several local processes.
+
+    # $env:SLURM_PROCID = '0'
+    rank = int(os.environ.get("SLURM_PROCID", 0))
+
+    task = sys.argv[1]
+
+    base = sys.argv[2] if len(sys.argv) > 2 else "/home/ehs3/pop-gen-vs-phylo/data"
+
+    if task == "enqueue":
+        queued_task = sys.argv[3]
+        if queued_task not in TASKS:
+            sys.exit(f'Unknown task {queued_task}, expected one of {TASKS}')
+        count = int(sys.argv[4])
+        params = {"base": base, "mix_count": int(sys.argv[5]) if len(sys.argv) > 5 else 1, "replicates": int(sys.argv[6]) if len(sys.argv) > 6 else 0}
+        flagged = flagged_datasets(base) if queued_task in PHYLONET_TASKS else set()
+        added = enqueue(queue_path(base), queued_task, [i for i in range(count) if i not in flagged], params)
+        print(f'Queued {added} {queued_task} tasks, leaving out {len(flagged & set(range(count)))} flagged datasets: {queue_status(queue_path(base))}')
+    elif task == "worker":
+        processes = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+        if processes > 1:
+            run_local_workers(base, processes)
+        else:
+            completed = run_worker(queue_path(base), run_queued_task)
+            print(f'Worker {worker_name()} on rank {rank} completed {completed} tasks')
+    else:
+        mix_count = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+
+        n = sys.argv[4] if len(sys.argv) > 4 else "1"
+
+        replicates = int(sys.argv[5]) if len(sys.argv) > 5 else 0 # Bootstrap replicates per admixture count for treemix_sweep
+
+        batches = {}
+        if n == "auto" and os.path.exists(f'{base}/{BATCHES_NAME}'): # Batches of equal expected wall time, from write_cluster_data.py
+            with open(f'{base}/{BATCHES_NAME}') as f:
+                batches = json.load(f)
+        if n == "auto" and task in batches:
+            start, end = batches[task][rank]
+        elif n == "auto": # The task had no runtime history when the batches were planned, so split its inputs evenly across the ranks
+            ranks = int(os.environ.get("SLURM_NTASKS", 1))
+            count = len(read_index(base))
+            per_rank = -(-count // ranks)
+            start, end = min(rank * per_rank, count), min((rank + 1) * per_rank, count)
+            print(f'No planned batches for task {task}, so rank {rank} runs inputs {start} to {end - 1}')
+        else:
+            start, end = rank * int(n), (rank + 1) * int(n)
+
+        for i in range(start, end):
+
+            print(f'Running with rank {rank} and task {task} on input {i} if input exists...')
+
+            try:
+                run_task(task, base, i, mix_count, replicates, rank)
+            except FileNotFoundError as e: # The last rank's range can run past the end of the inputs
+                print(e)
+            except Exception: # A failed tool run, so move on to the rest of the rank's inputs (as queue workers do)
+                print(f'Rank {rank} failed on task {task} with input {i} of {base}')
+                traceback.print_exc()
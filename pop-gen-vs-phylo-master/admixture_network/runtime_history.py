@@ -0,0 +1,149 @@
+import os
+import sys
+import json
+import time
+import socket
+import sqlite3
+import numpy as np
+from contextlib import contextmanager
+
+# A local SQLite history of tool runtimes and peak memory, with a log-linear cost model for predicting the runtime of planned runs
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    tool TEXT NOT NULL,
+    features TEXT NOT NULL,
+    seconds REAL NOT NULL,
+    peak_rss_mb REAL,
+    host TEXT NOT NULL,
+    recorded REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_by_tool ON runs (tool);
+"""
+
+def open_history(path=None, timeout=600):
+    """
+    Opens a runtime history, creating it if necessary, and returns the SQLite connection to it. Without a path, this is $RUNTIME_HISTORY,
+    or ~/.runtime_history.sqlite.
+    """
+    path = path if path is not None else os.environ.get("RUNTIME_HISTORY", os.path.expanduser("~/.runtime_history.sqlite")) # Read at call time
+    connection = sqlite3.connect(path, timeout=timeout)
+    connection.executescript(SCHEMA)
+    return connection
+
+def numeric_features(params, prefix=""):
+    """
+    Flattens a (possibly nested) dictionary of parameters into a dictionary of its numeric values, with nested keys joined by dots.
+    """
+    features = {}
+    for name, value in params.items():
+        if isinstance(value, dict):
+            features.update(numeric_features(value, f'{prefix}{name}.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            features[f'{prefix}{name}'] = value
+    return features
+
+def record_run(tool, features, seconds, peak_rss_mb=None, path=None):
+    """
+    Appends a run to the history. Only the numeric features are kept. A history that cannot be written (e.g. a read-only home directory)
+    is skipped with a warning, since losing a record should never fail the run itself.
+    """
+    try:
+        connection = open_history(path)
+        with connection:
+            connection.execute("INSERT INTO runs (tool, features, seconds, peak_rss_mb, host, recorded) VALUES (?, ?, ?, ?, ?, ?)", (tool, json.dumps(numeric_features(features), sort_keys=True), seconds, peak_rss_mb, socket.gethostname(), time.time()))
+        connection.close()
+    except sqlite3.Error as e:
+        print(f'Could not record the runtime of {tool}: {e}')
+    return
+
+def wait_measured(process):
+    """
+    Waits for a subprocess.Popen process and returns its peak RSS in megabytes. This comes from os.wait4, so it covers just this process
+    (and the children it waited for, e.g. the tool started by a shell), not every child this process has ever waited for.
+    """
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status) # Tell Popen the process has already been reaped
+    return usage.ru_maxrss / 1024 # ru_maxrss is in kilobytes on Linux
+
+@contextmanager
+def record_runtime(tool, features, path=None):
+    """
+    Records the wall-clock time of the enclosed block as a run of tool, if the block finishes without raising. The block gets a dictionary
+    in which it can set "peak_rss_mb" (see wait_measured); otherwise the peak memory is left empty, since it cannot be attributed to the run.
+    """
+    run = {"peak_rss_mb": None}
+    start = time.perf_counter()
+    yield run
+    record_run(tool, features, time.perf_counter() - start, run["peak_rss_mb"], path)
+
+def load_runs(tool, path=None):
+    """
+    Returns the recorded runs of a tool as a list of (features, seconds) pairs.
+    """
+    connection = open_history(path)
+    runs = [(json.loads(features), seconds) for features, seconds in connection.execute("SELECT features, seconds FROM runs WHERE tool = ? AND seconds > 0", (tool,))]
+    connection.close()
+    return runs
+
+def design_matrix(model, feature_rows):
+    """
+    Returns the rows [1, log(1 + x_1), ..., log(1 + x_k)] of a cost model's features.
+    """
+    return np.array([[1.0] + [np.log1p(max(features.get(name, 0), 0)) for name in model["features"]] for features in feature_rows])
+
+def fit_cost_model(tool, path=None):
+    """
+    Fits log(seconds) = b_0 + sum_k b_k log(1 + x_k) by least squares to the recorded runs of a tool, using the features that every run has
+    and that vary between runs (with too few runs for all of them, only the mean is fitted). Returns None if the tool has no runs.
+    """
+    runs = load_runs(tool, path)
+    if len(runs) == 0:
+        return None
+    names = sorted(set.intersection(*(set(features) for features, _ in runs)))
+    names = [name for name in names if len(set(features[name] for features, _ in runs)) > 1]
+    model = {"tool": tool, "features": names if len(runs) >= len(names) + 2 else [], "runs": len(runs)}
+
+    X = design_matrix(model, [features for features, _ in runs])
+    y = np.log([seconds for _, seconds in runs])
+    coefficients, *_ = np.linalg.lstsq(X, y, rcond=None)
+    residuals = y - X @ coefficients
+    model["coefficients"] = coefficients.tolist()
+    model["sd"] = float(np.sqrt(residuals @ residuals / max(len(runs) - len(coefficients), 1)))
+    return model
+
+def predict_seconds(model, features):
+    """
+    Returns the expected runtime in seconds of a run with the given features. The log-normal correction exp(sd^2 / 2) makes this the mean
+    rather than the median, so that predictions add up to the expected total of a batch.
+    """
+    return float(np.exp(design_matrix(model, [numeric_features(features)])[0] @ np.array(model["coefficients"]) + model["sd"] ** 2 / 2))
+
+def balance_batches(costs, ranks):
+    """
+    Splits a list of per-input costs into ranks contiguous batches with roughly equal total cost, and returns their (start, end) index ranges.
+    Each batch ends at the input whose cumulative cost is closest to its share of the total (so with fewer inputs than ranks, some are empty).
+    """
+    if len(costs) == 0:
+        return [(0, 0)] * ranks
+    cumulative = np.cumsum(costs)
+    batches = []
+    start = 0
+    for rank in range(ranks - 1):
+        end = max(int(np.argmin(np.abs(cumulative - cumulative[-1] * (rank + 1) / ranks))) + 1, start)
+        batches.append((start, end))
+        start = end
+    batches.append((start, len(costs)))
+    return batches
+
+if __name__ == "__main__":
+    # Usage: python runtime_history.py [history path]
+    path = sys.argv[1] if len(sys.argv) > 1 else None
+    connection = open_history(path)
+    tools = [tool for (tool,) in connection.execute("SELECT DISTINCT tool FROM runs ORDER BY tool")]
+    connection.close()
+    for tool in tools:
+        model = fit_cost_model(tool, path)
+        terms = " + ".join(f'{b:.2f} log(1 + {name})' for name, b in zip(model["features"], model["coefficients"][1:]))
+        print(f'{tool}: {model["runs"]} runs, log seconds = {model["coefficients"][0]:.2f}{" + " + terms if terms != "" else ""} (sd {model["sd"]:.2f})')
@@ -0,0 +1,63 @@
+import numpy as np
+
+# Biallelic data compressed to its distinct site patterns, with multiplicities and a map from every site back to its pattern
+
+def locus_matrix(locus):
+    """
+    Returns the samples x sites 0/1 matrix of a locus in the format of call_ms.
+    """
+    haplotypes = [haplotype for population in locus[1] for haplotype in population]
+    site_count = len(haplotypes[0])
+    matrix = np.frombuffer("".join(haplotypes).encode(), dtype=np.uint8).reshape(len(haplotypes), site_count)
+    return matrix - ord("0")
+
+def compress_matrix(matrix, positions, pop_sizes, loci=None):
+    """
+    Compresses a samples x sites 0/1 matrix with the positions of its sites (and optionally the locus of each site).
+    """
+    patterns, inverse, counts = np.unique(matrix.T, axis=0, return_inverse=True, return_counts=True)
+    compressed = {"patterns": patterns.reshape(-1, matrix.shape[0]), "counts": counts, "inverse": inverse.reshape(-1), "positions": np.asarray(positions, dtype=float), "pop_sizes": list(pop_sizes)}
+    if loci is not None:
+        compressed["loci"] = np.asarray(loci)
+    return compressed
+
+def compress_locus(locus):
+    """
+    Compresses a locus in the format of call_ms.
+    """
+    return compress_matrix(locus_matrix(locus), locus[0], [len(population) for population in locus[1]])
+
+def compress_data(data):
+    """
+    Compresses a whole dataset in the format of call_ms (a sequence of loci), keeping the locus of every site so that analyses can still
+    group sites by locus (e.g. into jackknife blocks).
+    """
+    matrices = [locus_matrix(locus) for locus in data]
+    positions = np.concatenate([np.asarray(locus[0], dtype=float) for locus in data])
+    loci = np.concatenate([np.full(matrix.shape[1], i) for i, matrix in enumerate(matrices)])
+    return compress_matrix(np.concatenate(matrices, axis=1), positions, [len(population) for population in data[0][1]], loci)
+
+def pattern_allele_counts(compressed):
+    """
+    Returns the patterns x populations matrix of derived ("1") allele counts of each pattern in each population.
+    """
+    starts = np.cumsum([0] + compressed["pop_sizes"][:-1])
+    if len(compressed["patterns"]) == 0:
+        return np.zeros((0, len(starts)), dtype=int)
+    return np.add.reduceat(compressed["patterns"].astype(int), starts, axis=1)
+
+def site_allele_counts(compressed):
+    """
+    Returns the sites x populations matrix of derived allele counts, expanded from the per-pattern counts.
+    """
+    return pattern_allele_counts(compressed)[compressed["inverse"]]
+
+def expand_rows(compressed, separator=""):
+    """
+    Expands a compressed locus or dataset back into one string of alleles per sample, with separator written before every allele.
+    """
+    characters = compressed["patterns"][compressed["inverse"]].T.astype(np.uint8) + ord("0") # Samples x sites
+    if separator != "":
+        prefix = np.frombuffer(separator.encode(), dtype=np.uint8)
+        characters = np.concatenate([np.broadcast_to(prefix, characters.shape + prefix.shape), characters[:, :, np.newaxis]], axis=2).reshape(characters.shape[0], -1)
+    return [row.tobytes().decode() for row in characters]
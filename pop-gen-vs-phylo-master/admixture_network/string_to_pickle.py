@@ -3,15 +3,21 @@ import os
 import pickle
 import networkx as nx
 from parse_rich_newick2 import parse_rich_newick
+from network_archive import ARCHIVE_NAME, run_id_from_filename, write_network
 
 network_string = sys.argv[1]
 path = os.path.expanduser(sys.argv[2])
 
 network = parse_rich_newick(network_string)
 
-print(f'Dumping network {network_string} to path {path}...')
-
-pickle.dump(network, open(path, 'wb'))
+if path.endswith(ARCHIVE_NAME): # Usage with an archive: python string_to_pickle.py <network string> <archive path> <run id> <method>
+    run_id = run_id_from_filename(sys.argv[3])
+    method = sys.argv[4]
+    print(f'Writing network {network_string} to archive {path} as run {run_id} of method {method}...')
+    write_network(path, network, run_id, method)
+else:
+    print(f'Dumping network {network_string} to path {path}...')
+    pickle.dump(network, open(path, 'wb'))
 
 viz = nx.nx_pydot.to_pydot(network)
 print(viz)
@@ -1,27 +1,32 @@
 import sys
 import os
-import pickle
 import statistics
 from compare_PhyloNet import compare_networks
+from network_archive import archive_path, open_archive, read_networks
 
-def summarize_results(base_dir, compare_method="luay", phylonet_prefix="java -jar PhyloNet_3.8.2.jar"):
+def summarize_results(base_dir, compare_method="luay", phylonet_prefix="java -jar PhyloNet_3.8.2.jar", cache=None):
     """
     Given the path to a directory of results, outputs a dictionary where the keys are methods and the values are lists of distances.
+    Runs without an archived true network are skipped. Networks are read from the directory's network archive (use network_archive.py to migrate older directories of pickle files).
+    If cache is a tool cache directory, distances that were already computed are reused.
     """
     methods = ["gtmix", "phylonet_mcmc_bimarkers", "phylonet_mle_bimarkers", "treemix"]
 
     results = {method:[] for method in methods}
 
-    for method, method_data in results.items():
-        output_network_files = [f for f in os.listdir(f'{base_dir}/output/{method}') if os.path.isfile(f'{base_dir}/output/{method}/{f}')]
-
-        for output_network_file in output_network_files:
-            output_network = pickle.load(open(f'{base_dir}/output/{method}/{output_network_file}', "rb"))
-            input_network = pickle.load(open(f'{base_dir}/networks/{output_network_file}', "rb"))
+    archive = open_archive(archive_path(base_dir))
+    input_networks = {run_id: network for run_id, _, network in read_networks(archive, "true")}
 
-            distance = compare_networks(output_network, input_network, method=compare_method, phylonet_prefix=phylonet_prefix)
+    for method, method_data in results.items():
+        for run_id, _, output_network in read_networks(archive, method):
+            if run_id not in input_networks:
+                print(f'Skipping {method} run {run_id}, which has no true network')
+                continue
+            distance = compare_networks(output_network, input_networks[run_id], method=compare_method, phylonet_prefix=phylonet_prefix, cache=cache)
             method_data.append(distance)
 
+    archive.close()
+
     return results
 
 if __name__ == "__main__":
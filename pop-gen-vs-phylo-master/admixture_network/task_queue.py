@@ -0,0 +1,187 @@
+import os
+import sys
+import json
+import time
+import socket
+import sqlite3
+import threading
+import traceback
+from contextlib import contextmanager
+
+# A task queue in a SQLite file on the shared filesystem. Workers claim (task, input) pairs under leases that expire if the worker dies
+
+QUEUE_NAME = "queue.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    task TEXT NOT NULL,
+    input_id,
+    params TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    UNIQUE (task, input_id, params)
+);
+CREATE INDEX IF NOT EXISTS tasks_by_state ON tasks (state, id);
+"""
+
+def queue_path(base):
+    """
+    Returns the path of the task queue that belongs to a data directory.
+    """
+    return f'{base}/{QUEUE_NAME}'
+
+def open_queue(path, timeout=600):
+    """
+    Opens a task queue, creating it if necessary, and returns the SQLite connection to it.
+    timeout is the number of seconds to wait for other workers to release the database lock.
+    """
+    connection = sqlite3.connect(path, timeout=timeout)
+    connection.executescript(SCHEMA)
+    return connection
+
+def worker_name():
+    """
+    Returns a name for the current process that is unique across the nodes of a cluster.
+    """
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+def enqueue(queue, task, input_ids, params=None):
+    """
+    Adds a task for each input id to a queue (either a path or an open connection). Tasks that are already queued are left alone.
+    Returns the number of tasks added.
+    """
+    connection = open_queue(queue) if isinstance(queue, str) else queue
+    params = json.dumps(params if params is not None else {}, sort_keys=True)
+    with connection:
+        before = connection.total_changes
+        connection.executemany("INSERT OR IGNORE INTO tasks (task, input_id, params) VALUES (?, ?, ?)", ((task, i, params) for i in input_ids))
+        added = connection.total_changes - before
+    if isinstance(queue, str):
+        connection.close()
+    return added
+
+def requeue_expired(connection, now=None, max_attempts=3):
+    """
+    Puts running tasks whose lease has run out back into the pending state, or marks them failed (recording why, as fail does) if they have
+    already been attempted max_attempts times. Must be called inside a write transaction.
+    """
+    now = time.time() if now is None else now
+    connection.execute("UPDATE tasks SET state = 'failed', error = 'Lease of worker ' || worker || ' expired on attempt ' || attempts || ' (the worker died or was killed)', worker = NULL, lease_expires = NULL WHERE state = 'running' AND lease_expires < ? AND attempts >= ?", (now, max_attempts))
+    return connection.execute("UPDATE tasks SET state = 'pending', worker = NULL WHERE state = 'running' AND lease_expires < ?", (now,)).rowcount
+
+def claim(connection, worker, lease=600, max_attempts=3):
+    """
+    Atomically claims the oldest pending task for a worker, holding it for lease seconds.
+    Returns a (task_id, task, input_id, params) tuple, or None if there is nothing to claim.
+    """
+    with connection: # Commits on success, rolls back on error
+        connection.execute("BEGIN IMMEDIATE") # Take the write lock up front, so that no two workers can claim the same task
+        requeue_expired(connection, max_attempts=max_attempts)
+        row = connection.execute("SELECT id, task, input_id, params FROM tasks WHERE state = 'pending' ORDER BY id LIMIT 1").fetchone()
+        if row is None:
+            return None
+        connection.execute("UPDATE tasks SET state = 'running', worker = ?, lease_expires = ?, attempts = attempts + 1 WHERE id = ?", (worker, time.time() + lease, row[0]))
+    return row[0], row[1], row[2], json.loads(row[3])
+
+def heartbeat(connection, task_id, worker, lease=600):
+    """
+    Extends a worker's lease on a task. Returns False if the worker has lost the task (because its lease ran out and it was requeued).
+    """
+    with connection:
+        cursor = connection.execute("UPDATE tasks SET lease_expires = ? WHERE id = ? AND worker = ? AND state = 'running'", (time.time() + lease, task_id, worker))
+    return cursor.rowcount > 0
+
+def complete(connection, task_id, worker):
+    """
+    Marks a task as done.
+    """
+    with connection:
+        connection.execute("UPDATE tasks SET state = 'done', lease_expires = NULL, error = NULL WHERE id = ? AND worker = ?", (task_id, worker))
+    return
+
+def fail(connection, task_id, worker, error, max_attempts=3):
+    """
+    Records a failed attempt at a task. The task is put back in the queue unless it has already been attempted max_attempts times.
+    """
+    with connection:
+        connection.execute("UPDATE tasks SET state = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END, worker = NULL, lease_expires = NULL, error = ? WHERE id = ? AND worker = ?", (max_attempts, error, task_id, worker))
+    return
+
+@contextmanager
+def hold_lease(path, task_id, worker, lease=600):
+    """
+    Context manager that renews a worker's lease on a task from a background thread (with its own connection) every lease / 3 seconds.
+    Yields an event that is set if the lease is lost (because it ran out and the task went to another worker), after which it is not renewed.
+    """
+    stop = threading.Event()
+    lost = threading.Event()
+
+    def renew():
+        connection = open_queue(path)
+        while not stop.wait(lease / 3):
+            if not heartbeat(connection, task_id, worker, lease):
+                lost.set()
+                break
+        connection.close()
+
+    thread = threading.Thread(target=renew, daemon=True)
+    thread.start()
+    try:
+        yield lost
+    finally:
+        stop.set()
+        thread.join()
+
+def queue_status(queue):
+    """
+    Returns a dictionary with the number of tasks in each state.
+    """
+    connection = open_queue(queue) if isinstance(queue, str) else queue
+    counts = dict(connection.execute("SELECT state, COUNT(*) FROM tasks GROUP BY state").fetchall())
+    if isinstance(queue, str):
+        connection.close()
+    return counts
+
+def run_worker(path, run, worker=None, lease=600, poll_interval=10, max_attempts=3):
+    """
+    Claims and runs tasks from the queue at path until it drains. run is called as run(task, input_id, params, worker) for each task.
+    While other workers still hold tasks, the worker keeps polling so that it can pick up any of them whose lease runs out.
+    Returns the number of tasks this worker completed.
+    """
+    worker = worker_name() if worker is None else worker
+    connection = open_queue(path)
+
+    completed = 0
+    while True:
+        claimed = claim(connection, worker, lease, max_attempts)
+        if claimed is None:
+            if queue_status(connection).get("running", 0) == 0:
+                break
+            time.sleep(poll_interval)
+            continue
+
+        task_id, task, input_id, params = claimed
+        try:
+            with hold_lease(path, task_id, worker, lease) as lost:
+                run(task, input_id, params, worker)
+        except Exception:
+            print(f'Worker {worker} failed on task {task} with input {input_id}')
+            traceback.print_exc()
+            fail(connection, task_id, worker, traceback.format_exc(), max_attempts)
+        else:
+            if lost.is_set(): # Another worker has the task now, and its result is the one that counts
+                print(f'Worker {worker} lost its lease on task {task} with input {input_id}, so its result is not recorded')
+                continue
+            complete(connection, task_id, worker)
+            completed += 1
+
+    connection.close()
+    return completed
+
+if __name__ == "__main__":
+    # Usage: python task_queue.py <queue path>
+    print(queue_status(os.path.expanduser(sys.argv[1])))
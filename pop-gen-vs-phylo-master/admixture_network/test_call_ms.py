@@ -0,0 +1,38 @@
+import os
+import time
+import runtime_history
+from call_ms import iter_ms
+
+# A stand-in for ms that prints three loci of four haplotypes in two populations, and exits
+FAKE_MS = """#!/bin/sh
+echo "ms 4 3 -t 5 -r 5 1000 -I 2 2 2"
+echo "1 2 3"
+for i in 1 2 3; do
+    echo ""
+    echo "//"
+    echo "segsites: 2"
+    echo "positions: 0.1000 0.5000"
+    echo "01"; echo "10"; echo "11"; echo "00"
+done
+"""
+
+def fake_ms_command(tmp_path):
+    path = tmp_path / "ms"
+    path.write_text(FAKE_MS)
+    os.chmod(path, 0o755)
+    return f'{path} 4 3 -t 5 -r 5 1000 -I 2 2 2'
+
+def test_iter_ms_with_slow_consumer(tmp_path, monkeypatch):
+    monkeypatch.setenv("RUNTIME_HISTORY", str(tmp_path / "history.sqlite"))
+    loci = []
+    for locus in iter_ms(fake_ms_command(tmp_path)):
+        time.sleep(0.3) # ms exits while the consumer is still busy
+        loci.append(locus)
+    assert loci == [((0.1, 0.5), (("01", "10"), ("11", "00")))] * 3
+    assert runtime_history.load_runs("ms", str(tmp_path / "history.sqlite"))[0][0]["loci"] == 3
+
+def test_iter_ms_stopped_early(tmp_path, monkeypatch):
+    monkeypatch.setenv("RUNTIME_HISTORY", str(tmp_path / "history.sqlite"))
+    loci = iter_ms(fake_ms_command(tmp_path))
+    assert next(loci)[0] == (0.1, 0.5)
+    loci.close()
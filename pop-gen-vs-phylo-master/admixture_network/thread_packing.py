@@ -0,0 +1,127 @@
+import os
+import sys
+import glob
+import json
+import math
+import time
+import numpy as np
+from run_PhyloNet import run_PhyloNet
+from write_PhyloNet_input import set_PhyloNet_threads, write_input
+from tool_threads import available_cores
+
+# Picks the PhyloNet thread count per job for a node, from Amdahl's law fitted to timings of a sample input
+
+PLAN_NAME = "thread_plan.json"
+
+def measure_scaling(file, thread_counts=(1, 2, 4, 8), phylonet_prefix="PhyloNet_3.8.2.jar", max_heap=None):
+    """
+    Runs a PhyloNet input once at each thread count and returns a dictionary mapping thread counts to wall-clock seconds.
+    The input should be representative of the batch but small enough to run several times.
+    """
+    stem = os.path.splitext(file)[0]
+    with open(file) as f:
+        input_str = f.read()
+
+    timings = {}
+    for threads in thread_counts:
+        write_input(set_PhyloNet_threads(input_str, threads), f'{stem}.pl{threads}.nex')
+        start = time.perf_counter()
+        run_PhyloNet(f'{stem}.pl{threads}.nex', output=f'{stem}.pl{threads}.out', phylonet_prefix=phylonet_prefix, max_heap=max_heap)
+        timings[threads] = time.perf_counter() - start
+    return timings
+
+def fit_amdahl(timings):
+    """
+    Fits time = serial + parallel / threads to a dictionary of timings by least squares.
+    Returns the single-threaded time and the serial fraction (between 0 and 1) of the work.
+    """
+    threads = np.array(sorted(timings), dtype=float)
+    seconds = np.array([timings[t] for t in sorted(timings)], dtype=float)
+    if len(threads) == 1:
+        return float(seconds[0] * threads[0]), 0.0
+    (serial, parallel), *_ = np.linalg.lstsq(np.column_stack([np.ones_like(threads), 1 / threads]), seconds, rcond=None)
+    serial, parallel = max(serial, 0.0), max(parallel, 0.0)
+    if serial + parallel == 0:
+        return float(seconds.mean()), 0.0
+    return float(serial + parallel), float(serial / (serial + parallel))
+
+def job_seconds(single_thread_seconds, serial_fraction, threads):
+    """
+    Returns the predicted time of a job with the given number of threads.
+    """
+    return single_thread_seconds * (serial_fraction + (1 - serial_fraction) / threads)
+
+def plan_packing(job_count, cores, single_thread_seconds, serial_fraction, max_concurrent=None):
+    """
+    Chooses the threads per job and the number of concurrent jobs that minimize the time to finish job_count jobs on a node with the given
+    number of cores. max_concurrent optionally caps the concurrent jobs (e.g. by memory). Ties go to fewer threads, which waste fewer cycles.
+    Returns a dictionary with the threads, concurrent jobs, predicted makespan in seconds, and parallel efficiency of each job.
+    """
+    best = None
+    for threads in range(1, cores + 1):
+        concurrent = min(cores // threads, max(job_count, 1), max_concurrent if max_concurrent is not None else cores)
+        if concurrent == 0:
+            break
+        seconds = job_seconds(single_thread_seconds, serial_fraction, threads)
+        makespan = math.ceil(job_count / concurrent) * seconds
+        if best is None or makespan < best["makespan"] * (1 - 1e-9):
+            best = {"threads": threads, "concurrent": concurrent, "makespan": makespan, "efficiency": single_thread_seconds / (threads * seconds)}
+    return best
+
+def apply_plan(files, threads):
+    """
+    Rewrites the -pl flag of PhyloNet input files in place.
+    """
+    for file in files:
+        with open(file) as f:
+            input_str = f.read()
+        write_input(set_PhyloNet_threads(input_str, threads), file)
+    return
+
+def load_plans(base):
+    """
+    Returns the packing plans saved in a data directory, as a dictionary from tasks to plans.
+    """
+    if not os.path.exists(f'{base}/{PLAN_NAME}'):
+        return {}
+    with open(f'{base}/{PLAN_NAME}') as f:
+        return json.load(f)
+
+def load_plan(base, task):
+    """
+    Returns the packing plan saved for a task in a data directory, or None if there is none.
+    """
+    return load_plans(base).get(task)
+
+def save_plan(base, plan):
+    """
+    Saves a packing plan in a data directory, replacing any earlier plan for the same task.
+    """
+    plans = load_plans(base)
+    plans[plan["task"]] = plan
+    with open(f'{base}/{PLAN_NAME}', "w") as f:
+        json.dump(plans, f, indent=1)
+    return
+
+def pack_PhyloNet_inputs(base, sample, task="phylonet_mle_bimarkers", cores=None, thread_counts=(1, 2, 4, 8), phylonet_prefix="PhyloNet_3.8.2.jar", max_concurrent=None):
+    """
+    Measures how a sample input scales with threads, plans the packing of a task's inputs in a data directory onto a node, rewrites the
+    inputs' thread counts, and saves the plan. Returns the plan.
+    """
+    cores = cores if cores is not None else available_cores()
+    files = sorted(file for file in glob.glob(f'{base}/input/{task}/*.nex') if os.path.basename(file).count(".") == 1) # Skip warm-start and measurement copies
+    timings = measure_scaling(sample, [threads for threads in thread_counts if threads <= cores], phylonet_prefix)
+    single_thread_seconds, serial_fraction = fit_amdahl(timings)
+    plan = plan_packing(len(files), cores, single_thread_seconds, serial_fraction, max_concurrent)
+    plan.update({"task": task, "cores": cores, "jobs": len(files), "serial_fraction": serial_fraction, "single_thread_seconds": single_thread_seconds, "timings": timings})
+    apply_plan(files, plan["threads"])
+    save_plan(base, plan)
+    return plan
+
+if __name__ == "__main__":
+    # Usage: python thread_packing.py <base> <sample input> [task] [cores] [PhyloNet jar]
+    base = os.path.expanduser(sys.argv[1])
+    plan = pack_PhyloNet_inputs(base, sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else "phylonet_mle_bimarkers", int(sys.argv[4]) if len(sys.argv) > 4 else None, phylonet_prefix=sys.argv[5] if len(sys.argv) > 5 else "PhyloNet_3.8.2.jar")
+    print(f'Serial fraction {plan["serial_fraction"]:.2f}, {plan["single_thread_seconds"]:.0f} s single-threaded')
+    print(f'{plan["jobs"]} jobs on {plan["cores"]} cores: {plan["concurrent"]} at a time with {plan["threads"]} threads each ({plan["efficiency"]:.0%} efficient), about {plan["makespan"] / 3600:.1f} h')
+    print(f'Start the workers with: python run_cluster_task.py worker {base} {plan["concurrent"]}')
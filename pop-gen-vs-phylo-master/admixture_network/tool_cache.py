@@ -0,0 +1,230 @@
+import os
+import sys
+import json
+import time
+import pickle
+import shutil
+import sqlite3
+import hashlib
+
+# A content-addressed cache of external tool runs, keyed by the tool, its executables, its arguments, and its input files, with LRU eviction
+
+INDEX_NAME = "index.sqlite"
+
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    tool TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stats (
+    tool TEXT PRIMARY KEY,
+    hits INTEGER NOT NULL DEFAULT 0,
+    misses INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS entries_by_use ON entries (last_used);
+"""
+
+executable_digests = {} # Maps (path, size, mtime) to the digest of an executable, so that large jars are only hashed once per process
+
+def open_cache(directory, timeout=600):
+    """
+    Opens the index of a cache directory, creating both if necessary, and returns the SQLite connection to it.
+    """
+    os.makedirs(directory, exist_ok=True)
+    connection = sqlite3.connect(f'{directory}/{INDEX_NAME}', timeout=timeout)
+    connection.executescript(SCHEMA)
+    return connection
+
+def update_digest(digest, path):
+    """
+    Feeds the contents of a file into a hashlib digest.
+    """
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return
+
+def file_digest(path, include=None):
+    """
+    Returns the SHA-256 digest of a file, or of a directory tree (file names and contents, in sorted order).
+    For directories, include is an optional function of a file's relative path that selects which files count as input.
+    """
+    digest = hashlib.sha256()
+    if os.path.isdir(path):
+        for directory, subdirs, files in sorted(os.walk(path)):
+            subdirs.sort()
+            for name in sorted(files):
+                relative_path = os.path.relpath(os.path.join(directory, name), path)
+                if include is None or include(relative_path):
+                    digest.update(relative_path.encode() + b"\0")
+                    update_digest(digest, os.path.join(directory, name))
+    else:
+        update_digest(digest, path)
+    return digest.hexdigest()
+
+def executable_digest(prefix):
+    """
+    Returns a digest of the files named in a command prefix such as "java -jar PhyloNet_3.8.2.jar" or "/usr/bin/treemix",
+    so that upgrading a tool invalidates its cache entries. Words that are not files (or programs on the PATH) are hashed as text.
+    """
+    digest = hashlib.sha256()
+    for word in prefix.split():
+        path = word if os.path.isfile(word) else shutil.which(word)
+        if path is None:
+            digest.update(word.encode() + b"\0")
+            continue
+        stat = os.stat(path)
+        memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+        if memo_key not in executable_digests:
+            executable_digests[memo_key] = file_digest(path)
+        digest.update(executable_digests[memo_key].encode())
+    return digest.hexdigest()
+
+def cache_key(tool, prefixes, args, input_paths=(), input_data=(), include=None):
+    """
+    Returns the cache key for a tool run. prefixes are the command prefixes of the executables involved, args is a JSON-serializable
+    description of the arguments that affect the result, input_paths are input files or directories, and input_data are input strings.
+    """
+    description = {
+        "tool": tool,
+        "executables": [executable_digest(prefix) for prefix in prefixes],
+        "args": args,
+        "inputs": [file_digest(path, include) for path in input_paths],
+        "data": [hashlib.sha256(data.encode()).hexdigest() for data in input_data],
+    }
+    return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+def entry_path(directory, key):
+    """
+    Returns the path of the pickle file that holds a cache entry.
+    """
+    return f'{directory}/{key[:2]}/{key}.p'
+
+def record(connection, tool, hit):
+    """
+    Counts a hit or a miss for a tool.
+    """
+    column = "hits" if hit else "misses"
+    with connection:
+        connection.execute("INSERT OR IGNORE INTO stats (tool) VALUES (?)", (tool,))
+        connection.execute(f'UPDATE stats SET {column} = {column} + 1 WHERE tool = ?', (tool,))
+    return
+
+def lookup(directory, tool, key):
+    """
+    Returns the (result, raw) pair stored under a key, or None on a miss. Updates the hit/miss counts and the entry's last use.
+    """
+    connection = open_cache(directory)
+    entry = None
+    if connection.execute("SELECT 1 FROM entries WHERE key = ?", (key,)).fetchone() is not None:
+        try:
+            with open(entry_path(directory, key), "rb") as f:
+                entry = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError): # Evicted or damaged under us, so treat it as a miss
+            entry = None
+    if entry is not None:
+        with connection:
+            connection.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+    record(connection, tool, entry is not None)
+    connection.close()
+    return entry
+
+def store(directory, tool, key, result, raw, max_bytes=DEFAULT_MAX_BYTES):
+    """
+    Stores a result and its raw output files (a dictionary from names to bytes) under a key, then evicts the least recently used
+    entries until the cache holds at most max_bytes.
+    """
+    path = entry_path(directory, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, "wb") as f:
+        pickle.dump((result, raw), f)
+    os.replace(temp_path, path)
+
+    connection = open_cache(directory)
+    with connection:
+        now = time.time()
+        connection.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)", (key, tool, os.path.getsize(path), now, now))
+    evict(connection, directory, max_bytes)
+    connection.close()
+    return
+
+def evict(connection, directory, max_bytes):
+    """
+    Deletes least recently used entries until the total size of the cache is at most max_bytes.
+    """
+    with connection:
+        connection.execute("BEGIN IMMEDIATE")
+        total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        for key, size in connection.execute("SELECT key, size FROM entries ORDER BY last_used").fetchall():
+            if total <= max_bytes:
+                break
+            connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+            if os.path.exists(entry_path(directory, key)):
+                os.remove(entry_path(directory, key))
+            total -= size
+    return
+
+def read_outputs(paths):
+    """
+    Reads a dictionary from names to output file paths into a dictionary from names to file contents, skipping files that do not exist.
+    """
+    raw = {}
+    for name, path in paths.items():
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                raw[name] = f.read()
+    return raw
+
+def restore_outputs(raw, paths):
+    """
+    Inverse of read_outputs: writes cached file contents back to the given paths.
+    """
+    for name, contents in raw.items():
+        with open(paths[name], "wb") as f:
+            f.write(contents)
+    return
+
+def cached_run(cache, tool, key_function, run, output_paths, max_bytes=DEFAULT_MAX_BYTES):
+    """
+    Runs a tool through the cache. run() must run the tool and return its parsed result, after writing its output files to output_paths
+    (a dictionary from names to paths). On a hit, the cached output files are written back to output_paths and the cached result is returned.
+    key_function() returns the cache key, and is only called if cache (a directory) is not None, so that uncached runs pay nothing.
+    """
+    if cache is None:
+        return run()
+
+    key = key_function()
+    entry = lookup(cache, tool, key)
+    if entry is not None:
+        result, raw = entry
+        restore_outputs(raw, output_paths)
+        return result
+
+    result = run()
+    store(cache, tool, key, result, read_outputs(output_paths), max_bytes)
+    return result
+
+def cache_stats(cache):
+    """
+    Returns a dictionary mapping each tool to its hit and miss counts and the number and total size of its cached entries.
+    """
+    connection = open_cache(cache)
+    stats = {tool: {"hits": hits, "misses": misses, "entries": 0, "bytes": 0} for tool, hits, misses in connection.execute("SELECT tool, hits, misses FROM stats")}
+    for tool, entries, size in connection.execute("SELECT tool, COUNT(*), SUM(size) FROM entries GROUP BY tool"):
+        stats.setdefault(tool, {"hits": 0, "misses": 0})
+        stats[tool].update({"entries": entries, "bytes": size})
+    connection.close()
+    return stats
+
+if __name__ == "__main__":
+    # Usage: python tool_cache.py <cache directory>
+    for tool, tool_stats in sorted(cache_stats(os.path.expanduser(sys.argv[1])).items()):
+        lookups = tool_stats["hits"] + tool_stats["misses"]
+        hit_rate = tool_stats["hits"] / lookups if lookups > 0 else 0
+        print(f'{tool}: {tool_stats["hits"]} hits, {tool_stats["misses"]} misses ({hit_rate:.0%}), {tool_stats["entries"]} entries, {tool_stats["bytes"] / 1024 ** 2:.1f} MB')
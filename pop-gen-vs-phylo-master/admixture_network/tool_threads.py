@@ -0,0 +1,15 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+def available_cores():
+    """
+    Returns the number of cores this process may run on (which respects SLURM's CPU allocation, unlike os.cpu_count).
+    """
+    return len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+
+def tool_pool(run_count, max_workers=None):
+    """
+    Returns a thread pool for running external tools, with at most max_workers threads, or one per run or core by default.
+    Threads are enough, since the work happens in the tools' own processes.
+    """
+    return ThreadPoolExecutor(max_workers=max_workers if max_workers is not None else max(1, min(run_count, available_cores())))
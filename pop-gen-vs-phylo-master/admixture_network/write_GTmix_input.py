@@ -1,33 +1,33 @@
 import os
 from admixture_network import generate_admixture_networks
 from call_ms import call_ms
+from fan_out import fan_out
 
-def write_GTmix_input(data, path):
+def GTmix_sink(path):
     """
-    Given a data tuple returned by call_ms, writes out the GTmix input that corresponds to that data.
+    Returns a sink (see fan_out.py) that writes out the GTmix input for a stream of loci.
     path refers to the directory that will be filled with locus folders: it will be created if necessary.
     """
     if not os.path.exists(path):
         os.makedirs(path)
 
-    # Write out the population information file
-    with open(f'{path}/listPopInfo-all.txt', 'w') as info_file:
-        haplotype_counter = 1
-
-        # Iterate through the data for the first locus (assumes that all loci are similarly organized)
-        for population_id, population_haplotypes in enumerate(data[0][1], 1):
-            haplotype_str = " ".join([str(x) for x in range(haplotype_counter, haplotype_counter + len(population_haplotypes))])
-            haplotype_counter += len(population_haplotypes)
+    def add(locus_id, locus):
+        # Write out the population information file, based on the first locus (assumes that all loci are similarly organized)
+        if locus_id == 0:
+            with open(f'{path}/listPopInfo-all.txt', 'w') as info_file:
+                haplotype_counter = 1
+                for population_id, population_haplotypes in enumerate(locus[1], 1):
+                    haplotype_str = " ".join([str(x) for x in range(haplotype_counter, haplotype_counter + len(population_haplotypes))])
+                    haplotype_counter += len(population_haplotypes)
 
-            info_file.write(f'{population_id} {len(population_haplotypes)} {haplotype_str}\n')
+                    info_file.write(f'{population_id} {len(population_haplotypes)} {haplotype_str}\n')
 
-    # Write out the haplotype files for each locus
-    for locus_id, locus in enumerate(data):
+        # Write out the haplotype file for the locus
         locus_path = f'{path}/{locus_id}'
 
         if not os.path.exists(locus_path):
             os.makedirs(locus_path)
-        
+
         # Extract position information
         positions = locus[0]
 
@@ -41,6 +41,15 @@ def write_GTmix_input(data, path):
                 for haplotype in population_haplotypes:
                     haplotype_file.write(f'{haplotype}\n')
 
+    return {"add": add, "close": lambda: path}
+
+def write_GTmix_input(data, path):
+    """
+    Given a data tuple returned by call_ms, writes out the GTmix input that corresponds to that data.
+    path refers to the directory that will be filled with locus folders: it will be created if necessary.
+    """
+    fan_out(data, {"gtmix": GTmix_sink(path)})
+
 if __name__ == "__main__":
     import networkx as nx
     test_results = generate_admixture_networks(4, 1, 0.02, 0.3, 0.5, 4, 2, 50, 50, 500000, True, 1)
@@ -1,46 +1,83 @@
+import io
 import collections
 import os
 import re
+from write_rich_newick import write_networks_block
+from fan_out import fan_out
+from site_patterns import compress_locus, expand_rows
+from gene_tree_store import new_store, add_tree, write_weighted_trees_block
+
+# Flags that give each PhyloNet command a starting network, which must be defined in a NETWORKS block of the same file
+START_NETWORK_FLAGS = {
+    "MCMC_BiMarkers": "-snet",
+    "MLE_BiMarkers": "-snet",
+    "MCMC_SEQ": "-snet",
+    "MCMC_GT": "-snet",
+    "InferNetwork_MP": "-s",
+    "InferNetwork_ML": "-s",
+    "InferNetwork_MPL": "-s",
+}
+
+# A gene tree line of a TREES block, e.g. "Tree gt3 = [&W 0.432] ((1_1,2_1),3_1);", with its name, optional weight, and tree
+GENE_TREE_PATTERN = re.compile(r'^\s*Tree\s+(\S+)\s*=\s*(?:\[&W\s+([0-9.]+(?:[Ee][-+]?[0-9]+)?)\]\s*)?(\(.*;)', re.IGNORECASE | re.MULTILINE)
 
 # Eventually you should seperate out the MrBayes functions into another file
 
-def build_bimarker_nexus(data):
+def bimarker_sink():
     """
-    Given a data tuple returned from call_ms, returns a multiline string corrsponding to the NEXUS file format representation of that data.
-    Also returns the taxa and taxon map corresponding to the data.
+    Returns a sink (see fan_out.py) that builds the bimarker NEXUS matrix for a stream of loci. Since the matrix has one row per individual,
+    the loci are buffered (as site patterns, see site_patterns.py) until the stream ends, and only then expanded into the individuals' rows.
+    The sink's result is the same as that of build_bimarker_nexus.
     """
-    # data[locus][locations/haplotypes][population][individual]
+    taxa = []
+    taxon_map = collections.defaultdict(list)
+    rows = []
+    loci = []
+    nchar = 0
+
+    def add(locus_id, locus):
+        nonlocal nchar
+        # Record taxa and taxon_map from the first locus
+        if locus_id == 0:
+            for pop_idx in range(len(locus[1])):
+                for indiv_idx in range(len(locus[1][0])):
+                    taxon_str = f'I{pop_idx + 1}-{indiv_idx + 1}'
+                    taxa.append(taxon_str)
+                    taxon_map[pop_idx + 1].append(taxon_str)
+                    rows.append([taxon_str + " "])
 
-    # Count number of individuals, and total length of each individual's bitstrings
-    ntax = sum(len(x) for x in data[0][1])
-    nchar = sum(len(x[1][0][0]) for x in data)
+        loci.append(compress_locus(locus))
+        nchar += len(locus[1][0][0])
 
-    # Build the beginning of the string
-    nexus = (
-        f'#NEXUS\n'
-        f'Begin data;\n'
-        f'Dimensions ntax={ntax} nchar={nchar};\n'
-        f'Format datatype=dna symbols="012" missing=? gap=-;\n'
-        f'Matrix\n'
-    )
+    def close():
+        # Extend each individual's row with its bitstring for every locus
+        for compressed in loci:
+            for row, bits in zip(rows, expand_rows(compressed)):
+                row.append(bits)
 
-    taxa = []
-    taxon_map = collections.defaultdict(list)
+        nexus = (
+            f'#NEXUS\n'
+            f'Begin data;\n'
+            f'Dimensions ntax={len(taxa)} nchar={nchar};\n'
+            f'Format datatype=dna symbols="012" missing=? gap=-;\n'
+            f'Matrix\n'
+        )
+        nexus += "".join("".join(row) + "\n" for row in rows)
 
-    # Build data lines by iterating through loci, holding individuals constant; also records information in taxa and taxon_map
-    for pop_idx in range(len(data[0][1])):
-        for indiv_idx in range(len(data[0][1][0])):
-            taxon_str = f'I{pop_idx + 1}-{indiv_idx + 1} '
-            taxa.append(taxon_str.strip())
-            taxon_map[pop_idx + 1].append(taxon_str.strip())
-            for locus in data:
-                taxon_str += locus[1][pop_idx][indiv_idx]
-            nexus += taxon_str + "\n"
+        # Add the end of the NEXUS block
+        nexus += ";End;\n"
 
-    # Add the end of the NEXUS block
-    nexus += ";End;\n"
+        return nexus, taxa, dict(taxon_map)
+
+    return {"add": add, "close": close}
 
-    return nexus, taxa, dict(taxon_map)
+def build_bimarker_nexus(data):
+    """
+    Given a data tuple returned from call_ms, returns a multiline string corrsponding to the NEXUS file format representation of that data.
+    Also returns the taxa and taxon map corresponding to the data.
+    """
+    # data[locus][locations/haplotypes][population][individual]
+    return fan_out(data, {"nexus": bimarker_sink()})["nexus"]
 
 def PhyloNet_taxa_loci_string(taxa_or_loci):
     """
@@ -54,7 +91,7 @@ def PhyloNet_taxon_map_string(taxon_map):
     """
     return f'<{";".join(str(pop) + ":" + ",".join(lst) for pop, lst in taxon_map.items())}>'
 
-def build_MCMC_BiMarkers_input(nexus, taxa, taxon_map, max_reticulation=1, chain_length=500000, burn_in_length="200000", sample_freq=500, seed=12345678, threads=None):
+def build_MCMC_BiMarkers_input(nexus, taxa, taxon_map, max_reticulation=1, chain_length=500000, burn_in_length="200000", sample_freq=500, seed=12345678, threads=None, start_network=None):
     """
     Given the results of build_bimarker_nexus, returns a multiline string representing the MCMC_BiMarkers input corresponding to that data.
     """
@@ -77,9 +114,9 @@ def build_MCMC_BiMarkers_input(nexus, taxa, taxon_map, max_reticulation=1, chain
         f'END;\n'
     )
 
-    return input_str
+    return add_start_network(input_str, start_network) if start_network is not None else input_str
 
-def build_MLE_BiMarkers_input(nexus, taxon_map, max_reticulation=1, max_runs=100, max_examinations=50000, num_optimums=10, max_failures=50, pseudo=True, seed=12345678, threads=None):
+def build_MLE_BiMarkers_input(nexus, taxon_map, max_reticulation=1, max_runs=100, max_examinations=50000, num_optimums=10, max_failures=50, pseudo=True, seed=12345678, threads=None, start_network=None):
     """
     Given the results of build_bimarker_nexus, returns a multiline string representing the MLE_BiMarkers input corresponding to that data.
     """
@@ -96,7 +133,7 @@ def build_MLE_BiMarkers_input(nexus, taxon_map, max_reticulation=1, max_runs=100
         f'END;\n'
     )
 
-    return input_str
+    return add_start_network(input_str, start_network) if start_network is not None else input_str
 
 def build_alignment_nexus(data):
     """
@@ -139,7 +176,7 @@ def build_alignment_nexus(data):
 
     return nexus, loci, dict(taxon_map)
 
-def build_MCMC_SEQ_input(nexus, loci, taxon_map, max_reticulation=4, chain_length=10000000, burn_in_length=2000000, sample_freq=5000, seed=12345678, out_directory=None, threads=None):
+def build_MCMC_SEQ_input(nexus, loci, taxon_map, max_reticulation=4, chain_length=10000000, burn_in_length=2000000, sample_freq=5000, seed=12345678, out_directory=None, threads=None, start_network=None):
     """
     Given the results of build_alignment_nexus, returns a multiline string representing the MCMC_SEQ input corresponding to that data.
     """
@@ -156,18 +193,40 @@ def build_MCMC_SEQ_input(nexus, loci, taxon_map, max_reticulation=4, chain_lengt
     # Build the rest of the input based on the given parameters
     input_str += (
         f'BEGIN PHYLONET;\n'
-        f'MCMC_SEQ -cl {chain_length} -bl {burn_in_length} -sf {sample_freq} -mr {max_reticulation}{" -pl "+ str(threads) if threads is not None else ""} -sd {seed} -tm {taxon_map_string}{" -pl "+ str(threads) if threads is not None else ""}{" -dir "+ out_directory if out_directory is not None else ""};\n'
+        f'MCMC_SEQ -cl {chain_length} -bl {burn_in_length} -sf {sample_freq} -mr {max_reticulation}{" -pl "+ str(threads) if threads is not None else ""} -sd {seed} -tm {taxon_map_string}{" -dir "+ out_directory if out_directory is not None else ""};\n'
         f'END;\n'
     )
 
-    return input_str
+    return add_start_network(input_str, start_network) if start_network is not None else input_str
 
-def build_InferNetwork_helper(command, nexus, taxon_map, loci_spec_string, max_reticulation, runs, threads):
+def deduplicate_gene_trees(nexus, loci_spec_string):
+    """
+    Given a TREES block and its loci spec string (as returned by run_MrBayes), merges the trees of each locus that share a rooted topology
+    into one tree whose "[&W w]" weight is their share of the locus's total weight (see gene_tree_store.py). Returns the smaller TREES block
+    and its loci spec string. Trees without a weight count once. Branch lengths are dropped, since the builders below only use topologies.
+    """
+    trees = GENE_TREE_PATTERN.findall(nexus)
+    locus_of = {}
+    for locus, (start, stop) in enumerate(re.findall(r'\{\s*gt(\d+)\s*-\s*gt(\d+)\s*\}', loci_spec_string)):
+        locus_of.update({f'gt{k}': locus for k in range(int(start), int(stop) + 1)})
+
+    taxa = sorted(set(re.findall(r'[(,]\s*([^\s(),:;\[]+)', " ".join(tree for _, _, tree in trees))))
+    store = new_store(taxa)
+    for name, weight, tree in trees:
+        add_tree(store, locus_of[name], tree, float(weight) if weight != "" else 1.0)
+
+    out = io.StringIO()
+    loci_spec_string = write_weighted_trees_block(store, out)
+    return out.getvalue(), loci_spec_string
+
+def build_InferNetwork_helper(command, nexus, taxon_map, loci_spec_string, max_reticulation, runs, threads, start_network=None, deduplicate=False):
     """
     Given the results of build_alignment_nexus (taxon_map) and run_MrBayes (nexus, loci_spec_string), returns a multiline string representing the InferNetwork input corresponding 
-    to that data and the specified command.
+    to that data and the specified command. With deduplicate, repeated gene trees are merged into weighted trees first (see deduplicate_gene_trees).
     """
     # Use the NEXUS file as a starting point
+    if deduplicate:
+        nexus, loci_spec_string = deduplicate_gene_trees(nexus, loci_spec_string)
     input_str = nexus
 
     # Convert taxon_map to string
@@ -180,35 +239,37 @@ def build_InferNetwork_helper(command, nexus, taxon_map, loci_spec_string, max_r
         f'END;\n'
     )
 
-    return input_str
+    return add_start_network(input_str, start_network) if start_network is not None else input_str
 
-def build_InferNetwork_MP_input(nexus, taxon_map, loci_spec_string, max_reticulation=1, runs=5, threads=1):
+def build_InferNetwork_MP_input(nexus, taxon_map, loci_spec_string, max_reticulation=1, runs=5, threads=1, start_network=None, deduplicate=False):
     """
     Given the results of build_alignment_nexus (taxon_map) and run_MrBayes (nexus, loci_spec_string), returns a multiline string representing the InferNetwork_MP input corresponding 
     to that data.
     """
-    return build_InferNetwork_helper("InferNetwork_MP", nexus, taxon_map, loci_spec_string, max_reticulation, runs, threads)
+    return build_InferNetwork_helper("InferNetwork_MP", nexus, taxon_map, loci_spec_string, max_reticulation, runs, threads, start_network, deduplicate)
 
-def build_InferNetwork_ML_input(nexus, taxon_map, loci_spec_string, max_reticulation=1, runs=5, threads=1):
+def build_InferNetwork_ML_input(nexus, taxon_map, loci_spec_string, max_reticulation=1, runs=5, threads=1, start_network=None, deduplicate=False):
     """
     Given the results of build_alignment_nexus (taxon_map) and run_MrBayes (nexus, loci_spec_string), returns a multiline string representing the InferNetwork_ML input corresponding 
     to that data.
     """
-    return build_InferNetwork_helper("InferNetwork_ML", nexus, taxon_map, loci_spec_string, max_reticulation, runs, threads)
+    return build_InferNetwork_helper("InferNetwork_ML", nexus, taxon_map, loci_spec_string, max_reticulation, runs, threads, start_network, deduplicate)
 
-def build_InferNetwork_MPL_input(nexus, taxon_map, loci_spec_string, max_reticulation=1, runs=5, threads=1):
+def build_InferNetwork_MPL_input(nexus, taxon_map, loci_spec_string, max_reticulation=1, runs=5, threads=1, start_network=None, deduplicate=False):
     """
     Given the results of build_alignment_nexus (taxon_map) and run_MrBayes (nexus, loci_spec_string), returns a multiline string representing the InferNetwork_MPL input corresponding 
     to that data.
     """
-    return build_InferNetwork_helper("InferNetwork_MPL", nexus, taxon_map, loci_spec_string, max_reticulation, runs, threads)
+    return build_InferNetwork_helper("InferNetwork_MPL", nexus, taxon_map, loci_spec_string, max_reticulation, runs, threads, start_network, deduplicate)
 
-def build_MCMC_GT_input(nexus, taxon_map, loci_spec_string, max_reticulation=None, chain_length=1100000, burn_in_length=100000, sample_freq=1000, seed=12345678, pseudo=False, threads=1):
+def build_MCMC_GT_input(nexus, taxon_map, loci_spec_string, max_reticulation=None, chain_length=1100000, burn_in_length=100000, sample_freq=1000, seed=12345678, pseudo=False, threads=1, start_network=None, deduplicate=False):
     """
     Given the results of build_alignment_nexus (taxon_map) and run_MrBayes (nexus, loci_spec_string), returns a multiline string representing the MCMC_GT input corresponding 
-    to that data.
+    to that data. With deduplicate, repeated gene trees are merged into weighted trees first (see deduplicate_gene_trees).
     """
     # Use the NEXUS file as a starting point
+    if deduplicate:
+        nexus, loci_spec_string = deduplicate_gene_trees(nexus, loci_spec_string)
     input_str = nexus
 
     # Convert taxon_map to string
@@ -221,7 +282,32 @@ def build_MCMC_GT_input(nexus, taxon_map, loci_spec_string, max_reticulation=Non
         f'END;\n'
     )
 
-    return input_str
+    return add_start_network(input_str, start_network) if start_network is not None else input_str
+
+def add_start_network(input_str, network, name="startnet"):
+    """
+    Returns a copy of a PhyloNet input in which the command starts its search from the given network (for example one inferred by TreeMix or
+    GTmix). The network's topology is added in a NETWORKS block under the given name, and the command's starting network flag refers to it.
+    Only the topology is used, since branch lengths from other methods are not on PhyloNet's scale.
+    """
+    command = re.search(rf'^({"|".join(START_NETWORK_FLAGS)})\b', input_str, re.MULTILINE)
+    if command is None:
+        return input_str
+    networks_block = write_networks_block([network], names=[name], edge_data=False)
+    end = re.compile(r';[ \t]*\n').search(input_str, command.end()).start() # Options go after the positional arguments, so add the flag at the end (semicolons inside taxon maps are not followed by a newline)
+    input_str = input_str[:end] + f' {START_NETWORK_FLAGS[command.group(1)]} {name}' + input_str[end:]
+    return input_str.replace('BEGIN PHYLONET;\n', networks_block + 'BEGIN PHYLONET;\n', 1)
+
+def set_PhyloNet_threads(input_str, threads):
+    """
+    Returns a copy of a PhyloNet input whose command runs with the given number of threads (-pl), replacing the thread count it had, if any.
+    """
+    command = re.search(rf'^({"|".join(START_NETWORK_FLAGS)})\b', input_str, re.MULTILINE)
+    if command is None:
+        return input_str
+    end = re.compile(r';[ \t]*\n').search(input_str, command.end()).start()
+    arguments = re.sub(r' -pl \d+', "", input_str[command.end():end])
+    return input_str[:command.end()] + arguments + f' -pl {threads}' + input_str[end:]
 
 def write_input(input_str, file):
     """
@@ -276,11 +362,11 @@ if __name__ == "__main__":
     # Run MrBayes on input
     trees_nexus, trees_loci_spec = run_MrBayes("MrBayes\\test.nex", ".\mb.exe", 50)
 
-    # Generate gene tree PhyloNet inputs
-    InferNetwork_MP_input = build_InferNetwork_MP_input(trees_nexus, alignment_taxon_map, trees_loci_spec)
-    InferNetwork_ML_input = build_InferNetwork_ML_input(trees_nexus, alignment_taxon_map, trees_loci_spec)
-    InferNetwork_MPL_input = build_InferNetwork_MPL_input(trees_nexus, alignment_taxon_map, trees_loci_spec)
-    MCMC_GT_input = build_MCMC_GT_input(trees_nexus, alignment_taxon_map, trees_loci_spec)
+    # Generate gene tree PhyloNet inputs, with each locus's repeated topologies merged into weighted trees
+    InferNetwork_MP_input = build_InferNetwork_MP_input(trees_nexus, alignment_taxon_map, trees_loci_spec, deduplicate=True)
+    InferNetwork_ML_input = build_InferNetwork_ML_input(trees_nexus, alignment_taxon_map, trees_loci_spec, deduplicate=True)
+    InferNetwork_MPL_input = build_InferNetwork_MPL_input(trees_nexus, alignment_taxon_map, trees_loci_spec, deduplicate=True)
+    MCMC_GT_input = build_MCMC_GT_input(trees_nexus, alignment_taxon_map, trees_loci_spec, deduplicate=True)
 
     # Write out test PhyloNet inputs
     write_input(MCMC_BiMarkers_input, "test_inputs/MCMC_BiMarkers_input.nex")
@@ -1,41 +1,56 @@
 import os
+from fan_out import fan_out
+from site_patterns import compress_locus, expand_rows
 
-def write_Structure(data, use_pop_data, dir='Structure_input'):
+def Structure_sink(use_pop_data, dir='Structure_input'):
     """
-    sets up the command for running structure and also prepares the necessary data files
-    takes in data, and boolean use_pop_data
-    returns run command
+    sink (see fan_out.py) version of write_Structure, for a stream of loci
+    loci are buffered as site patterns (see site_patterns.py) until the stream ends, and expanded into each individual's data line as the input file is written
+    the sink's result is the run command, as returned by write_Structure
     """
-    #a dictionary (no values at the moment). may be useful if expanding functionality to construct mainparams ground-up
-    #param = {"MAXPOPS" , "BURNIN", "NUMREPS", "INFILE", "OUTFILE", "NUMINDS", "NUMLOCI", "PLOIDY", "MISSING", "ONEROWPERIND", "LABEL", "POPDATA", "POPFLAG", "LOCDATA", "PHENOTYPE", "EXTRACOLS", "MARKERNAMES", "RECESSIVEALLELES", "MAPDISTANCES", "PHASED", "MARKOVPHASE", "NOTAMBIGUOUS"}
+    if not os.path.exists(dir):
+        os.makedirs(dir)
 
-    # if not os.path.exists(dir):
-    #     os.makedirs(dir)
+    lines = []
+    loci = []
+    counts = {"snps": 0, "pop_count": 0, "ind_count": 0}
 
-    #get relevant information for specific run
-    loci_count = len(data)
-    snps = sum([len(loc[1][0][0]) for loc in data])
-    pop_count = len(data[0][1])
-    ind_count = len(data[0][1][0])
-    #initialize with variable porameters command
+    def add(locus_id, locus):
+        if locus_id == 0:
+            counts["pop_count"] = len(locus[1])
+            counts["ind_count"] = len(locus[1][0])
+            for pop in range(counts["pop_count"]):
+                for indiv in range(counts["ind_count"]):
+                    line = [f'{pop}.{indiv}'] #initialize data line
+                    if use_pop_data: #option to not specify population may be useful (see Structure documentation)
+                        line.append(f' {pop} {1}')
+                    lines.append(line)
 
-    with open(f'{dir}/structure_input.txt', 'w') as input:
+        counts["snps"] += len(locus[1][0][0])
+        loci.append(compress_locus(locus))
 
-        for pop in range(pop_count):
-            for indiv in range (ind_count):
-                input.write(f'{pop}.{indiv}') #initialize data line
-                if use_pop_data: #option to not specify population may be useful (see Structure documentation)
-                    input.write(f' {pop} {1}')
+    def close():
+        for compressed in loci:
+            for line, codes in zip(lines, expand_rows(compressed, separator=" ")): #biallelic coding, as in code_alleles
+                line.append(codes)
+        with open(f'{dir}/structure_input.txt', 'w') as input:
+            for line in lines:
+                input.write("".join(line) + '\n')
+        return f'-L {counts["snps"]} -K {counts["pop_count"]} -N {counts["ind_count"]*counts["pop_count"]}'
 
-                for locus in data:
-                    codes = code_alleles(locus[1][pop][indiv])
-                    for code in codes:
-                        input.write(f' {code}')
-                input.write('\n')
+    return {"add": add, "close": close}
 
-    var_inst = f'-L {snps} -K {pop_count} -N {ind_count*pop_count}'
+def write_Structure(data, use_pop_data, dir='Structure_input'):
+    """
+    sets up the command for running structure and also prepares the necessary data files
+    takes in data, and boolean use_pop_data
+    writes the input to dir (created if necessary), so separate datasets can be kept in separate directories
+    returns run command
+    """
+    #a dictionary (no values at the moment). may be useful if expanding functionality to construct mainparams ground-up
+    #param = {"MAXPOPS" , "BURNIN", "NUMREPS", "INFILE", "OUTFILE", "NUMINDS", "NUMLOCI", "PLOIDY", "MISSING", "ONEROWPERIND", "LABEL", "POPDATA", "POPFLAG", "LOCDATA", "PHENOTYPE", "EXTRACOLS", "MARKERNAMES", "RECESSIVEALLELES", "MAPDISTANCES", "PHASED", "MARKOVPHASE", "NOTAMBIGUOUS"}
 
-    return var_inst
+    return fan_out(data, {"structure": Structure_sink(use_pop_data, dir)})["structure"]
 
 def code_alleles(hap):
     """
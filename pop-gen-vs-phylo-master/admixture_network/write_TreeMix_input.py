@@ -2,29 +2,38 @@ import os
 import gzip
 from admixture_network import generate_admixture_networks
 from call_ms import call_ms
+from fan_out import fan_out
+from site_patterns import compress_locus, pattern_allele_counts
+
+def TreeMix_sink(path):
+    """
+    Returns a sink (see fan_out.py) that writes out the TreeMix input for a stream of loci, one SNP line at a time.
+    Allele counts are computed once per distinct site pattern of each locus (see site_patterns.py), and repeated for each of its sites.
+    """
+    f = gzip.open(path, "wt") # File must be gzipped!
+
+    def add(locus_id, locus):
+        # Count populations and alleles per population, and write the first line of the file based on the population count
+        pop_count = len(locus[1])
+        alleles_per_pop = len(locus[1][0])
+        if locus_id == 0:
+            f.write(" ".join(str(x) for x in range(1, pop_count + 1)) + "\n")
+
+        compressed = compress_locus(locus)
+        pattern_lines = ["".join(f"{count},{alleles_per_pop - count} " for count in counts) + "\n" for counts in pattern_allele_counts(compressed)] # Subtract to find the complement
+        f.write("".join(pattern_lines[j] for j in compressed["inverse"])) # Write SNP lines
+
+    def close():
+        f.close()
+        return path
+
+    return {"add": add, "close": close}
 
 def write_TreeMix_input(data, path):
     """
     Given a data tuple returned by call_ms, writes out the TreeMix input that corresponds to that data.
     """
-    # with open(path, "w") as f:
-    with gzip.open(path, "wt") as f: # File must be gzipped!
-        # Count populations, and write the first line of the file based on this count
-        pop_count = len(data[0][1])
-        f.write(" ".join(str(x) for x in range(1, pop_count + 1)) + "\n")
-
-        # Count alleles per population
-        alleles_per_pop = len(data[0][1][0])
-
-        for locus in data: # Iterate through loci
-            haplotype_length = len(locus[1][0][0]) # Sample access: [1][population][member]
-            for snp_idx in range(haplotype_length): # Iterate through SNP positions
-                line = ""
-                for pop_idx in range(pop_count): # Iterate through populations, building up a line for the SNP
-                    # Count 1's at a given SNP position for this population
-                    count = sum(int(locus[1][pop_idx][allele_idx][snp_idx]) for allele_idx in range(alleles_per_pop))
-                    line += f"{count},{alleles_per_pop - count} " # Subtract to find the complement
-                f.write(line + "\n") # Write SNP line
+    fan_out(data, {"treemix": TreeMix_sink(path)})
 
 if __name__ == "__main__":
     import networkx as nx
@@ -1,11 +1,11 @@
-import pickle
 import os
 import sys
 from admixture_network import generate_admixture_networks, generate_BirthHybrid_networks, generate_BirthHybrid_networks_admixture_target
-from call_ms import call_ms
-from write_GTmix_input import write_GTmix_input
-from write_TreeMix_input import write_TreeMix_input
-from write_PhyloNet_input import write_input, build_bimarker_nexus, build_MCMC_BiMarkers_input, build_MLE_BiMarkers_input
+from network_archive import archive_path, write_network
+from dataset_generation import index_path, read_index, log_index, planned_batch_size, ms_seeds, seeded_command, generate_datasets
+from thread_packing import load_plan
+from tool_threads import available_cores
+from run_cluster_task import project_task_costs
 
 def create_dir(path):
     """
@@ -20,35 +20,40 @@ def create_dir(path):
 base = sys.argv[1]
 
 # Build directory structure
-top_level = ["generation_work", "input", "networks", "output"]
+top_level = ["generation_work", "input"]
 methods = ["gtmix", "treemix", "phylonet_mcmc_bimarkers", "phylonet_mle_bimarkers"]
 for name in top_level:
     create_dir(base + "/" + name)
 for name in methods:
     create_dir(base + "/input/" + name)
-    create_dir(base + "/output/" + name)
 
 count = 2
 
-# networks = [list(x) for x in generate_admixture_networks(4, 1, 0.02, 0.3, 0.5, 4, 2, 50, 50, 500000, True, count)]
-# networks = [list(x) for x in generate_BirthHybrid_networks_admixture_target(50, 7, 3, 1, 2, 50, 50, 500000, work_path=f'{base}/generation_work/', beast_prefix="/home/ehs3/pop-gen-vs-phylo/bin/beast/bin/beast")]
-networks = [list(x) for x in generate_BirthHybrid_networks_admixture_target(10, int(sys.argv[2]), 6, 1, 50, 50, 50, 500000, hybrid_rate=3, work_path=f'{base}/generation_work/', beast_prefix="/home/ehs3/pop-gen-vs-phylo/bin/beast/bin/beast", ms_prefix="/home/ehs3/pop-gen-vs-phylo/bin/ms/ms")]
-
-networks = [x + [call_ms(x[1])] for x in networks] # Will have to be changed for gene trees
-
-for i, network_data in enumerate(networks):
-    # Save network using pickle
-    pickle.dump(network_data[0], open(f'{base}/networks/{i}.p', 'wb'))
-
-    # Write GTmix input
-    write_GTmix_input(network_data[2], f'{base}/input/gtmix/{i}/')
-
-    # Write TreeMix input
-    write_TreeMix_input(network_data[2], f'{base}/input/treemix/{i}.gz')
-
-    # Write PhyloNet input
-    bimarker_nexus, bimarker_taxa, bimarker_taxon_map = build_bimarker_nexus(network_data[2])
-    MCMC_BiMarkers_input = build_MCMC_BiMarkers_input(bimarker_nexus, bimarker_taxa, bimarker_taxon_map, max_reticulation=int(sys.argv[2]))
-    MLE_BiMarkers_input = build_MLE_BiMarkers_input(bimarker_nexus, bimarker_taxon_map, max_reticulation=int(sys.argv[2]))
-    write_input(MCMC_BiMarkers_input, f'{base}/input/phylonet_mcmc_bimarkers/{i}.nex')
-    write_input(MLE_BiMarkers_input, f'{base}/input/phylonet_mle_bimarkers/{i}.nex')
\ No newline at end of file
+# Generate the networks, unless an interrupted batch is being resumed (its networks and ms commands are already in the dataset index)
+# Each network is saved to the archive before it is logged, so that every indexed network can be found there, and the batch marker is
+# logged last, so that a batch whose planning was interrupted is generated again from scratch
+seed = int(os.environ.get("DATASET_SEED", 1))
+if planned_batch_size(base) is None:
+    if os.path.exists(index_path(base)):
+        print(f'The batch in {base} was not fully planned, so its networks are generated again')
+        os.remove(index_path(base))
+    # networks = [list(x) for x in generate_admixture_networks(4, 1, 0.02, 0.3, 0.5, 4, 2, 50, 50, 500000, True, count)]
+    # networks = [list(x) for x in generate_BirthHybrid_networks_admixture_target(50, 7, 3, 1, 2, 50, 50, 500000, work_path=f'{base}/generation_work/', beast_prefix="/home/ehs3/pop-gen-vs-phylo/bin/beast/bin/beast")]
+    networks = [list(x) for x in generate_BirthHybrid_networks_admixture_target(10, int(sys.argv[2]), 6, 1, 50, 50, 50, 500000, hybrid_rate=3, work_path=f'{base}/generation_work/', beast_prefix="/home/ehs3/pop-gen-vs-phylo/bin/beast/bin/beast", ms_prefix="/home/ehs3/pop-gen-vs-phylo/bin/ms/ms")]
+    for i, (network, cmd) in enumerate(networks):
+        write_network(archive_path(base), network, i, "true")
+        log_index(base, {"id": i, "cmd": seeded_command(cmd, ms_seeds(seed, i)), "status": "planned"})
+    log_index(base, {"batch": "planned", "networks": len(networks)})
+
+# Threads per PhyloNet job, from the packing plans made by thread_packing.py for an earlier batch (if any)
+MCMC_BiMarkers_plan = load_plan(base, "phylonet_mcmc_bimarkers")
+MLE_BiMarkers_plan = load_plan(base, "phylonet_mle_bimarkers")
+
+# Simulate and write the datasets that are not yet complete, in parallel
+# With $TARGET_SNPS, each dataset stops at that many segregating sites, and the ms commands' locus counts are only upper bounds
+target_snps = int(os.environ["TARGET_SNPS"]) if "TARGET_SNPS" in os.environ else None
+generate_datasets(base, int(sys.argv[2]), MCMC_threads=MCMC_BiMarkers_plan["threads"] if MCMC_BiMarkers_plan is not None else None, MLE_threads=MLE_BiMarkers_plan["threads"] if MLE_BiMarkers_plan is not None else None, max_workers=available_cores(), target_snps=target_snps)
+
+# Project the cost of inference from the runtime history, and suggest per-rank batches (run them with n = auto in run_cluster_task.py)
+ranks = int(sys.argv[3]) if len(sys.argv) > 3 else int(os.environ.get("SLURM_NTASKS", 1))
+project_task_costs(base, len(read_index(base)), ranks, mix_count=int(sys.argv[2]))
@@ -1,3 +1,4 @@
+import io
 import networkx as nx
 import copy
 
@@ -21,23 +22,12 @@ def format_edge_data(data):
 
     return data_string
 
-def write_rich_newick_helper(network, node, parent):
+def format_node(network, node, parent, edge_data=True):
     """
-    Recursive helper function for write_rich_newick.
+    Helper function that returns the label and edge data that follow a node's child list in a Rich Newick string.
     """
-    # Call recursively to get child Rich Newick strings, unless we are revisiting an admixture node
-    child_strings = []
-    if "skip_children" not in network.nodes[node]:
-        for child in network.neighbors(node):
-            child_strings.append(write_rich_newick_helper(network, child, node))
-
-    # Form this node's string out of the child strings
-    if len(child_strings) > 0:
-        output = '(' + ",".join(child_strings) + ')'
-    else:
-        output = ''
-
     # Add node label to string
+    output = ''
     node_type = network.nodes[node]["type"]
     if node_type in ["leaf", "outgroup"]:
         output += str(network.nodes[node]["population"])
@@ -45,10 +35,9 @@ def write_rich_newick_helper(network, node, parent):
         output += "I" + str(node)
     elif node_type == "admixture":
         output += "I" + str(node) + "#H" + str(node)
-        network.nodes[node]["skip_children"] = True
 
     # Add edge data to string (specific keys might need to be tweaked here)
-    if node_type != "root":
+    if node_type != "root" and edge_data:
         length = network.edges[parent, node].get("length")
         support = network.edges[parent, node].get("support")
         if node_type == "admixture":
@@ -63,19 +52,77 @@ def write_rich_newick_helper(network, node, parent):
 
     return output
 
-def write_rich_newick(network):
+def leaf_sort_key(network, node):
     """
-    Given a properly formatted NetworkX DiGraph as an input, returns the Rich Newick string correpsonding to it.
+    Returns a sort key for a leaf's population label that works for both integer and string labels.
     """
-    root = next(node for node, attrs in network.nodes.items() if attrs["type"] == "root")
+    population = network.nodes[node].get("population")
+    return (isinstance(population, str), population if population is not None else 0)
 
-    output = write_rich_newick_helper(network, root, None) + ";"
+def canonical_child_order(network):
+    """
+    Returns a dictionary mapping each node to its children, sorted by the smallest leaf label below each child (ties are broken by node id),
+    so that the written string does not depend on the order in which edges were added.
+    """
+    smallest_leaf = {}
+    for node in reversed(list(nx.topological_sort(network))):
+        children = list(network.neighbors(node))
+        smallest_leaf[node] = min(smallest_leaf[child] for child in children) if len(children) > 0 else leaf_sort_key(network, node)
+    return {node: sorted(network.neighbors(node), key=lambda child: (smallest_leaf[child], str(child))) for node in network.nodes}
 
-    for attrs in network.nodes.values():
-        if "skip_children" in attrs:
-            attrs.pop("skip_children")
+def write_rich_newick(network, root=None, canonical=False, edge_data=True):
+    """
+    Given a properly formatted NetworkX DiGraph as an input, returns the Rich Newick string correpsonding to it.
+    Works iteratively and never modifies the network, so it is safe to call on networks that are shared between threads.
+    The root is found by scanning the nodes unless it is given. If canonical is set, children are written in canonical_child_order instead of
+    edge insertion order. If edge_data is not set, lengths, support values, and probabilities are left out, leaving just the topology.
+    """
+    if root is None:
+        root = next(node for node, attrs in network.nodes.items() if attrs["type"] == "root")
+
+    child_order = canonical_child_order(network) if canonical else None
+    expanded = set() # Admixture nodes whose children have already been written, so that revisits only write their label
+
+    def children(node):
+        if node in expanded:
+            return []
+        return child_order[node] if child_order is not None else list(network.neighbors(node))
+
+    # Each frame holds a node, its parent, its children, the index of the next child to visit, and the strings of the children visited so far
+    stack = [(root, None, children(root), [0], [])]
+    while True:
+        node, parent, node_children, next_child, child_strings = stack[-1]
+        if next_child[0] < len(node_children): # Descend into the next child
+            child = node_children[next_child[0]]
+            next_child[0] += 1
+            stack.append((child, node, children(child), [0], []))
+            continue
+
+        # All children are done, so form this node's string out of the child strings
+        stack.pop()
+        output = '(' + ",".join(child_strings) + ')' if len(child_strings) > 0 else ''
+        output += format_node(network, node, parent, edge_data)
+        if network.nodes[node]["type"] == "admixture":
+            expanded.add(node)
+
+        if len(stack) == 0:
+            return output + ";"
+        stack[-1][4].append(output)
+
+def write_networks_block(networks, out=None, names=None, canonical=False, edge_data=True):
+    """
+    Serializes a batch of networks as a NEXUS NETWORKS block, with one "Network name = ...;" line per network. Names default to net1, net2, ...
+    Writes to the stream out if it is given, and otherwise returns the block as a string.
+    """
+    stream = out if out is not None else io.StringIO()
 
-    return output
+    stream.write('BEGIN NETWORKS;\n')
+    for i, network in enumerate(networks):
+        name = names[i] if names is not None else f'net{i + 1}'
+        stream.write(f'Network {name} = {write_rich_newick(network, canonical=canonical, edge_data=edge_data)}\n')
+    stream.write('END;\n')
+
+    return stream.getvalue() if out is None else None
 
 if __name__ == "__main__":
     from admixture_network import generate_admixture_networks